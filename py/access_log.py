@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import queue
+import threading
+
+# records are collected on the loop and handed to the writer thread in
+# batches, every FLUSH_INTERVAL seconds or once BATCH_SIZE are pending
+FLUSH_INTERVAL = 1
+BATCH_SIZE = 1024
+
+FIELDS = ('client', 'destination', 'bytes_up', 'bytes_down', 'connect_ms',
+          'duration_ms', 'stage', 'reason')
+
+
+class AccessLog(object):
+    """One JSON line per tunnel, written off the event loop.
+
+    log() only appends a tuple in FIELDS order; formatting and the file
+    write happen on a background thread.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._records = []
+        self._loop = None
+        self._timer = None
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_batches,
+                                        name='access-log')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def add_to_loop(self, loop):
+        self._loop = loop
+        self._timer = loop.call_later(FLUSH_INTERVAL, self._on_flush_timer)
+
+    def log(self, record):
+        self._records.append(record)
+        if len(self._records) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._records:
+            self._queue.put(self._records)
+            self._records = []
+
+    def _on_flush_timer(self):
+        self.flush()
+        self._timer = self._loop.call_later(FLUSH_INTERVAL, self._on_flush_timer)
+
+    def _write_batches(self):
+        # unbuffered append: each batch is a single write(), so workers
+        # sharing the file don't interleave inside a line
+        with open(self._path, 'ab', buffering=0) as f:
+            while True:
+                batch = self._queue.get()
+                if batch is None:
+                    return
+                try:
+                    f.write(''.join(json.dumps(dict(zip(FIELDS, r))) + '\n'
+                                    for r in batch).encode('utf-8'))
+                except (OSError, IOError, ValueError) as e:
+                    logging.error('access log write failed: %s', e)
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+        self.flush()
+        self._queue.put(None)
+        self._writer.join()
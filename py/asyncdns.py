@@ -0,0 +1,619 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import re
+import socket
+import struct
+from collections import OrderedDict
+
+import common
+from event_loop import POLL_ERR, POLL_IN
+
+VALID_HOSTNAME = re.compile(br"(?!-)[A-Z\d\-_]{1,63}(?<!-)$", re.IGNORECASE)
+
+#   rfc1035
+#   format
+#   +---------------------+
+#   |        Header       |
+#   +---------------------+
+#   |       Question      | the question for the name server
+#   +---------------------+
+#   |        Answer       | RRs answering the question
+#   +---------------------+
+#   |      Authority      | RRs pointing toward an authority
+#   +---------------------+
+#   |      Additional     | RRs holding additional information
+#   +---------------------+
+#
+#   header
+#                                   1  1  1  1  1  1
+#     0  1  2  3  4  5  6  7  8  9  0  1  2  3  4  5
+#   +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+#   |                      ID                       |
+#   +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+#   |QR|   Opcode  |AA|TC|RD|RA|   Z    |   RCODE   |
+#   +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+#   |                    QDCOUNT                    |
+#   +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+#   |                    ANCOUNT                    |
+#   +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+#   |                    NSCOUNT                    |
+#   +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+#   |                    ARCOUNT                    |
+#   +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+
+QTYPE_ANY = 255
+QTYPE_A = 1
+QTYPE_AAAA = 28
+QTYPE_CNAME = 5
+QTYPE_NS = 2
+QCLASS_IN = 1
+
+# seconds to wait for one answer, and how many servers to try per qtype
+QUERY_TIMEOUT = 2
+QUERY_ATTEMPTS = 3
+
+# answers are cached for their own TTL, clamped to this range; failures
+# are cached for NEGATIVE_TTL so a dead name doesn't hammer the servers
+MIN_TTL = 1
+MAX_TTL = 3600
+NEGATIVE_TTL = 30
+CACHE_SIZE = 4096
+
+
+def build_address(address):
+    address = address.strip(b'.')
+    labels = address.split(b'.')
+    results = []
+    for label in labels:
+        l = len(label)
+        if l > 63:
+            return None
+        results.append(common.chr(l))
+        results.append(label)
+    results.append(b'\0')
+    return b''.join(results)
+
+
+def build_request(address, qtype):
+    request_id = os.urandom(2)
+    header = struct.pack('!BBHHHH', 1, 0, 1, 0, 0, 0)
+    addr = build_address(address)
+    qtype_qclass = struct.pack('!HH', qtype, QCLASS_IN)
+    return request_id + header + addr + qtype_qclass
+
+
+def parse_ip(addrtype, data, length, offset):
+    if addrtype == QTYPE_A:
+        return socket.inet_ntop(socket.AF_INET, data[offset:offset + length])
+    elif addrtype == QTYPE_AAAA:
+        return socket.inet_ntop(socket.AF_INET6, data[offset:offset + length])
+    elif addrtype in [QTYPE_CNAME, QTYPE_NS]:
+        return parse_name(data, offset)[1]
+    else:
+        return data[offset:offset + length]
+
+
+def parse_name(data, offset):
+    p = offset
+    labels = []
+    l = common.ord(data[p])
+    while l > 0:
+        if (l & (128 + 64)) == (128 + 64):
+            # pointer
+            pointer = struct.unpack('!H', data[p:p + 2])[0]
+            pointer &= 0x3FFF
+            r = parse_name(data, pointer)
+            labels.append(r[1])
+            p += 2
+            # pointer is the end
+            return p - offset, b'.'.join(labels)
+        else:
+            labels.append(data[p + 1:p + 1 + l])
+            p += 1 + l
+        l = common.ord(data[p])
+    return p - offset + 1, b'.'.join(labels)
+
+
+def parse_record(data, offset, question=False):
+    nlen, name = parse_name(data, offset)
+    if not question:
+        record_type, record_class, record_ttl, record_rdlength = struct.unpack(
+            '!HHiH', data[offset + nlen:offset + nlen + 10]
+        )
+        ip = parse_ip(record_type, data, record_rdlength, offset + nlen + 10)
+        return nlen + 10 + record_rdlength, \
+            (name, ip, record_type, record_class, record_ttl)
+    else:
+        record_type, record_class = struct.unpack(
+            '!HH', data[offset + nlen:offset + nlen + 4]
+        )
+        return nlen + 4, (name, None, record_type, record_class, None)
+
+
+def parse_header(data):
+    if len(data) >= 12:
+        header = struct.unpack('!HBBHHHH', data[:12])
+        res_id = header[0]
+        res_qr = header[1] & 128
+        res_tc = header[1] & 2
+        res_ra = header[2] & 128
+        res_rcode = header[2] & 15
+        res_qdcount = header[3]
+        res_ancount = header[4]
+        res_nscount = header[5]
+        res_arcount = header[6]
+        return (res_id, res_qr, res_tc, res_ra, res_rcode, res_qdcount,
+                res_ancount, res_nscount, res_arcount)
+    return None
+
+
+def parse_response(data):
+    try:
+        if len(data) >= 12:
+            header = parse_header(data)
+            if not header:
+                return None
+            res_id, res_qr, res_tc, res_ra, res_rcode, res_qdcount, \
+                res_ancount, res_nscount, res_arcount = header
+
+            qds = []
+            ans = []
+            offset = 12
+            for i in range(0, res_qdcount):
+                l, r = parse_record(data, offset, True)
+                offset += l
+                if r:
+                    qds.append(r)
+            for i in range(0, res_ancount):
+                l, r = parse_record(data, offset)
+                offset += l
+                if r:
+                    ans.append(r)
+            response = DNSResponse()
+            if qds:
+                response.hostname = qds[0][0]
+            for an in qds:
+                response.questions.append((an[1], an[2], an[3]))
+            for an in ans:
+                response.answers.append((an[1], an[2], an[3], an[4]))
+            return response
+    except Exception as e:
+        logging.exception(e)
+        return None
+
+
+def is_valid_hostname(hostname):
+    if len(hostname) > 255:
+        return False
+    if hostname[-1:] == b'.':
+        hostname = hostname[:-1]
+    return all(VALID_HOSTNAME.match(x) for x in hostname.split(b'.'))
+
+
+class DNSResponse(object):
+    def __init__(self):
+        self.hostname = None
+        self.questions = []  # each: (addr, type, class)
+        self.answers = []  # each: (addr, type, class, ttl)
+
+    def __str__(self):
+        return '%s: %s' % (self.hostname, str(self.answers))
+
+
+class DNSResolver(object):
+    """Non-blocking resolver driven by an EventLoop.
+
+    Lookups are tracked per (hostname, qtype): concurrent requests for the
+    same pair share a single query, and answers (including failures) are
+    cached for their TTL.
+    """
+
+    def __init__(self, server_list=None, prefer_ipv6=False):
+        self._loop = None
+        self._hosts = {}
+        self._cache = OrderedDict()  # (hostname, qtype) -> (expire_at, ips)
+        self._pending = {}  # (hostname, qtype) -> {owner: [callback]}
+        self._owners = {}  # owner -> set of the keys it waits for
+        self._query_ids = {}  # (hostname, qtype) -> ids of the queries sent
+        self._timers = {}
+        self._attempts = {}
+        self._sock = None
+        self._server_index = 0
+        if server_list is None:
+            self._servers = None
+            self._parse_resolv()
+        else:
+            self._servers = [s if isinstance(s, tuple) else (s, 53)
+                             for s in server_list]
+        if prefer_ipv6:
+            self._QTYPES = [QTYPE_AAAA, QTYPE_A]
+        else:
+            self._QTYPES = [QTYPE_A, QTYPE_AAAA]
+        self._parse_hosts()
+
+    def _parse_resolv(self):
+        self._servers = []
+        try:
+            with open('/etc/resolv.conf', 'rb') as f:
+                content = f.readlines()
+                for line in content:
+                    line = line.strip()
+                    if not (line and line.startswith(b'nameserver')):
+                        continue
+                    parts = line.split()
+                    if len(parts) < 2:
+                        continue
+                    server = parts[1]
+                    # the query socket is AF_INET, skip v6 nameservers
+                    if common.is_ip(server) == socket.AF_INET:
+                        self._servers.append((common.to_str(server), 53))
+        except IOError:
+            pass
+        if not self._servers:
+            self._servers = [('8.8.4.4', 53), ('8.8.8.8', 53)]
+
+    def _parse_hosts(self):
+        etc_path = '/etc/hosts'
+        if 'WINDIR' in os.environ:
+            etc_path = os.environ['WINDIR'] + '/system32/drivers/etc/hosts'
+        try:
+            with open(etc_path, 'rb') as f:
+                for line in f.readlines():
+                    line = line.split(b'#', 1)[0].strip()
+                    parts = line.split()
+                    if len(parts) < 2:
+                        continue
+                    ip = parts[0]
+                    if not common.is_ip(ip):
+                        continue
+                    for hostname in parts[1:]:
+                        if hostname:
+                            self._hosts.setdefault(hostname.lower(), ip)
+        except IOError:
+            pass
+        self._hosts.setdefault(b'localhost', b'127.0.0.1')
+
+    def add_to_loop(self, loop):
+        if self._loop:
+            raise Exception('already add to loop')
+        self._loop = loop
+        self._open_sock()
+
+    def _open_sock(self):
+        # AF_INET only, _parse_resolv leaves out v6 nameservers
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                   socket.SOL_UDP)
+        self._sock.setblocking(False)
+        self._loop.add(self._sock, POLL_IN | POLL_ERR, self)
+
+    def _cache_get(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= self._loop.time():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return entry[1]
+
+    def _cache_put(self, key, ips, ttl):
+        ttl = max(MIN_TTL, min(ttl, MAX_TTL))
+        self._cache[key] = (self._loop.time() + ttl, ips)
+        self._cache.move_to_end(key)
+        while len(self._cache) > CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    def _finish(self, key, ips, ttl):
+        self._cache_put(key, ips, ttl)
+        self._attempts.pop(key, None)
+        self._query_ids.pop(key, None)
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        pending = self._pending.pop(key, {})
+        for owner in pending:
+            keys = self._owners.get(owner)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._owners[owner]
+        for callbacks in pending.values():
+            for callback in callbacks:
+                callback(ips)
+
+    def _handle_data(self, data):
+        response = parse_response(data)
+        if not (response and response.hostname and response.questions):
+            return
+        key = (response.hostname.lower(), response.questions[0][1])
+        if struct.unpack('!H', data[:2])[0] not in self._query_ids.get(key, ()):
+            # late, unsolicited or spoofed answer
+            return
+        ips = []
+        ttl = MAX_TTL
+        for answer in response.answers:
+            if answer[1] == key[1] and answer[2] == QCLASS_IN:
+                ips.append(common.to_bytes(answer[0]))
+                ttl = min(ttl, answer[3])
+        if ips:
+            self._finish(key, ips, ttl)
+        else:
+            self._finish(key, ips, NEGATIVE_TTL)
+
+    def handle_event(self, sock, fd, event):
+        if sock != self._sock:
+            return
+        if event & POLL_ERR:
+            logging.error('dns socket err')
+            self._loop.remove(self._sock)
+            self._sock.close()
+            self._open_sock()
+            return
+        while True:
+            try:
+                data, addr = sock.recvfrom(1024)
+            except (OSError, IOError):
+                return
+            if addr in self._servers:
+                self._handle_data(data)
+
+    def _on_query_timeout(self, key):
+        self._timers.pop(key, None)
+        if key not in self._pending:
+            return
+        if self._attempts.get(key, 0) < min(QUERY_ATTEMPTS, len(self._servers)):
+            self._send_req(key)
+        else:
+            logging.warning('dns query for %s type %d timed out',
+                            common.to_str(key[0]), key[1])
+            self._finish(key, [], NEGATIVE_TTL)
+
+    def _send_req(self, key):
+        hostname, qtype = key
+        req = build_request(hostname, qtype)
+        # an answer has to carry one of the ids sent, a retry may still
+        # get the answer to an earlier attempt
+        self._query_ids.setdefault(key, set()).add(struct.unpack('!H', req[:2])[0])
+        # rotate through the servers so a retry goes somewhere else
+        server = self._servers[self._server_index % len(self._servers)]
+        self._server_index += 1
+        self._attempts[key] = self._attempts.get(key, 0) + 1
+        logging.debug('resolving %s with type %d using server %s',
+                      common.to_str(hostname), qtype, server)
+        try:
+            self._sock.sendto(req, server)
+        except (OSError, IOError) as e:
+            logging.error('dns sendto %s: %s', server, e)
+        timer = self._timers.get(key)
+        if timer:
+            timer.cancel()
+        self._timers[key] = self._loop.call_later(
+            QUERY_TIMEOUT, self._on_query_timeout, key)
+
+    def _lookup(self, hostname, qtype, owner, callback):
+        key = (hostname, qtype)
+        ips = self._cache_get(key)
+        if ips is not None:
+            callback(ips)
+            return
+        self._owners.setdefault(owner, set()).add(key)
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = {owner: [callback]}
+            self._send_req(key)
+        else:
+            # coalesce with the query already in flight
+            pending.setdefault(owner, []).append(callback)
+
+    def _resolve_static(self, hostname, callback):
+        if not hostname:
+            callback(None, Exception('empty hostname'))
+        elif common.is_ip(hostname):
+            return [hostname]
+        elif hostname.lower() in self._hosts:
+            logging.debug('hit hosts: %s', common.to_str(hostname))
+            return [self._hosts[hostname.lower()]]
+        elif not is_valid_hostname(hostname):
+            callback(None, Exception('invalid hostname: %s' % hostname))
+        else:
+            return None
+        return []
+
+    def resolve(self, hostname, callback):
+        """Call callback((hostname, ip), error) with one address.
+
+        The preferred family is asked first, the other one only if the
+        first has no answer.
+        """
+        hostname = common.to_bytes(hostname)
+        ips = self._resolve_static(hostname, callback)
+        if ips:
+            callback((hostname, ips[0]), None)
+        if ips is not None:
+            return
+        hostname = hostname.lower()
+        first, second = self._QTYPES
+
+        def on_second(ips):
+            if ips:
+                callback((hostname, ips[0]), None)
+            else:
+                callback((hostname, None),
+                         Exception('unknown hostname %s' % hostname))
+
+        def on_first(ips):
+            if ips:
+                callback((hostname, ips[0]), None)
+            else:
+                self._lookup(hostname, second, callback, on_second)
+
+        self._lookup(hostname, first, callback, on_first)
+
+    def resolve_all(self, hostname, callback):
+        """Call callback((hostname, [ip, ...]), error) with every address.
+
+        Both families are queried in parallel and the result alternates
+        between them, preferred family first, as RFC 8305 suggests for
+        connection attempts.
+        """
+        hostname = common.to_bytes(hostname)
+        ips = self._resolve_static(hostname, callback)
+        if ips:
+            callback((hostname, ips), None)
+        if ips is not None:
+            return
+        hostname = hostname.lower()
+        results = {}
+
+        def on_answer(qtype, ips):
+            results[qtype] = ips
+            if len(results) < len(self._QTYPES):
+                return
+            first, second = [results[t] for t in self._QTYPES]
+            merged = []
+            for i in range(max(len(first), len(second))):
+                merged.extend(first[i:i + 1])
+                merged.extend(second[i:i + 1])
+            if merged:
+                callback((hostname, merged), None)
+            else:
+                callback((hostname, []),
+                         Exception('unknown hostname %s' % hostname))
+
+        for qtype in self._QTYPES:
+            self._lookup(hostname, qtype, callback,
+                         lambda ips, qtype=qtype: on_answer(qtype, ips))
+
+    def remove_callback(self, callback):
+        # the queries keep running, their answers are still worth caching
+        for key in self._owners.pop(callback, ()):
+            self._pending[key].pop(callback, None)
+
+    def close(self):
+        if self._sock:
+            if self._loop:
+                self._loop.remove(self._sock)
+            self._sock.close()
+            self._sock = None
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+
+
+def _build_answer(query, ips, ttl):
+    # a minimal authoritative answer for the stub server used in test()
+    qdcount_end = 12
+    while common.ord(query[qdcount_end]) != 0:
+        qdcount_end += common.ord(query[qdcount_end]) + 1
+    question = query[12:qdcount_end + 5]
+    qtype = struct.unpack('!H', question[-4:-2])[0]
+    answers = []
+    for ip in ips:
+        family = socket.AF_INET6 if b':' in ip else socket.AF_INET
+        if (family == socket.AF_INET) != (qtype == QTYPE_A):
+            continue
+        rdata = socket.inet_pton(family, common.to_str(ip))
+        answers.append(b'\xc0\x0c' + struct.pack('!HHiH', qtype, QCLASS_IN,
+                                                  ttl, len(rdata)) + rdata)
+    header = query[:2] + struct.pack('!BBHHHH', 0x81, 0x80, 1, len(answers),
+                                     0, 0)
+    return header + question + b''.join(answers)
+
+
+def test():
+    from event_loop import EventLoop
+
+    records = {b'example.test': [b'10.0.0.1'], b'v6.example.test': [b'::1'],
+               b'dual.test': [b'10.0.0.2', b'10.0.0.3', b'::2']}
+    queries = []
+
+    class StubServer(object):
+        def __init__(self, loop):
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind(('127.0.0.1', 0))
+            loop.add(self.sock, POLL_IN, self)
+
+        def handle_event(self, sock, fd, event):
+            data, addr = sock.recvfrom(1024)
+            name = parse_response(data).hostname
+            queries.append(name)
+            sock.sendto(_build_answer(data, records.get(name, []), 60), addr)
+
+    loop = EventLoop()
+    stub = StubServer(loop)
+    resolver = DNSResolver([stub.sock.getsockname()])
+    resolver.add_to_loop(loop)
+    results = []
+
+    def callback(result, error):
+        results.append((result, error))
+
+    def run_until(n):
+        deadline = loop.time() + 5
+        while len(results) < n and loop.time() < deadline:
+            for sock, fd, event in loop.poll(0.1):
+                loop._handlers[fd].handle_event(sock, fd, event)
+            loop._run_timers()
+
+    resolver.resolve(b'example.test', callback)
+    resolver.resolve(b'example.test', callback)
+    run_until(2)
+    assert [r[0] for r in results] == [(b'example.test', b'10.0.0.1')] * 2
+    assert queries == [b'example.test']
+
+    resolver.resolve(b'example.test', callback)
+    assert results[-1][0] == (b'example.test', b'10.0.0.1')
+    assert len(queries) == 1
+
+    resolver.resolve(b'v6.example.test', callback)
+    run_until(4)
+    assert results[-1][0] == (b'v6.example.test', b'::1')
+
+    resolver.resolve(b'missing.test', callback)
+    run_until(5)
+    assert results[-1][1] is not None
+    resolver.resolve(b'missing.test', callback)
+    assert results[-1][1] is not None
+    assert queries.count(b'missing.test') == 2
+
+    resolver.resolve_all(b'dual.test', callback)
+    run_until(7)
+    assert results[-1][0] == (b'dual.test', [b'10.0.0.2', b'::2', b'10.0.0.3'])
+
+    resolver.resolve(b'127.0.0.1', callback)
+    assert results[-1][0] == (b'127.0.0.1', b'127.0.0.1')
+
+    # an answer with an id that wasn't sent is dropped
+    resolver.resolve(b'spoof.test', callback)
+    query = build_request(b'spoof.test', QTYPE_A)
+    forged = _build_answer(query, [b'10.6.6.6'], 60)
+    if struct.unpack('!H', forged[:2])[0] not in resolver._query_ids[(b'spoof.test', QTYPE_A)]:
+        resolver._handle_data(forged)
+        assert (b'spoof.test', QTYPE_A) in resolver._pending
+    records[b'spoof.test'] = [b'10.0.0.4']
+    run_until(len(results) + 1)
+    assert results[-1][0] == (b'spoof.test', b'10.0.0.4')
+    assert not resolver._query_ids and not resolver._owners
+
+    # a removed callback isn't called, the answer is still cached
+    removed = []
+    resolver.resolve_all(b'dual2.test', removed.append)
+    resolver.remove_callback(removed.append)
+    assert not resolver._owners
+    records[b'dual2.test'] = [b'10.0.0.5']
+    deadline = loop.time() + 5
+    while resolver._pending and loop.time() < deadline:
+        for sock, fd, event in loop.poll(0.1):
+            loop._handlers[fd].handle_event(sock, fd, event)
+    assert not removed and resolver._cache_get((b'dual2.test', QTYPE_A)) == [b'10.0.0.5']
+    # ipv6 literals as a socks5 ATYP 4 request carries them
+    for literal in (b'::1', b'::ffff:127.0.0.1', b'2001:db8::8'):
+        resolver.resolve_all(literal, callback)
+        assert results[-1] == ((literal, [literal]), None)
+    resolver.close()
+    loop.close()
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import functools
+import logging
+import signal
+import socket
+
+import common
+from common import CMD_CONNECT, CONNECT_ERRNO_REPLIES, METHOD_NO_AUTH, \
+    SOCKS_VERSION, parse_header_from, socks5_request_length
+from send_queue import HIGH_WATERMARK, LOW_WATERMARK
+from stats import STAGE_ADDR, STAGE_CONNECTING, STAGE_DESTROYED, STAGE_INIT, STAGE_STREAM, \
+    Stats, collect_tunnels
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# the same limits as tcp_event
+HANDSHAKE_TIMEOUT = 10
+CONNECT_TIMEOUT = 10
+IDLE_TIMEOUT = 300
+# rfc8305 connection attempt delay, handed to create_connection()
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+
+class _RemoteProtocol(asyncio.Protocol):
+    def __init__(self, tunnel):
+        self._tunnel = tunnel
+
+    def data_received(self, data):
+        self._tunnel.remote_data(data)
+
+    def eof_received(self):
+        self._tunnel.close('eof')
+
+    def connection_lost(self, exc):
+        self._tunnel.close('eof' if exc is None else 'error')
+
+    # the remote side can't take more: stop reading the client
+    def pause_writing(self):
+        self._tunnel.pause_local()
+
+    def resume_writing(self):
+        self._tunnel.resume_local()
+
+
+class SocksProtocol(asyncio.Protocol):
+    """One client connection: socks5 handshake, connect, then relay.
+
+    Buffering and flow control are the transports': each side's write
+    buffer limits pause and resume reading on the other side.
+    """
+
+    def __init__(self, server):
+        self._server = server
+        self._loop = server.loop
+        self._transport = None  # type: asyncio.Transport
+        self._remote = None  # type: asyncio.Transport
+        self._stage = STAGE_INIT
+        self._handshake = bytearray()
+        self._pending = []  # client data that arrived while connecting
+        self._pending_size = 0
+        self._bytes_up = 0
+        self._bytes_down = 0
+        self._last_activity = self._loop.time()
+        self._timer = None
+        self._connect_task = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._server.stats.accepts += 1
+        peer = transport.get_extra_info('peername')
+        allowed = self._server.allowed_clients
+        if allowed and peer[0] not in allowed:
+            self._server.stats.acl_denied += 1
+            transport.abort()
+            self._stage = STAGE_DESTROYED
+            return
+        sock = transport.get_extra_info('socket')
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        transport.set_write_buffer_limits(HIGH_WATERMARK, LOW_WATERMARK)
+        self._server.tunnels.add(self)
+        self._timer = self._loop.call_later(HANDSHAKE_TIMEOUT, self._on_timeout)
+
+    def stat_values(self):
+        queued = self._transport.get_write_buffer_size()
+        if self._remote:
+            queued += self._remote.get_write_buffer_size()
+        return self._stage, self._bytes_up, self._bytes_down, queued
+
+    def _on_timeout(self):
+        if self._stage == STAGE_DESTROYED:
+            return
+        if self._stage == STAGE_STREAM:
+            remaining = self._last_activity + IDLE_TIMEOUT - self._loop.time()
+            if remaining > 0:
+                self._timer = self._loop.call_later(remaining, self._on_timeout)
+                return
+        if self._stage == STAGE_CONNECTING:
+            self._reply_error(common.REP_HOST_UNREACHABLE, 'timeout')
+        else:
+            self.close('timeout')
+
+    def _set_stage(self, stage, timeout):
+        self._stage = stage
+        self._timer.cancel()
+        self._timer = self._loop.call_later(timeout, self._on_timeout)
+
+    def _reply_error(self, rep, reason):
+        if self._stage == STAGE_DESTROYED:
+            return
+        self._transport.write(common.socks5_reply(rep))
+        self.close(reason)
+
+    def data_received(self, data):
+        if self._stage == STAGE_STREAM:
+            self._bytes_up += len(data)
+            self._last_activity = self._loop.time()
+            self._remote.write(data)
+        elif self._stage == STAGE_CONNECTING:
+            self._bytes_up += len(data)
+            self._hold(data)
+        elif self._stage != STAGE_DESTROYED:
+            self._handshake += data
+            self._parse_handshake()
+
+    def _parse_handshake(self):
+        data = self._handshake
+        if self._stage == STAGE_INIT:
+            if len(data) < 2:
+                return
+            if data[0] != SOCKS_VERSION:
+                self.close('protocol')
+                return
+            end = 2 + data[1]
+            if len(data) < end:
+                return
+            if METHOD_NO_AUTH not in data[2:end]:
+                self._transport.write(b'\x05\xff')
+                self.close('protocol')
+                return
+            self._transport.write(b'\x05\x00')
+            self._set_stage(STAGE_ADDR, HANDSHAKE_TIMEOUT)
+            del data[:end]
+        length = socks5_request_length(data)
+        if length is None:
+            return
+        if length < 0:
+            self._reply_error(common.REP_ADDRTYPE_NOT_SUPPORTED, 'protocol')
+            return
+        if data[0] != SOCKS_VERSION:
+            self.close('protocol')
+            return
+        if data[1] != CMD_CONNECT:
+            # udp associate needs the event loop engine
+            self._reply_error(common.REP_COMMAND_NOT_SUPPORTED, 'protocol')
+            return
+        header_result = parse_header_from(data, 3)
+        if not header_result:
+            self._reply_error(common.REP_GENERAL_FAILURE, 'protocol')
+            return
+        addrtype, remote_addr, remote_port, header_length = header_result
+        forbidden_ip = self._server.forbidden_ip
+        if forbidden_ip and addrtype != common.ADDRTYPE_HOST and \
+                forbidden_ip.contains_packed(data[4:length - 2]):
+            self._reply_error(common.REP_NOT_ALLOWED, 'forbidden')
+            return
+        if len(data) > length:
+            # payload pipelined behind the request goes out on connect
+            self._bytes_up += len(data) - length
+            self._hold(bytes(data[length:]))
+        self._handshake = None
+        self._set_stage(STAGE_CONNECTING, CONNECT_TIMEOUT)
+        self._connect_task = self._loop.create_task(
+            self._connect(common.to_str(remote_addr), remote_port))
+
+    def _hold(self, data):
+        # the client isn't read past HIGH_WATERMARK until the remote end
+        # is there to take it, as in the event loop engine
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= HIGH_WATERMARK:
+            self._transport.pause_reading()
+
+    async def _connect(self, host, port):
+        try:
+            transport = await self._open_remote(host, port)
+        except asyncio.CancelledError:
+            return
+        except socket.gaierror as e:
+            logging.debug('resolve %s failed: %s', host, e)
+            self._reply_error(common.REP_HOST_UNREACHABLE, 'dns')
+            return
+        except (OSError, IOError) as e:
+            logging.debug('connect %s:%d failed: %s', host, port, e)
+            self._reply_error(CONNECT_ERRNO_REPLIES.get(e.errno, common.REP_GENERAL_FAILURE),
+                              'connect')
+            return
+        if transport is None:
+            self._reply_error(common.REP_NOT_ALLOWED, 'forbidden')
+            return
+        if self._stage == STAGE_DESTROYED:
+            transport.close()
+            return
+        self._remote = transport
+        transport.set_write_buffer_limits(HIGH_WATERMARK, LOW_WATERMARK)
+        transport.get_extra_info('socket').setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        bind_addr = transport.get_extra_info('sockname')
+        self._transport.write(common.socks5_reply(common.REP_SUCCEEDED, bind_addr[0], bind_addr[1]))
+        self._last_activity = self._loop.time()
+        self._set_stage(STAGE_STREAM, IDLE_TIMEOUT)
+        if self._pending_size >= HIGH_WATERMARK:
+            # before the writes, a remote that can't take them all
+            # pauses the client again through pause_writing()
+            self._transport.resume_reading()
+        for data in self._pending:
+            transport.write(data)
+        self._pending = None
+        self._pending_size = 0
+
+    async def _open_remote(self, host, port):
+        """Connected transport, or None if every address is forbidden."""
+        forbidden_ip = self._server.forbidden_ip
+        factory = lambda: _RemoteProtocol(self)
+        if not forbidden_ip:
+            transport, _ = await self._loop.create_connection(
+                factory, host, port, happy_eyeballs_delay=CONNECTION_ATTEMPT_DELAY,
+                interleave=1)
+            return transport
+        # the addresses have to be filtered before anything connects, so
+        # resolve here and try what is left in order
+        infos = await self._loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        addrs = [info[4] for info in infos if info[4][0] not in forbidden_ip]
+        error = None
+        for addr in addrs:
+            try:
+                transport, _ = await self._loop.create_connection(factory, addr[0], addr[1])
+                return transport
+            except (OSError, IOError) as e:
+                error = e
+        if error:
+            raise error
+        return None
+
+    def remote_data(self, data):
+        self._bytes_down += len(data)
+        self._last_activity = self._loop.time()
+        self._transport.write(data)
+
+    # the client can't take more: stop reading the remote
+    def pause_writing(self):
+        if self._remote:
+            self._remote.pause_reading()
+
+    def resume_writing(self):
+        if self._remote:
+            self._remote.resume_reading()
+
+    def pause_local(self):
+        self._transport.pause_reading()
+
+    def resume_local(self):
+        self._transport.resume_reading()
+
+    def eof_received(self):
+        self.close('eof')
+
+    def connection_lost(self, exc):
+        self.close('eof' if exc is None else 'error')
+
+    def close(self, reason='closed'):
+        if self._stage == STAGE_DESTROYED:
+            return
+        server = self._server
+        server.tunnels.discard(self)
+        server.stats.count_closed(reason, self._bytes_up, self._bytes_down)
+        self._stage = STAGE_DESTROYED
+        if self._timer:
+            self._timer.cancel()
+        if self._connect_task and not self._connect_task.done():
+            self._connect_task.cancel()
+        if self._remote:
+            self._remote.close()
+        # close() still flushes what was written, a reply included
+        self._transport.close()
+
+
+class AsyncioServer(object):
+    """The socks5 server on an asyncio loop, next to TCPServerEvent."""
+
+    def __init__(self, loop, config=None):
+        self.loop = loop
+        self.config = config or {}
+        self.forbidden_ip = self.config.get('forbidden_ip')  # type: common.IPNetwork
+        self.allowed_clients = self.config.get('allowed_clients')  # type: common.IPNetwork
+        self.tunnels = set()
+        self.stats = Stats()
+        self.stats.sources.append(functools.partial(collect_tunnels, self.tunnels))
+        self._server = None
+
+    async def start(self, port):
+        self._server = await self.loop.create_server(
+            lambda: SocksProtocol(self), '0.0.0.0', port, backlog=1024,
+            reuse_port=self.config.get('reuse_port') or None)
+        logging.info("asyncio engine listening on port:%s", port)
+
+    def close(self):
+        if self._server:
+            self._server.close()
+        for tunnel in list(self.tunnels):
+            tunnel.close()
+
+
+def serve(port, config):
+    # type: (int,dict) -> None
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = asyncio.new_event_loop()
+    logging.debug("using asyncio loop: %s", type(loop).__name__)
+    for key in ('admin_port', 'access_log', 'http_proxy', 'splice', 'upstream', 'mux_port',
+                'rate_limit', 'client_rate_limit', 'global_rate_limit', 'read_budget',
+                'loop_profile'):
+        if config.get(key):
+            logging.warning("%s is not supported by the asyncio engine", key)
+    server = AsyncioServer(loop, config)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_until_complete(server.start(port))
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.close()
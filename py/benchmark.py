@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+#
+# End to end load test: a local echo origin, the proxy under test and a
+# SOCKS5 load generator, all on loopback. For every concurrency level it
+# records tunnel setup rate, ping-pong latency, bulk throughput and proxy
+# RSS, and writes everything to one JSON file so runs can be diffed:
+#
+#   python benchmark.py --levels 10,1000,10000 -o bench.json
+#   python benchmark.py --go-binary ../go/socks_proxy   # go/main.go, port 1082
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+from event_loop import EVENT_MODELS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PING_SIZE = 64
+BULK_CHUNK = 16 * 1024
+# bulk senders keep at most this much unechoed data in flight per tunnel
+BULK_WINDOW = 64 * 1024
+# tunnels handshaking at once per generator during setup
+SETUP_INFLIGHT = 256
+# cap on latency samples kept per generator (reservoir sampled)
+MAX_SAMPLES = 100000
+
+ST_CONNECT = 0
+ST_GREETING = 1
+ST_REQUEST = 2
+ST_READY = 3
+
+
+def raise_nofile():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def rss_kb(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (OSError, IOError):
+        pass
+    out = subprocess.check_output(['ps', '-o', 'rss=', '-p', str(pid)])
+    return int(out.strip() or 0)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))
+    return sorted_values[index]
+
+
+def wait_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except (OSError, IOError):
+            time.sleep(0.05)
+    raise Exception('nothing listening on port %d' % port)
+
+
+def serve_origin(sock):
+    # echo everything back; one selector loop handles every connection
+    raise_nofile()
+    sel = selectors.DefaultSelector()
+    sock.setblocking(False)
+    sel.register(sock, selectors.EVENT_READ)
+    pending = {}
+    while True:
+        for key, events in sel.select():
+            s = key.fileobj
+            if s is sock:
+                try:
+                    conn, addr = sock.accept()
+                except (OSError, IOError):
+                    continue
+                conn.setblocking(False)
+                pending[conn] = b''
+                sel.register(conn, selectors.EVENT_READ)
+                continue
+            try:
+                if events & selectors.EVENT_READ and not pending[s]:
+                    data = s.recv(256 * 1024)
+                    if not data:
+                        raise EOFError()
+                    pending[s] = data
+                if pending[s]:
+                    pending[s] = pending[s][s.send(pending[s]):]
+            except BlockingIOError:
+                pass
+            except (OSError, IOError, EOFError):
+                sel.unregister(s)
+                del pending[s]
+                s.close()
+                continue
+            sel.modify(s, selectors.EVENT_WRITE if pending[s]
+                       else selectors.EVENT_READ)
+
+
+def start_origin():
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(4096)
+    process = multiprocessing.Process(target=serve_origin, args=(sock,))
+    process.daemon = True
+    process.start()
+    port = sock.getsockname()[1]
+    sock.close()
+    return process, port
+
+
+class _Client(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.state = ST_CONNECT
+        self.buf = b''
+        self.started = time.time()
+        self.outstanding = 0
+
+
+class _Samples(object):
+    def __init__(self):
+        self.values = []
+        self.seen = 0
+
+    def add(self, value):
+        self.seen += 1
+        if len(self.values) < MAX_SAMPLES:
+            self.values.append(value)
+        else:
+            i = random.randrange(self.seen)
+            if i < MAX_SAMPLES:
+                self.values[i] = value
+
+
+def _socks_request(origin_port):
+    return b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') + \
+        struct.pack('>H', origin_port)
+
+
+def _setup(sel, proxy_port, origin_port, count, deadline):
+    request = _socks_request(origin_port)
+    ready, failed, started, inflight = [], 0, 0, 0
+    latencies = _Samples()
+    while len(ready) + failed < count and time.time() < deadline:
+        while inflight < SETUP_INFLIGHT and started < count:
+            sock = socket.socket()
+            sock.setblocking(False)
+            sock.connect_ex(('127.0.0.1', proxy_port))
+            sel.register(sock, selectors.EVENT_WRITE, _Client(sock))
+            started += 1
+            inflight += 1
+        for key, events in sel.select(0.5):
+            c = key.data
+            try:
+                if c.state == ST_CONNECT:
+                    err = c.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err:
+                        raise OSError(err, os.strerror(err))
+                    c.sock.sendall(b'\x05\x01\x00')
+                    c.state = ST_GREETING
+                    sel.modify(c.sock, selectors.EVENT_READ, c)
+                    continue
+                data = c.sock.recv(64)
+                if not data:
+                    raise EOFError()
+                c.buf += data
+                if c.state == ST_GREETING and len(c.buf) >= 2:
+                    c.buf = c.buf[2:]
+                    c.sock.sendall(request)
+                    c.state = ST_REQUEST
+                if c.state == ST_REQUEST and len(c.buf) >= 10:
+                    if c.buf[1:2] != b'\x00':
+                        raise EOFError()
+                    c.buf = b''
+                    c.state = ST_READY
+                    latencies.add(time.time() - c.started)
+                    sel.unregister(c.sock)
+                    ready.append(c)
+                    inflight -= 1
+            except BlockingIOError:
+                pass
+            except (OSError, IOError, EOFError):
+                sel.unregister(c.sock)
+                c.sock.close()
+                failed += 1
+                inflight -= 1
+    return ready, failed, latencies
+
+
+def _ping(sel, clients, duration):
+    payload = b'p' * PING_SIZE
+    rtts = _Samples()
+    errors = 0
+    for c in clients:
+        c.started = time.time()
+        c.sock.send(payload)
+        sel.register(c.sock, selectors.EVENT_READ, c)
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        for key, events in sel.select(0.1):
+            c = key.data
+            try:
+                data = c.sock.recv(PING_SIZE)
+                if not data:
+                    raise EOFError()
+            except BlockingIOError:
+                continue
+            except (OSError, IOError, EOFError):
+                sel.unregister(c.sock)
+                errors += 1
+                continue
+            c.buf += data
+            if len(c.buf) >= PING_SIZE:
+                now = time.time()
+                rtts.add(now - c.started)
+                c.buf = b''
+                c.started = now
+                c.sock.send(payload)
+    for c in clients:
+        if c.sock in sel.get_map():
+            sel.unregister(c.sock)
+    return rtts, errors
+
+
+def _bulk(sel, clients, duration):
+    chunk = os.urandom(BULK_CHUNK)
+    received = 0
+    # drain ping replies still in flight first
+    for c in clients:
+        c.sock.setblocking(True)
+        c.sock.settimeout(5)
+        try:
+            while len(c.buf) < PING_SIZE:
+                c.buf += c.sock.recv(PING_SIZE - len(c.buf))
+        except (OSError, IOError):
+            pass
+        c.sock.setblocking(False)
+        c.buf = b''
+        c.outstanding = 0
+        sel.register(c.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, c)
+    start = time.time()
+    deadline = start + duration
+    while time.time() < deadline:
+        for key, events in sel.select(0.1):
+            c = key.data
+            try:
+                if events & selectors.EVENT_READ:
+                    n = len(c.sock.recv(256 * 1024))
+                    received += n
+                    c.outstanding -= n
+                if c.outstanding < BULK_WINDOW:
+                    c.outstanding += c.sock.send(chunk)
+                # only ask for writability while the window has room
+                sel.modify(c.sock, selectors.EVENT_READ | selectors.EVENT_WRITE
+                           if c.outstanding < BULK_WINDOW else selectors.EVENT_READ, c)
+            except BlockingIOError:
+                pass
+            except (OSError, IOError):
+                sel.unregister(c.sock)
+    return received, time.time() - start
+
+
+def generate(proxy_port, origin_port, count, duration, results):
+    raise_nofile()
+    sel = selectors.DefaultSelector()
+    start = time.time()
+    clients, failed, setup = _setup(sel, proxy_port, origin_port, count,
+                                    start + max(30, duration * 10))
+    setup_time = time.time() - start
+    rtts, ping_errors = _ping(sel, clients, duration)
+    received, bulk_time = _bulk(sel, clients, duration)
+    for c in clients:
+        c.sock.close()
+    results.put({'established': len(clients), 'failed': failed,
+                 'setup_time': setup_time, 'setup': setup.values,
+                 'rtts': rtts.values, 'pings': rtts.seen,
+                 'ping_errors': ping_errors, 'bulk_bytes': received,
+                 'bulk_time': bulk_time})
+
+
+def run_level(proxy_pid, proxy_port, origin_port, concurrency, duration,
+              generators):
+    generators = max(1, min(generators, concurrency))
+    results = multiprocessing.Queue()
+    processes = []
+    for i in range(generators):
+        count = concurrency // generators + (i < concurrency % generators)
+        p = multiprocessing.Process(target=generate, args=(
+            proxy_port, origin_port, count, duration, results))
+        p.start()
+        processes.append(p)
+    parts = [results.get() for p in processes]
+    rss_loaded = rss_kb(proxy_pid)
+    for p in processes:
+        p.join()
+    setup = sorted(v for part in parts for v in part['setup'])
+    rtts = sorted(v for part in parts for v in part['rtts'])
+    established = sum(part['established'] for part in parts)
+    setup_time = max(part['setup_time'] for part in parts)
+    bulk_time = max(part['bulk_time'] for part in parts)
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {
+        'concurrency': concurrency,
+        'established': established,
+        'failed': sum(part['failed'] for part in parts),
+        'connections_per_sec': round(established / setup_time, 1),
+        'setup_p50_ms': ms(percentile(setup, 50)),
+        'setup_p99_ms': ms(percentile(setup, 99)),
+        'pings_per_sec': round(sum(part['pings'] for part in parts) / duration, 1),
+        'ping_p50_ms': ms(percentile(rtts, 50)),
+        'ping_p99_ms': ms(percentile(rtts, 99)),
+        'ping_errors': sum(part['ping_errors'] for part in parts),
+        'throughput_mb_s': round(sum(part['bulk_bytes'] for part in parts) /
+                                 bulk_time / 1e6, 2),
+        'proxy_rss_kb': rss_loaded,
+    }
+
+
+def start_proxy(target, port, extra_args):
+    if target == 'go':
+        # go/main.go always listens on :1082
+        cmd = [extra_args[0]]
+    elif target == 'asyncio':
+        cmd = [sys.executable, os.path.join(HERE, 'tcp_event.py'), '-p',
+               str(port), '--engine', 'asyncio'] + extra_args
+    else:
+        cmd = [sys.executable, os.path.join(HERE, 'tcp_event.py'), '-p',
+               str(port), '--event-model', target] + extra_args
+    process = subprocess.Popen(cmd, cwd=HERE, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL,
+                               preexec_fn=raise_nofile)
+    wait_port(port)
+    if process.poll() is not None:
+        raise Exception('%s exited, is port %d already taken?' % (target, port))
+    return process
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='proxy load test')
+    parser.add_argument('--levels', default='10,1000,10000',
+                        help='comma separated concurrent tunnel counts')
+    parser.add_argument('--models', default=','.join(
+        [m for m in EVENT_MODELS if hasattr(__import__('select'), m)] + ['asyncio']),
+        help='event loop backends to run tcp_event.py with, asyncio for the '
+             'asyncio engine')
+    parser.add_argument('--duration', type=float, default=5,
+                        help='seconds for each ping and bulk phase')
+    parser.add_argument('--generators', type=int,
+                        default=max(1, (os.cpu_count() or 2) // 2),
+                        help='load generator processes')
+    parser.add_argument('--port', type=int, default=1082)
+    parser.add_argument('--proxy-args', default='',
+                        help='extra arguments for tcp_event.py, e.g. "--splice"')
+    parser.add_argument('--go-binary',
+                        help='also benchmark the go build of go/main.go')
+    parser.add_argument('-o', '--output', default='bench.json')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    nofile = raise_nofile()
+    levels = [int(l) for l in args.levels.split(',')]
+    targets = [(m, args.proxy_args.split()) for m in args.models.split(',')]
+    if args.go_binary:
+        targets.append(('go', [os.path.abspath(args.go_binary)]))
+    origin, origin_port = start_origin()
+    report = {'revision': git_revision(), 'time': time.time(),
+              'python': platform.python_version(),
+              'platform': platform.platform(), 'nofile': nofile,
+              'duration': args.duration, 'results': []}
+    try:
+        for target, extra_args in targets:
+            port = 1082 if target == 'go' else args.port
+            for level in levels:
+                # each tunnel costs the proxy two fds and the generators one
+                if level * 3 + 64 > nofile or (target == 'select' and level > 300):
+                    logging.info('%s %d: skipped, over the fd limit', target, level)
+                    continue
+                proxy = start_proxy(target, port, extra_args)
+                try:
+                    result = run_level(proxy.pid, port, origin_port, level,
+                                       args.duration, args.generators)
+                finally:
+                    proxy.terminate()
+                    proxy.wait()
+                result['target'] = target
+                logging.info(json.dumps(result, sort_keys=True))
+                report['results'].append(result)
+    finally:
+        origin.terminate()
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    logging.info('results written to %s', args.output)
+
+
+if __name__ == '__main__':
+    main()
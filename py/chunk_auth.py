@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Authenticated chunks for the mux connection between two instances.
+
+Both ends share a key (--mux-key) and start by sending NONCE_SIZE random
+bytes. Every byte after that travels in chunks laid out like the
+shadowsocks one time auth chunks:
+
+    DATA.LEN (2 bytes) | HMAC-SHA1 (10 bytes) | DATA
+
+The HMAC covers an 8 byte chunk counter and DATA. It is keyed per
+direction from the shared key and both nonces, so a chunk can't be
+replayed, reordered or moved to another connection. Only integrity is
+protected, the data itself travels in the clear.
+"""
+import hashlib
+import hmac
+import os
+import struct
+
+from common import ONETIMEAUTH_BYTES, ONETIMEAUTH_CHUNK_BYTES, \
+    ONETIMEAUTH_CHUNK_DATA_LEN, sha1_hmac
+
+NONCE_SIZE = 16
+# as much as DATA.LEN can say, fewer chunks means fewer HMACs
+MAX_CHUNK_DATA = (1 << (8 * ONETIMEAUTH_CHUNK_DATA_LEN)) - 1
+
+_LEN = struct.Struct('>H')
+_COUNTER = struct.Struct('>Q')
+_BLANK_HEADER = bytes(ONETIMEAUTH_CHUNK_BYTES)
+
+
+class ChunkAuth(object):
+    """One connection's chunking and verification, both directions.
+
+    Send nonce first, then seal() everything going out; open() takes
+    everything coming in. Nothing can be sealed before ready, that is
+    before the peer's nonce went through open().
+    """
+
+    def __init__(self, key, is_client):
+        # type: (bytes,bool) -> None
+        self.nonce = os.urandom(NONCE_SIZE)
+        self.ready = False
+        self._key = key
+        self._is_client = is_client
+        # keyed once, every chunk works on a copy()
+        self._send_mac = None
+        self._recv_mac = None
+        self._send_count = 0
+        self._recv_count = 0
+        self._in = bytearray()
+
+    def _derive_keys(self, peer_nonce):
+        if self._is_client:
+            nonces = self.nonce + peer_nonce
+        else:
+            nonces = peer_nonce + self.nonce
+        up = hmac.new(sha1_hmac(self._key, b'up' + nonces), digestmod=hashlib.sha1)
+        down = hmac.new(sha1_hmac(self._key, b'down' + nonces), digestmod=hashlib.sha1)
+        self._send_mac, self._recv_mac = (up, down) if self._is_client else (down, up)
+        self.ready = True
+
+    def seal(self, pieces):
+        """Chunk and sign the concatenation of pieces, returns a bytearray."""
+        out = bytearray()
+        mac = None
+        pos = size = 0
+        for piece in pieces:
+            view = memoryview(piece)
+            while view:
+                if mac is None:
+                    pos = len(out)
+                    out += _BLANK_HEADER
+                    size = 0
+                    mac = self._send_mac.copy()
+                    mac.update(_COUNTER.pack(self._send_count))
+                    self._send_count += 1
+                part = view[:MAX_CHUNK_DATA - size]
+                view = view[len(part):]
+                mac.update(part)
+                out += part
+                size += len(part)
+                if size == MAX_CHUNK_DATA:
+                    self._finish_chunk(out, pos, size, mac)
+                    mac = None
+        if mac is not None:
+            self._finish_chunk(out, pos, size, mac)
+        return out
+
+    @staticmethod
+    def _finish_chunk(out, pos, size, mac):
+        _LEN.pack_into(out, pos, size)
+        out[pos + ONETIMEAUTH_CHUNK_DATA_LEN:pos + ONETIMEAUTH_CHUNK_BYTES] = \
+            mac.digest()[:ONETIMEAUTH_BYTES]
+
+    def open(self, data):
+        """Verified data of the chunks that data completes, as a bytearray.
+
+        Raises ValueError for a chunk that fails verification.
+        """
+        buf = self._in
+        buf += data
+        if not self.ready:
+            if len(buf) < NONCE_SIZE:
+                return bytearray()
+            self._derive_keys(bytes(buf[:NONCE_SIZE]))
+            del buf[:NONCE_SIZE]
+        out, pos = self._open_chunks(buf)
+        # the views on buf are gone with _open_chunks' frame
+        del buf[:pos]
+        return out
+
+    def _open_chunks(self, buf):
+        out = bytearray()
+        view = memoryview(buf)
+        pos, end = 0, len(buf)
+        while end - pos >= ONETIMEAUTH_CHUNK_BYTES:
+            size = _LEN.unpack_from(buf, pos)[0]
+            start = pos + ONETIMEAUTH_CHUNK_BYTES
+            if end - start < size:
+                break
+            chunk = view[start:start + size]
+            mac = self._recv_mac.copy()
+            mac.update(_COUNTER.pack(self._recv_count))
+            mac.update(chunk)
+            if not hmac.compare_digest(mac.digest()[:ONETIMEAUTH_BYTES],
+                                       view[pos + ONETIMEAUTH_CHUNK_DATA_LEN:start]):
+                raise ValueError('chunk %d failed verification' % self._recv_count)
+            self._recv_count += 1
+            out += chunk
+            pos = start + size
+        return out, pos
+
+
+def _pair(client_key=b'key', server_key=b'key'):
+    client, server = ChunkAuth(client_key, True), ChunkAuth(server_key, False)
+    assert server.open(client.nonce) == b''
+    assert client.open(server.nonce) == b''
+    return client, server
+
+
+def _refused(auth, data):
+    try:
+        auth.open(data)
+    except ValueError:
+        return True
+    return False
+
+
+def test_chunk_auth():
+    client, server = _pair()
+    assert client.ready and server.ready
+    data = os.urandom(3 * MAX_CHUNK_DATA + 100)
+    sealed = client.seal([data[:10], data[10:70000], data[70000:]])
+    assert len(sealed) == len(data) + 4 * ONETIMEAUTH_CHUNK_BYTES
+    # arbitrary splits come out whole, chunk by chunk
+    opened = server.open(sealed[:5]) + server.open(sealed[5:70000]) + server.open(sealed[70000:])
+    assert opened == data
+    assert client.open(server.seal([b'pong'])) == b'pong'
+
+    client, server = _pair()
+    sealed = client.seal([b'hello'])
+    sealed[-1] ^= 1
+    assert _refused(server, sealed)
+    # replayed chunk
+    client, server = _pair()
+    sealed = bytes(client.seal([b'hello']))
+    assert server.open(sealed) == b'hello'
+    assert _refused(server, sealed)
+    # a chunk from another connection
+    other_client, other_server = _pair()
+    client, server = _pair()
+    assert _refused(server, other_client.seal([b'hello']))
+    client, server = _pair(server_key=b'other key')
+    assert _refused(server, client.seal([b'hello']))
+
+
+if __name__ == '__main__':
+    test_chunk_auth()
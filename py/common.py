@@ -18,6 +18,8 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
+import bisect
+import errno
 import socket
 import struct
 import logging
@@ -93,7 +95,7 @@ def inet_pton(family, addr):
         if '.' in addr:  # a v4 addr
             v4addr = addr[addr.rindex(':') + 1:]
             v4addr = socket.inet_aton(v4addr)
-            v4addr = map(lambda x: ('%02X' % ord(x)), v4addr)
+            v4addr = ['%02X' % ord(x) for x in v4addr]
             v4addr.insert(2, ':')
             newaddr = addr[:addr.rindex(':') + 1] + ''.join(v4addr)
             return inet_pton(family, newaddr)
@@ -115,11 +117,13 @@ def inet_pton(family, addr):
 
 
 def is_ip(address):
+    # the strict parser, the shim above takes shorthands like '1' and
+    # raises more than these on some malformed input
     for family in (socket.AF_INET, socket.AF_INET6):
         try:
             if type(address) != str:
                 address = address.decode('utf8')
-            inet_pton(family, address)
+            socket.inet_pton(family, address)
             return family
         except (TypeError, ValueError, OSError, IOError):
             pass
@@ -143,6 +147,30 @@ ADDRTYPE_HOST = 0x03
 ADDRTYPE_AUTH = 0x10
 ADDRTYPE_MASK = 0xF
 
+# socks5 reply codes, rfc1928 section 6
+REP_SUCCEEDED = 0x00
+REP_GENERAL_FAILURE = 0x01
+REP_NOT_ALLOWED = 0x02
+REP_NETWORK_UNREACHABLE = 0x03
+REP_HOST_UNREACHABLE = 0x04
+REP_CONNECTION_REFUSED = 0x05
+REP_TTL_EXPIRED = 0x06
+REP_COMMAND_NOT_SUPPORTED = 0x07
+REP_ADDRTYPE_NOT_SUPPORTED = 0x08
+
+SOCKS_VERSION = 0x05
+METHOD_NO_AUTH = 0x00
+CMD_CONNECT = 0x01
+CMD_UDP_ASSOCIATE = 0x03
+
+# reply for a connect that failed with errno, REP_GENERAL_FAILURE otherwise
+CONNECT_ERRNO_REPLIES = {
+    errno.ECONNREFUSED: REP_CONNECTION_REFUSED,
+    errno.ENETUNREACH: REP_NETWORK_UNREACHABLE,
+    errno.EHOSTUNREACH: REP_HOST_UNREACHABLE,
+    errno.ETIMEDOUT: REP_HOST_UNREACHABLE,
+}
+
 
 def pack_addr(address):
     address_str = to_str(address)
@@ -168,6 +196,10 @@ def add_header(address, port, data=b''):
     return _data
 
 
+def socks5_reply(rep, bind_addr=b'0.0.0.0', bind_port=0):
+    return b'\x05' + chr(rep) + b'\x00' + add_header(bind_addr, bind_port)
+
+
 def parse_header(data):
     addrtype = ord(data[0])
     dest_addr = None
@@ -184,7 +216,7 @@ def parse_header(data):
         if len(data) > 2:
             addrlen = ord(data[1])
             if len(data) >= 4 + addrlen:
-                dest_addr = data[2:2 + addrlen]
+                dest_addr = bytes(data[2:2 + addrlen])
                 dest_port = struct.unpack('>H', data[2 + addrlen:4 +
                                                      addrlen])[0]
                 header_length = 4 + addrlen
@@ -207,32 +239,159 @@ def parse_header(data):
     return addrtype, to_bytes(dest_addr), dest_port, header_length
 
 
+def socks5_request_length(data, offset=0):
+    """Length of the socks5 request at data[offset:], None while too short
+    to tell, -1 for an unknown address type."""
+    if len(data) < offset + 5:
+        return None
+    addrtype = data[offset + 3]
+    if addrtype == ADDRTYPE_IPV4:
+        length = 10
+    elif addrtype == ADDRTYPE_IPV6:
+        length = 22
+    elif addrtype == ADDRTYPE_HOST:
+        length = 7 + data[offset + 4]
+    else:
+        return -1
+    if len(data) < offset + length:
+        return None
+    return length
+
+
+# python 3 fast path for the socks5 address codec: the headers are read
+# straight out of the receive buffer with precompiled structs, nothing is
+# sliced or concatenated on the way
+_V4_ADDR = struct.Struct('>B4sH')
+_V4_OCTETS = struct.Struct('>B4BH')
+_V6_ADDR = struct.Struct('>B16sH')
+_HOST_LEN = struct.Struct('>BB')
+_PORT = struct.Struct('>H')
+# udp datagram: RSV RSV FRAG, then the address
+_UDP_V4_HEADER = struct.Struct('>3xB4sH')
+_UDP_V6_HEADER = struct.Struct('>3xB16sH')
+_UDP_V4_OCTETS = struct.Struct('>3xB4BH')
+UDP_HEADER_PREFIX = 3
+
+
+def parse_header_from(buf, offset=0):
+    """parse_header() for the header at buf[offset:], any bytes-like buf.
+
+    Returns the same (addrtype, dest_addr, dest_port, header_length) or
+    None if the header is short or the address type unknown.
+    """
+    left = len(buf) - offset
+    if left < 1:
+        return None
+    addrtype = buf[offset]
+    kind = addrtype & ADDRTYPE_MASK
+    if kind == ADDRTYPE_IPV4:
+        if left < 7:
+            return None
+        # formatting the octets beats inet_ntoa() plus an encode()
+        _, a, b, c, d, port = _V4_OCTETS.unpack_from(buf, offset)
+        return addrtype, b'%d.%d.%d.%d' % (a, b, c, d), port, 7
+    elif kind == ADDRTYPE_HOST:
+        if left < 2:
+            return None
+        _, addrlen = _HOST_LEN.unpack_from(buf, offset)
+        if left < 4 + addrlen:
+            return None
+        port, = _PORT.unpack_from(buf, offset + 2 + addrlen)
+        return addrtype, bytes(buf[offset + 2:offset + 2 + addrlen]), port, \
+            4 + addrlen
+    elif kind == ADDRTYPE_IPV6:
+        if left < 19:
+            return None
+        _, packed, port = _V6_ADDR.unpack_from(buf, offset)
+        return addrtype, socket.inet_ntop(socket.AF_INET6, packed).encode(), \
+            port, 19
+    return None
+
+
+def parse_udp_headers(datagrams):
+    """Bulk parse socks5 udp datagrams.
+
+    Returns one (addrtype, dest_addr, dest_port, payload) per datagram,
+    payload being a memoryview into it, or None for a fragmented, short
+    or malformed one.
+    """
+    results = []
+    append = results.append
+    unpack_v4 = _UDP_V4_OCTETS.unpack_from
+    for data in datagrams:
+        if len(data) < 4 or data[2]:
+            append(None)
+            continue
+        if data[3] == ADDRTYPE_IPV4 and len(data) >= 10:
+            # the common case inlined, skipping a call per datagram
+            _, a, b, c, d, port = unpack_v4(data)
+            append((ADDRTYPE_IPV4, b'%d.%d.%d.%d' % (a, b, c, d), port,
+                    memoryview(data)[10:]))
+            continue
+        header = parse_header_from(data, UDP_HEADER_PREFIX)
+        if header is None:
+            append(None)
+            continue
+        addrtype, dest_addr, dest_port, header_length = header
+        append((addrtype, dest_addr, dest_port,
+                memoryview(data)[UDP_HEADER_PREFIX + header_length:]))
+    return results
+
+
+def pack_ip_header(ip, port):
+    """add_header() for a textual ip address, without trying both families."""
+    if ':' in ip:
+        return _V6_ADDR.pack(ADDRTYPE_IPV6,
+                             socket.inet_pton(socket.AF_INET6, ip), port)
+    return _V4_ADDR.pack(ADDRTYPE_IPV4, socket.inet_aton(ip), port)
+
+
+def pack_udp_header(ip, port):
+    """The RSV RSV FRAG + address header put in front of a relayed reply."""
+    if ':' in ip:
+        return _UDP_V6_HEADER.pack(ADDRTYPE_IPV6,
+                                   socket.inet_pton(socket.AF_INET6, ip), port)
+    return _UDP_V4_HEADER.pack(ADDRTYPE_IPV4, socket.inet_aton(ip), port)
+
+
+# ::ffff:0:0/96, the v4 address is the last 4 bytes
+_V4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'
+
+
 class IPNetwork(object):
+    """Set of CIDR networks, matched by bisecting merged intervals.
+
+    The networks are kept as sorted, non-overlapping (first, last) integer
+    ranges per family, rebuilt on the first lookup after add_network, so
+    a lookup is O(log n) however many prefixes are loaded.
+    """
     ADDRLENGTH = {socket.AF_INET: 32, socket.AF_INET6: 128, False: 0}
 
     def __init__(self, addrs):
         self._network_list_v4 = []
         self._network_list_v6 = []
+        self._index = None  # family -> (firsts, lasts)
         if type(addrs) == str:
             addrs = addrs.split(',')
         list(map(self.add_network, addrs))
 
     def add_network(self, addr):
-        if addr is "":
+        addr = addr.strip()
+        if addr == "":
             return
         block = addr.split('/')
-        addr_family = is_ip(block[0])
-        addr_len = IPNetwork.ADDRLENGTH[addr_family]
-        if addr_family is socket.AF_INET:
-            ip, = struct.unpack("!I", socket.inet_aton(block[0]))
-        elif addr_family is socket.AF_INET6:
-            hi, lo = struct.unpack("!QQ", inet_pton(addr_family, block[0]))
-            ip = (hi << 64) | lo
+        if ':' in block[0]:
+            addr_family = socket.AF_INET6
         else:
+            addr_family = socket.AF_INET
+        try:
+            ip = int_from_packed(socket.inet_pton(addr_family, block[0]))
+        except (ValueError, OSError, IOError):
             raise Exception("Not a valid CIDR notation: %s" % addr)
-        if len(block) is 1:
+        addr_len = IPNetwork.ADDRLENGTH[addr_family]
+        if len(block) == 1:
             prefix_size = 0
-            while (ip & 1) == 0 and ip is not 0:
+            while (ip & 1) == 0 and ip != 0:
                 ip >>= 1
                 prefix_size += 1
             logging.warn("You did't specify CIDR routing prefix size for %s, "
@@ -242,24 +401,71 @@ class IPNetwork(object):
             ip >>= prefix_size
         else:
             raise Exception("Not a valid CIDR notation: %s" % addr)
-        if addr_family is socket.AF_INET:
+        if addr_family == socket.AF_INET:
             self._network_list_v4.append((ip, prefix_size))
         else:
             self._network_list_v6.append((ip, prefix_size))
+        self._index = None
+
+    @staticmethod
+    def _build_ranges(network_list):
+        firsts, lasts = [], []
+        for first, last in sorted((ip << ps, ((ip + 1) << ps) - 1)
+                                  for ip, ps in network_list):
+            if lasts and first <= lasts[-1] + 1:
+                # overlapping or adjacent, extend the previous range
+                lasts[-1] = max(lasts[-1], last)
+            else:
+                firsts.append(first)
+                lasts.append(last)
+        return firsts, lasts
+
+    def _build_index(self):
+        self._index = {
+            4: self._build_ranges(self._network_list_v4),
+            16: self._build_ranges(self._network_list_v6),
+        }
+        return self._index
+
+    def contains_packed(self, packed):
+        """Look up a 4 or 16 byte address as found in a socks5 header.
+
+        A v4 mapped address (::ffff:0:0/96) is what a v6 socket connects
+        to for its v4 part, so the v4 networks apply to it as well.
+        """
+        if len(packed) == 16 and packed[:12] == _V4_MAPPED_PREFIX and \
+                self._lookup(packed[12:]):
+            return True
+        return self._lookup(packed)
+
+    def _lookup(self, packed):
+        index = self._index or self._build_index()
+        ranges = index.get(len(packed))
+        if ranges is None:
+            return False
+        firsts, lasts = ranges
+        ip = int_from_packed(packed)
+        i = bisect.bisect_right(firsts, ip) - 1
+        return i >= 0 and ip <= lasts[i]
 
     def __contains__(self, addr):
-        addr_family = is_ip(addr)
-        if addr_family is socket.AF_INET:
-            ip, = struct.unpack("!I", socket.inet_aton(addr))
-            return any(map(lambda n_ps: n_ps[0] == ip >> n_ps[1],
-                           self._network_list_v4))
-        elif addr_family is socket.AF_INET6:
-            hi, lo = struct.unpack("!QQ", inet_pton(addr_family, addr))
-            ip = (hi << 64) | lo
-            return any(map(lambda n_ps: n_ps[0] == ip >> n_ps[1],
-                           self._network_list_v6))
-        else:
-            return False
+        addr = to_str(addr)
+        family = socket.AF_INET6 if ':' in addr else socket.AF_INET
+        try:
+            packed = socket.inet_pton(family, addr)
+        except (TypeError, ValueError, OSError, IOError):
+            if family != socket.AF_INET6:
+                return False
+            # the lenient parser above also takes forms like ':ff:ffff'
+            try:
+                packed = inet_pton(family, addr)
+            except (TypeError, ValueError, OSError, IOError):
+                return False
+        return self.contains_packed(packed)
+
+
+def int_from_packed(packed):
+    return int.from_bytes(packed, 'big')
 
 
 def test_inet_conv():
@@ -269,6 +475,10 @@ def test_inet_conv():
     ipv6 = b'2404:6800:4005:805::1011'
     b = inet_pton(socket.AF_INET6, ipv6)
     assert inet_ntop(socket.AF_INET6, b) == ipv6
+    assert inet_pton(socket.AF_INET6, '::ffff:127.0.0.1') == \
+        socket.inet_pton(socket.AF_INET6, '::ffff:127.0.0.1')
+    assert is_ip(b'::ffff:127.0.0.1') == socket.AF_INET6
+    assert not is_ip(b'1') and not is_ip(b'example.com')
 
 
 def test_parse_header():
@@ -288,6 +498,13 @@ def test_pack_header():
     assert pack_addr(b'www.google.com') == b'\x03\x0ewww.google.com'
 
 
+def test_socks5_reply():
+    assert socks5_reply(REP_SUCCEEDED, '10.0.0.1', 4097) == \
+        b'\x05\x00\x00\x01\x0a\x00\x00\x01\x10\x01'
+    assert socks5_reply(REP_CONNECTION_REFUSED) == \
+        b'\x05\x05\x00\x01\x00\x00\x00\x00\x00\x00'
+
+
 def test_ip_network():
     ip_network = IPNetwork('127.0.0.0/24,::ff:1/112,::1,192.168.1.1,192.0.2.0')
     assert '127.0.0.1' in ip_network
@@ -301,10 +518,60 @@ def test_ip_network():
     assert '192.0.2.1' in ip_network
     assert '192.0.3.1' in ip_network  # 192.0.2.0 is treated as 192.0.2.0/23
     assert 'www.google.com' not in ip_network
+    assert b'127.0.0.255' in ip_network
+    assert ip_network.contains_packed(b'\x7f\x00\x00\x05')
+    assert not ip_network.contains_packed(b'\x7f\x00\x01\x05')
+    assert ip_network.contains_packed(b'\x00' * 15 + b'\x01')
+    # v4 mapped v6 addresses are held against the v4 networks
+    assert '::ffff:127.0.0.1' in ip_network
+    assert '::ffff:7f00:2' in ip_network
+    assert '::ffff:127.0.1.1' not in ip_network
+    assert ip_network.contains_packed(_V4_MAPPED_PREFIX + b'\xc0\xa8\x01\x01')
+    assert not IPNetwork('::ffff:0:0/96').contains_packed(b'\x7f\x00\x00\x01')
+    assert '::ffff:10.0.0.1' in IPNetwork('::ffff:0:0/96')
+    # overlapping and adjacent prefixes merge into one range
+    ip_network = IPNetwork(['10.0.0.0/9', '10.128.0.0/9', '10.1.0.0/16'])
+    assert ip_network._build_index()[4] == ([0x0a000000], [0x0affffff])
+    assert '10.255.255.255' in ip_network
+    assert '11.0.0.0' not in ip_network
+    assert '9.255.255.255' not in ip_network
+    ip_network.add_network('11.0.0.0/8')
+    assert '11.0.0.0' in ip_network
+
+
+def test_parse_header_from():
+    for header in (b'\x03\x0ewww.google.com\x00\x50',
+                   b'\x01\x08\x08\x08\x08\x00\x35',
+                   (b'\x04$\x04h\x00@\x05\x08\x05\x00\x00\x00\x00\x00'
+                    b'\x00\x10\x11\x00\x50')):
+        assert parse_header_from(b'xx' + header + b'data', 2) == \
+            parse_header(header)
+        assert parse_header_from(memoryview(header)) == parse_header(header)
+        assert parse_header_from(header[:-1]) is None
+    assert parse_header_from(b'\x05abc') is None
+    assert parse_header_from(b'') is None
+
+
+def test_udp_headers():
+    v4 = pack_udp_header('8.8.8.8', 53) + b'query'
+    v6 = b'\x00\x00\x00' + pack_ip_header('2404:6800:4005:805::1011', 80) + b'x'
+    assert pack_ip_header('8.8.8.8', 53) == add_header(b'8.8.8.8', 53)
+    assert pack_udp_header('2404:6800:4005:805::1011', 80) == \
+        b'\x00\x00\x00' + add_header(b'2404:6800:4005:805::1011', 80)
+    frag = b'\x00\x00\x01' + v4[3:]
+    results = parse_udp_headers([v4, frag, b'\x00\x00', v6])
+    assert results[0][:3] == (1, b'8.8.8.8', 53)
+    assert results[0][3] == b'query'
+    assert results[1] is None and results[2] is None
+    assert results[3][1:3] == (b'2404:6800:4005:805::1011', 80)
+    assert bytes(results[3][3]) == b'x'
 
 
 if __name__ == '__main__':
     test_inet_conv()
     test_parse_header()
+    test_parse_header_from()
+    test_udp_headers()
     test_pack_header()
+    test_socks5_reply()
     test_ip_network()
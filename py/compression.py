@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Deflate for mux streams, one compressor per stream and direction.
+
+A stream's data is compressed in batches of up to COMPRESS_BATCH bytes,
+each sync flushed so the receiver can pass it on without waiting for
+more. Frames of compressed data carry FLAG_DEFLATE and form one raw
+deflate stream per direction; frames without the flag are plain.
+
+Already compressed traffic (tls, media, archives) doesn't shrink and
+would only cost cpu, so every batch that comes out above SKIP_RATIO of
+its input turns compression off for the next SKIP_BYTES, after which
+one batch is tried again.
+"""
+import os
+import zlib
+
+FLAG_DEFLATE = 0x01
+
+COMPRESS_LEVEL = 6
+COMPRESS_BATCH = 64 * 1024
+# a 8k window and a small hash table keep a compressor near 64k and an
+# inflater near 16k, which adds up with thousands of open streams
+WBITS = 13
+MEM_LEVEL = 6
+SKIP_RATIO = 0.9
+SKIP_BYTES = 1024 * 1024
+
+
+class AdaptiveDeflate(object):
+
+    def __init__(self):
+        self._compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -WBITS, MEM_LEVEL)
+        self._skip = 0
+
+    def compress(self, data):
+        """(payload, flags) for one batch of stream data."""
+        if self._skip > 0:
+            # data sent plain never enters the compressor, so both ends'
+            # deflate history stays the same
+            self._skip -= len(data)
+            return data, 0
+        compressor = self._compressor
+        out = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if len(out) > len(data) * SKIP_RATIO:
+            self._skip = SKIP_BYTES
+        return out, FLAG_DEFLATE
+
+
+def new_inflater():
+    return zlib.decompressobj(-WBITS)
+
+
+def test_adaptive_deflate():
+    deflate, inflater = AdaptiveDeflate(), new_inflater()
+    text = b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n' * 1000
+    payload, flags = deflate.compress(text)
+    assert flags == FLAG_DEFLATE and len(payload) < len(text) // 10
+    assert inflater.decompress(payload) == text
+    # random data is sent compressed once, then plain for SKIP_BYTES
+    noise = os.urandom(COMPRESS_BATCH)
+    payload, flags = deflate.compress(noise)
+    assert flags == FLAG_DEFLATE and inflater.decompress(payload) == noise
+    for _ in range(SKIP_BYTES // COMPRESS_BATCH):
+        assert deflate.compress(noise) == (noise, 0)
+    # and the history both ends share is still in step afterwards
+    payload, flags = deflate.compress(text)
+    assert flags == FLAG_DEFLATE and inflater.decompress(payload) == text
+
+
+if __name__ == '__main__':
+    test_adaptive_deflate()
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
+import heapq
 import logging
 import select
+import time
 from collections import defaultdict
 
 POLL_NULL = 0x00
@@ -19,10 +21,40 @@ EVENT_NAMES = {
     POLL_NVAL: 'POLL_NVAL',
 }
 
+# backends in order of preference
+EVENT_MODELS = ('epoll', 'kqueue', 'select')
+
 # we check timeouts every TIMEOUT_PRECISION seconds
 TIMEOUT_PRECISION = 10
 
 
+class _EpollLoop(object):
+    MAX_EVENTS = 1024
+
+    def __init__(self):
+        # POLL_* constants share their values with EPOLL*, so modes and
+        # results pass through untouched. Level-triggered: handlers read
+        # at most a buffer (or their read budget) per event
+        self._epoll = select.epoll()
+
+    def poll(self, timeout):
+        if timeout is None or timeout < 0:
+            timeout = -1  # epoll behaviour
+        return self._epoll.poll(timeout, _EpollLoop.MAX_EVENTS)
+
+    def register(self, fd, mode):
+        self._epoll.register(fd, mode)
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def modify(self, fd, mode):
+        self._epoll.modify(fd, mode)
+
+    def close(self):
+        self._epoll.close()
+
+
 class _KqueueLoop(object):
     MAX_EVENTS = 1024
 
@@ -76,9 +108,6 @@ class _SelectLoop(object):
 
     def poll(self, timeout=TIMEOUT_PRECISION):
         r, w, e = select.select(self.r_inputs, self.w_inputs, self.e_inputs, timeout)
-        logging.info("r_inputs:%s, w_inputs:%s, e_inputs:%s, timeout:%s", self.r_inputs, self.w_inputs, self.e_inputs,
-                     timeout)
-        logging.info("res r:%s,w:%s,e:%s", r, w, e)
         result = defaultdict(lambda: POLL_NULL)
         for p in [(r, POLL_IN), (w, POLL_OUT), (e, POLL_ERR)]:
             for fd in p[0]:
@@ -105,53 +134,165 @@ class _SelectLoop(object):
         self.unregister(fd)
         self.register(fd, mode)
 
+    def close(self):
+        pass
+
+
+class Timer(object):
+    __slots__ = ('deadline', 'callback', 'args')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        self.callback = None
+        self.args = None
+
+    @property
+    def cancelled(self):
+        return self.callback is None
+
 
 class EventLoop(object):
-    def __init__(self):
-        if hasattr(select, 'kqueue'):
+    def __init__(self, model=None):
+        # model forces one of the backends in EVENT_MODELS instead of the
+        # best available
+        for name in EVENT_MODELS if model is None else [model]:
+            if hasattr(select, name):
+                break
+        else:
+            raise Exception('no usable event model: %s' % model)
+        if name == 'epoll':
+            self._impl = _EpollLoop()
+        elif name == 'kqueue':
             self._impl = _KqueueLoop()
-            model = 'kqueue'
-        elif hasattr(select, 'select'):
-            self._impl = _SelectLoop()
-            model = 'select'
         else:
-            raise Exception('error')
-        self._fdmap = {}  # (f, handler)
-        logging.debug('using event model: %s', model)
+            self._impl = _SelectLoop()
+        self.model = name
+        # two flat maps rather than one of (f, handler) tuples, a tuple
+        # per registered fd adds up with many idle tunnels
+        self._files = {}  # fd -> f
+        self._handlers = {}  # fd -> handler
+        self._timers = []  # heap of (deadline, seq, timer)
+        self._timer_seq = 0
+        self._stopping = False
+        # counts polls, lets handlers budget work per loop iteration
+        self.iteration = 0
+        self.profiler = None  # type: LoopProfiler
+        logging.debug('using event model: %s', self.model)
 
     def poll(self, timeout=TIMEOUT_PRECISION):
         events = self._impl.poll(timeout)
-        # logging.info("event:%s", events)
-        return [(self._fdmap[fd][0], fd, event) for fd, event in events]
+        files = self._files
+        return [(files[fd], fd, event) for fd, event in events]
 
     def add(self, f, mode, handler):
         fd = f.fileno()
-        logging.info("add event fd:%d", fd)
-        self._fdmap[fd] = (f, handler)
+        self._files[fd] = f
+        self._handlers[fd] = handler
         self._impl.register(fd, mode)
 
     def remove(self, f):
         fd = f.fileno()
-        del self._fdmap[fd]
-        logging.info("remove event fd:%d", fd)
+        del self._files[fd]
+        del self._handlers[fd]
         self._impl.unregister(fd)
 
     def modify(self, f, mode):
         fd = f.fileno()
-        logging.info("modify event fd:%d", fd)
         self._impl.modify(fd, mode)
 
+    def time(self):
+        return time.monotonic()
+
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) after delay seconds, returns a cancellable Timer.
+
+        Cancelled timers stay in the heap and are dropped when they surface,
+        so cancel and re-arm are both cheap.
+        """
+        timer = Timer(self.time() + delay, callback, args)
+        self._timer_seq += 1
+        heapq.heappush(self._timers, (timer.deadline, self._timer_seq, timer))
+        return timer
+
+    def _next_timeout(self):
+        timers = self._timers
+        while timers and timers[0][2].cancelled:
+            heapq.heappop(timers)
+        if not timers:
+            return TIMEOUT_PRECISION
+        return max(0, min(timers[0][0] - self.time(), TIMEOUT_PRECISION))
+
+    def _run_timers(self):
+        timers = self._timers
+        now = self.time()
+        slow = self.profiler.slow_threshold if self.profiler else 0
+        while timers and timers[0][0] <= now:
+            timer = heapq.heappop(timers)[2]
+            if timer.cancelled:
+                continue
+            callback, args = timer.callback, timer.args
+            timer.cancel()
+            try:
+                if slow:
+                    start = time.perf_counter()
+                    callback(*args)
+                    elapsed = time.perf_counter() - start
+                    if elapsed >= slow:
+                        self.profiler.slow_callback('timer %s' % getattr(
+                            callback, '__qualname__', callback), elapsed)
+                else:
+                    callback(*args)
+            except Exception as e:
+                logging.exception(e)
+
+    def close(self):
+        self._impl.close()
+
+    def stop(self):
+        # run() returns after the current iteration
+        self._stopping = True
+
     def run(self):
-        while True:
+        self._stopping = False
+        while not self._stopping:
+            self.iteration += 1
+            profiler = self.profiler
+            # every callback is timed against the slow threshold, the
+            # histograms are only filled in sampled iterations
+            slow = profiler.slow_threshold if profiler else 0
+            if profiler and self.iteration % profiler.sample_every:
+                profiler = None
             try:
-                events = self.poll()
+                events = self.poll(self._next_timeout())
             except (OSError, IOError) as e:
                 logging.exception(e)
                 continue
 
+            if profiler:
+                profiler.polled(len(events))
             for sock, fd, event in events:
-                h = self._fdmap[fd][1]
+                # an earlier handler in this batch may have removed the fd
+                handler = self._handlers.get(fd)
+                if handler is None:
+                    continue
                 try:
-                    h.handle_event(sock, fd, event)
+                    if profiler:
+                        profiler.call(handler, sock, fd, event)
+                    elif slow:
+                        start = time.perf_counter()
+                        handler.handle_event(sock, fd, event)
+                        elapsed = time.perf_counter() - start
+                        if elapsed >= slow:
+                            self.profiler.slow_callback('%s.handle_event fd:%d' % (
+                                type(handler).__name__, fd), elapsed)
+                    else:
+                        handler.handle_event(sock, fd, event)
                 except Exception as e:
                     logging.exception(e)
+            self._run_timers()
+            if profiler:
+                profiler.done()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import socket
+
+from event_loop import POLL_ERR, POLL_IN
+
+# the successor blocks on the control connection, the serving process
+# reads it from its loop and drops it when the request takes longer
+HANDOFF_TIMEOUT = 5
+MAX_FDS = 16
+REQUEST = b'handoff\n'
+
+
+def receive_sockets(path):
+    """Take over the listening sockets of the process serving path.
+
+    Returns {name: socket}, or None when no process answers on path.
+    """
+    ctl = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    ctl.settimeout(HANDOFF_TIMEOUT)
+    try:
+        ctl.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        ctl.close()
+        return None
+    with ctl:
+        ctl.sendall(REQUEST)
+        msg, fds, flags, addr = socket.recv_fds(ctl, 1024, MAX_FDS)
+        socks = {}
+        for name, fd in zip(msg.decode('ascii').split(','), fds):
+            sock = socket.socket(fileno=fd)
+            sock.setblocking(False)
+            socks[name] = sock
+        # the old process closes the connection once path is free again
+        while ctl.recv(16):
+            pass
+    logging.info("took over %s from %s", ', '.join(sorted(socks)), path)
+    return socks
+
+
+class HandoffServer(object):
+    """Hands this process's listening sockets to its successor.
+
+    get_sockets() returns the {name: socket} to pass over SCM_RIGHTS,
+    on_handoff() is called right after they are sent and should stop
+    accepting and start draining.
+    """
+
+    def __init__(self, path, get_sockets, on_handoff):
+        self._path = path
+        self._get_sockets = get_sockets
+        self._on_handoff = on_handoff
+        self._loop = None
+        if os.path.exists(path):
+            # nobody answered on it (see receive_sockets), a stale file
+            os.unlink(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen(1)
+        self._sock.setblocking(False)
+
+    def add_to_loop(self, loop):
+        self._loop = loop
+        loop.add(self._sock, POLL_IN | POLL_ERR, self)
+
+    def handle_event(self, sock, fd, mode):
+        try:
+            conn, _ = sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        _HandoffRequest(self, conn, self._loop)
+
+    def hand_over(self, conn):
+        """Send the sockets over conn, False when that failed."""
+        try:
+            socks = self._get_sockets()
+            names = sorted(socks)
+            # a fresh unix connection, the one message fits its buffer
+            socket.send_fds(conn, [','.join(names).encode('ascii')],
+                            [socks[name].fileno() for name in names])
+        except (OSError, IOError) as e:
+            logging.error("handoff failed: %s", e)
+            return False
+        logging.info("handed %s over to the next process", ', '.join(names))
+        # free path before the successor binds it
+        self.close()
+        self._on_handoff()
+        return True
+
+    def close(self):
+        if self._sock is None:
+            return
+        if self._loop:
+            self._loop.remove(self._sock)
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+
+
+class _HandoffRequest(object):
+    """One control connection, read from the loop until REQUEST is in."""
+
+    def __init__(self, server, conn, loop):
+        self._server = server
+        self._conn = conn
+        self._loop = loop
+        self._data = b''
+        conn.setblocking(False)
+        loop.add(conn, POLL_IN | POLL_ERR, self)
+        self._timer = loop.call_later(HANDOFF_TIMEOUT, self._on_timeout)
+
+    def handle_event(self, sock, fd, mode):
+        try:
+            data = sock.recv(len(REQUEST) - len(self._data))
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, IOError) as e:
+            logging.warning("handoff request: %s", e)
+            self.close()
+            return
+        self._data += data
+        if not data or not REQUEST.startswith(self._data):
+            self.close()
+        elif self._data == REQUEST:
+            # the successor waits for the close to know path is free
+            self._server.hand_over(sock)
+            self.close()
+
+    def _on_timeout(self):
+        logging.warning("handoff request timed out")
+        self.close()
+
+    def close(self):
+        if self._conn is None:
+            return
+        self._timer.cancel()
+        self._loop.remove(self._conn)
+        self._conn.close()
+        self._conn = None
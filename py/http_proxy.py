@@ -0,0 +1,602 @@
+# -*- coding: utf-8 -*-
+import errno
+import logging
+import socket
+import threading
+
+from event_loop import POLL_ERR, POLL_IN, POLL_OUT, EventLoop
+from send_queue import HIGH_WATERMARK, LOW_WATERMARK, SendQueue
+from utils import create_remote_socket, errno_from_exception, parse_request_line, \
+    parse_request_target
+
+BUF_SIZE = 32 * 1024
+MAX_HEAD_SIZE = 64 * 1024
+MAX_CHUNK_LINE = 4096
+# a connection may sit this long without a byte moving either way
+IDLE_TIMEOUT = 120
+
+STATE_REQUEST_HEAD = 0
+STATE_CONNECTING = 1
+STATE_FORWARDING = 2
+STATE_CLOSING = 3
+STATE_DESTROYED = -1
+
+# never forwarded, they describe the hop and not the message
+HOP_HEADERS = frozenset((b'connection', b'proxy-connection', b'keep-alive',
+                         b'proxy-authorization', b'proxy-authenticate', b'te',
+                         b'trailer', b'upgrade'))
+
+_CHUNK_SIZE = 0
+_CHUNK_DATA = 1
+_CHUNK_DATA_END = 2
+_CHUNK_TRAILER = 3
+
+
+class _BodyFraming(object):
+    """Finds the end of an http/1.1 message body as bytes go through.
+
+    length: fixed Content-Length, chunked: Transfer-Encoding chunked,
+    neither: the body runs until the connection closes.
+    """
+
+    def __init__(self, length=None, chunked=False):
+        self.chunked = chunked
+        self.until_close = length is None and not chunked
+        self.remaining = length or 0
+        self.done = length == 0
+        self._state = _CHUNK_SIZE
+        self._line = bytearray()
+
+    def feed(self, data):
+        """Returns how many bytes of data belong to the body."""
+        if self.done:
+            return 0
+        if self.until_close:
+            return len(data)
+        if not self.chunked:
+            n = min(len(data), self.remaining)
+            self.remaining -= n
+            self.done = not self.remaining
+            return n
+        return self._feed_chunked(bytes(data))
+
+    def _feed_chunked(self, data):
+        pos, end = 0, len(data)
+        while pos < end and not self.done:
+            if self._state == _CHUNK_DATA:
+                n = min(self.remaining, end - pos)
+                pos += n
+                self.remaining -= n
+                if not self.remaining:
+                    self._state = _CHUNK_DATA_END
+                continue
+            i = data.find(b'\n', pos)
+            if i < 0:
+                if self._state != _CHUNK_DATA_END:
+                    self._line += data[pos:]
+                    if len(self._line) > MAX_CHUNK_LINE:
+                        raise ValueError('chunk line too long')
+                return end
+            line = bytes(self._line) + data[pos:i]
+            self._line = bytearray()
+            pos = i + 1
+            if self._state == _CHUNK_DATA_END:
+                self._state = _CHUNK_SIZE
+            elif self._state == _CHUNK_SIZE:
+                self.remaining = int(line.split(b';', 1)[0].strip(), 16)
+                if self.remaining < 0:
+                    raise ValueError('bad chunk size')
+                self._state = _CHUNK_DATA if self.remaining else _CHUNK_TRAILER
+            elif not line.strip():
+                self.done = True
+        return pos
+
+
+def _parse_head(head):
+    """Split a message head into its start line parts and header list."""
+    lines = head.split(b'\r\n')
+    start = lines[0].split(b' ', 2)
+    if len(start) != 3:
+        raise ValueError('bad start line')
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(b':')
+        if not sep or not name or name != name.strip():
+            raise ValueError('bad header line')
+        headers.append((name, value.strip()))
+    return start, headers
+
+
+def _header_tokens(headers, name):
+    tokens = set()
+    for key, value in headers:
+        if key.lower() == name:
+            tokens.update(t.strip().lower() for t in value.split(b','))
+    return tokens
+
+
+def _body_framing(headers):
+    if b'chunked' in _header_tokens(headers, b'transfer-encoding'):
+        return _BodyFraming(chunked=True)
+    for key, value in headers:
+        if key.lower() == b'content-length':
+            if not value.isdigit():
+                raise ValueError('bad content-length')
+            return _BodyFraming(int(value))
+    return None
+
+
+def _host_header(host, port):
+    # from the parsed target, so userinfo in it never goes upstream
+    if b':' in host:
+        host = b'[' + host + b']'
+    return host if port == 80 else host + b':%d' % port
+
+
+def _keep_alive(version, headers):
+    tokens = _header_tokens(headers, b'connection') | \
+        _header_tokens(headers, b'proxy-connection')
+    if version == b'HTTP/1.1':
+        return b'close' not in tokens
+    return b'keep-alive' in tokens
+
+
+def error_response(status):
+    body = ('%s\n' % status).encode('latin-1')
+    return ('HTTP/1.1 %s\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n'
+            'Connection: close\r\n\r\n' % (status, len(body))).encode('latin-1') + body
+
+
+class HTTPProxyEvent(object):
+    """Plain http forward proxy for one client connection.
+
+    Requests are handled one at a time. Upstream connections come from
+    and go back to the server's UpstreamPool, so a client (or a later
+    one) asking the same origin again skips the connect. A connection
+    only goes back once its response has been read to the end.
+    """
+
+    def __init__(self, server, local_sock, data):
+        self._server = server
+        self.loop = loop = server.loop
+        self._pool = server.upstream_pool
+        self._local_sock = local_sock
+        self._client_address = local_sock.getpeername()[:2]
+        self._remote_sock = None  # type: socket.socket
+        self._remote_key = None
+        self._remote_reused = False
+        self._state = STATE_REQUEST_HEAD
+        self._buf = bytearray(data)  # client bytes not yet forwarded
+        self._request_head = None  # rewritten head, kept for a retry
+        self._request_body = None  # type: _BodyFraming
+        self._retryable = False
+        self._method = None
+        self._client_keep_alive = False
+        self._draining = False  # answer what was asked, then close
+        self._response_head = bytearray()
+        self._response_body = None  # type: _BodyFraming
+        self._response_bytes = 0
+        self._remote_keep_alive = False
+        self._to_local = SendQueue()
+        self._to_remote = SendQueue()
+        self._modes = {}
+        self._last_activity = loop.time()
+        self._timer = loop.call_later(IDLE_TIMEOUT, self._on_timeout)
+        self._modes[local_sock] = POLL_IN | POLL_ERR
+        loop.add(local_sock, POLL_IN | POLL_ERR, self)
+        # counted with the tunnels against --max-tunnels and drained with them
+        server.http_connections.add(self)
+        self._process_client()
+        self._after_event()
+
+    def _on_timeout(self):
+        if self._state == STATE_DESTROYED:
+            return
+        remaining = self._last_activity + IDLE_TIMEOUT - self.loop.time()
+        if remaining > 0:
+            self._timer = self.loop.call_later(remaining, self._on_timeout)
+            return
+        if self._state == STATE_CONNECTING or \
+                (self._state == STATE_FORWARDING and not self._response_bytes):
+            self._fail('504 Gateway Timeout')
+            self._after_event()
+        else:
+            self.destroy()
+
+    def _fail(self, status):
+        """Answer the current request with an error and close afterwards."""
+        self._close_remote()
+        self._to_local.append(error_response(status))
+        self._state = STATE_CLOSING
+
+    def _process_client(self):
+        if self._state == STATE_REQUEST_HEAD:
+            end = self._buf.find(b'\r\n\r\n')
+            if end < 0:
+                if len(self._buf) > MAX_HEAD_SIZE:
+                    self._fail('431 Request Header Fields Too Large')
+                return
+            head = bytes(self._buf[:end])
+            del self._buf[:end + 4]
+            try:
+                self._start_request(head)
+            except ValueError as e:
+                logging.debug('bad http request from %s:%d: %s',
+                              self._client_address[0], self._client_address[1], e)
+                self._fail('400 Bad Request')
+            return
+        if self._state == STATE_FORWARDING and self._buf and \
+                not self._request_body.done:
+            n = self._request_body.feed(self._buf)
+            self._to_remote.append(self._buf[:n])
+            del self._buf[:n]
+
+    def _start_request(self, head):
+        method, target, version = parse_request_line(head.split(b'\r\n', 1)[0])
+        headers = _parse_head(head)[1]
+        if not version.startswith(b'HTTP/1.'):
+            raise ValueError('unsupported version')
+        if method == b'CONNECT':
+            # only the first request of a connection can turn it into a tunnel
+            raise ValueError('CONNECT after a request')
+        host, port, path = parse_request_target(method, target)
+        self._method = method.upper()
+        self._client_keep_alive = _keep_alive(version, headers) and not self._draining
+        self._request_body = _body_framing(headers) or _BodyFraming(0)
+        if self._request_body.until_close:
+            raise ValueError('request body without length')
+        # only a request without a body can be sent again as is
+        self._retryable = self._request_body.done
+        hop = _header_tokens(headers, b'connection') | HOP_HEADERS
+        lines = [b' '.join((method, path, b'HTTP/1.1'))]
+        if not any(k.lower() == b'host' for k, v in headers):
+            lines.append(b'Host: ' + _host_header(host, port))
+        lines.extend(k + b': ' + v for k, v in headers if k.lower() not in hop)
+        self._request_head = b'\r\n'.join(lines) + b'\r\n\r\n'
+        self._server.stats.http_requests += 1
+        self._remote_key = (host.lower(), port)
+        self._state = STATE_CONNECTING
+        sock = self._pool.acquire(self._remote_key)
+        if sock is not None:
+            self._server.stats.pool_hits += 1
+            self._on_remote_ready(sock, True)
+            return
+        self._server.dns_resolver.resolve(host, self._on_resolved)
+
+    def _on_resolved(self, result, error):
+        if self._state != STATE_CONNECTING:
+            return
+        if error:
+            self._fail('502 Bad Gateway')
+        else:
+            self._connect(result[1])
+        # may run from the resolver's own event
+        self._after_event()
+
+    def _connect(self, ip):
+        forbidden_ip = self._server.forbidden_ip
+        if forbidden_ip and ip in forbidden_ip:
+            self._fail('403 Forbidden')
+            return
+        try:
+            sock = create_remote_socket(ip, self._remote_key[1])
+        except (OSError, IOError) as e:
+            logging.debug('http upstream %s: %s', ip, e)
+            self._fail('502 Bad Gateway')
+            return
+        self._remote_sock = sock
+        self._modes[sock] = POLL_OUT | POLL_ERR
+        self.loop.add(sock, POLL_OUT | POLL_ERR, self)
+
+    def _on_remote_ready(self, sock, reused):
+        self._remote_sock = sock
+        self._remote_reused = reused
+        if reused:
+            self._modes[sock] = POLL_IN | POLL_ERR
+            self.loop.add(sock, POLL_IN | POLL_ERR, self)
+        else:
+            self._set_mode(sock, POLL_IN | POLL_ERR)
+        self._state = STATE_FORWARDING
+        self._response_head = bytearray()
+        self._response_body = None
+        self._response_bytes = 0
+        self._to_remote.append(self._request_head)
+        self._process_client()
+
+    def _on_response_data(self, data):
+        """Forward upstream bytes, returns True once the response is done."""
+        self._response_bytes += len(data)
+        while self._response_body is None:
+            self._response_head += data
+            end = self._response_head.find(b'\r\n\r\n')
+            if end < 0:
+                if len(self._response_head) > MAX_HEAD_SIZE:
+                    raise ValueError('response head too large')
+                return False
+            head = bytes(self._response_head[:end])
+            data = memoryview(bytes(self._response_head[end + 4:]))
+            self._response_head = bytearray()
+            # leaves _response_body unset for an interim 1xx response
+            self._start_response(head)
+        n = self._response_body.feed(data)
+        if n:
+            self._to_local.append(data[:n])
+        if n < len(data):
+            # bytes past the end of the response, don't trust the connection
+            self._remote_keep_alive = False
+        return self._response_body.done
+
+    def _start_response(self, head):
+        (version, status, reason), headers = _parse_head(head)
+        code = int(status)
+        hop = _header_tokens(headers, b'connection') | HOP_HEADERS
+        lines = [b' '.join((b'HTTP/1.1', status, reason))]
+        lines.extend(k + b': ' + v for k, v in headers if k.lower() not in hop)
+        if 100 <= code < 200:
+            self._to_local.append(b'\r\n'.join(lines) + b'\r\n\r\n')
+            return
+        if self._method == b'HEAD' or code in (204, 304):
+            body = _BodyFraming(0)
+        else:
+            body = _body_framing(headers) or _BodyFraming()
+        self._response_body = body
+        self._remote_keep_alive = _keep_alive(version, headers) and \
+            not body.until_close
+        if body.until_close or not self._client_keep_alive:
+            self._client_keep_alive = False
+            lines.append(b'Connection: close')
+        self._to_local.append(b'\r\n'.join(lines) + b'\r\n\r\n')
+
+    def _finish_response(self):
+        sock, self._remote_sock = self._remote_sock, None
+        del self._modes[sock]
+        if self._remote_keep_alive and self._request_body.done and \
+                not self._to_remote.size:
+            self.loop.remove(sock)
+            self._pool.release(self._remote_key, sock)
+        else:
+            self.loop.remove(sock)
+            sock.close()
+        if not self._request_body.done:
+            # answered before the body was sent, the rest can't be skipped
+            self._client_keep_alive = False
+        if self._client_keep_alive:
+            self._state = STATE_REQUEST_HEAD
+            self._process_client()
+        else:
+            self._state = STATE_CLOSING
+
+    def _close_remote(self):
+        self._server.dns_resolver.remove_callback(self._on_resolved)
+        if self._remote_sock:
+            self._modes.pop(self._remote_sock, None)
+            self.loop.remove(self._remote_sock)
+            self._remote_sock.close()
+            self._remote_sock = None
+        self._to_remote = SendQueue()
+
+    def _retry_fresh(self):
+        # a pooled connection the origin had already given up on, the
+        # request had no body so it can go out again on a new one
+        self._close_remote()
+        self._state = STATE_CONNECTING
+        self._server.dns_resolver.resolve(self._remote_key[0], self._on_resolved)
+
+    def _remote_read(self):
+        try:
+            data = self._remote_sock.recv(BUF_SIZE)
+        except (OSError, IOError) as e:
+            if errno_from_exception(e) in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = None
+            error = e
+        else:
+            error = None
+        if not data:
+            if self._remote_reused and self._retryable and not self._response_bytes:
+                self._retry_fresh()
+            elif self._response_body is not None and \
+                    self._response_body.until_close and not error:
+                self._client_keep_alive = self._remote_keep_alive = False
+                self._finish_response()
+            elif not self._response_bytes:
+                self._fail('502 Bad Gateway')
+            else:
+                self.destroy()
+            return
+        if self._on_response_data(memoryview(data)):
+            self._finish_response()
+
+    def _local_read(self):
+        data = self._local_sock.recv(BUF_SIZE)
+        if not data:
+            self.destroy()
+            return
+        self._buf += data
+        self._process_client()
+
+    def handle_event(self, sock, fd, mode):
+        try:
+            if sock == self._remote_sock and self._state == STATE_CONNECTING:
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    logging.debug('http upstream connect failed: errno %d', err)
+                    self._fail('502 Bad Gateway')
+                else:
+                    self._on_remote_ready(sock, False)
+            elif sock == self._remote_sock:
+                if mode & POLL_OUT:
+                    self._to_remote.flush(sock)
+                if mode & (POLL_IN | POLL_ERR):
+                    self._remote_read()
+            elif sock == self._local_sock:
+                if mode & POLL_OUT:
+                    self._to_local.flush(sock)
+                if mode & POLL_IN and self._state != STATE_CLOSING:
+                    self._local_read()
+                elif mode & POLL_ERR:
+                    self.destroy()
+        except ValueError as e:
+            logging.debug('bad http response: %s', e)
+            if self._response_bytes and self._response_body is not None:
+                self.destroy()
+            else:
+                self._fail('502 Bad Gateway')
+        except (OSError, IOError) as e:
+            if errno_from_exception(e) not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.destroy()
+        self._last_activity = self.loop.time()
+        self._after_event()
+
+    def _after_event(self):
+        if self._state == STATE_DESTROYED:
+            return
+        try:
+            if self._remote_sock and self._to_remote.size and \
+                    self._state == STATE_FORWARDING:
+                self._to_remote.flush(self._remote_sock)
+            if self._to_local.size:
+                self._to_local.flush(self._local_sock)
+        except (OSError, IOError):
+            self.destroy()
+            return
+        if self._state == STATE_CLOSING and not self._to_local.size:
+            self.destroy()
+            return
+        self._update_modes()
+
+    def _update_modes(self):
+        local_mode = POLL_ERR
+        # the client is only read while a request head or body is expected
+        # and the upstream keeps up with it
+        if self._state == STATE_REQUEST_HEAD or \
+                (self._state == STATE_FORWARDING and not self._request_body.done and
+                 self._to_remote.size < HIGH_WATERMARK):
+            local_mode |= POLL_IN
+        if self._to_local.size:
+            local_mode |= POLL_OUT
+        self._set_mode(self._local_sock, local_mode)
+        if self._remote_sock and self._state == STATE_FORWARDING:
+            remote_mode = POLL_ERR
+            if self._to_local.size <= LOW_WATERMARK:
+                remote_mode |= POLL_IN
+            if self._to_remote.size:
+                remote_mode |= POLL_OUT
+            self._set_mode(self._remote_sock, remote_mode)
+
+    def _set_mode(self, sock, mode):
+        if self._modes.get(sock) != mode:
+            self._modes[sock] = mode
+            self.loop.modify(sock, mode)
+
+    def drain(self):
+        """No more requests after the current one, an idle keep-alive
+        connection is closed right away."""
+        self._draining = True
+        self._client_keep_alive = False
+        if self._state == STATE_REQUEST_HEAD and not self._buf:
+            self.destroy()
+
+    def destroy(self):
+        if self._state == STATE_DESTROYED:
+            return
+        self._state = STATE_DESTROYED
+        self._server.remove_http_connection(self)
+        self._timer.cancel()
+        self._close_remote()
+        self.loop.remove(self._local_sock)
+        self._local_sock.close()
+
+
+def test_body_framing():
+    # a Content-Length body ends where the length says, not with the read
+    body = _BodyFraming(5)
+    assert body.feed(b'he') == 2 and not body.done
+    assert body.feed(b'llo GET /') == 3 and body.done
+    assert body.feed(b'more') == 0
+    assert _BodyFraming(0).done and _BodyFraming().feed(b'abc') == 3
+    # chunk size lines, data, CRLFs and trailers split anywhere
+    message = b'5;name=value\r\nhello\r\n1A\r\n' + b'x' * 26 + \
+        b'\r\n0\r\nExpires: never\r\nX-Digest: abc\r\n\r\n'
+    for step in (1, 2, 3, 7, len(message)):
+        body = _BodyFraming(chunked=True)
+        consumed = 0
+        for i in range(0, len(message), step):
+            assert not body.done
+            consumed += body.feed(message[i:i + step])
+        assert body.done and consumed == len(message)
+    body = _BodyFraming(chunked=True)
+    assert body.feed(message + b'GET / HTTP/1.1\r\n') == len(message) and body.done
+    for bad in (b'zz\r\n', b'-5\r\n', b'1' * (MAX_CHUNK_LINE + 1)):
+        try:
+            _BodyFraming(chunked=True).feed(bad)
+        except ValueError:
+            continue
+        assert False, bad
+    assert _host_header(b'example.com', 80) == b'example.com'
+    assert _host_header(b'::1', 8080) == b'[::1]:8080'
+
+
+def _origin(listener, responses):
+    """Serve requests off listener, one list of responses per accepted
+    connection; a None response closes it without answering."""
+    for answers in responses:
+        conn, _ = listener.accept()
+        data = b''
+        for answer in answers:
+            while b'\r\n\r\n' not in data:
+                data += conn.recv(4096)
+            data = data.split(b'\r\n\r\n', 1)[1]
+            if answer is None:
+                break
+            conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s' % (len(answer), answer))
+        conn.close()
+
+
+def test_pool_retry():
+    # the origin closes a pooled connection as the next request arrives on
+    # it, the request goes out again on a fresh one
+    # tcp_event imports this module
+    from tcp_event import TCPServerEvent
+    loop = EventLoop()
+    server = TCPServerEvent(0, config={'http_proxy': True})
+    server.add_loop(loop)
+    listener = socket.create_server(('127.0.0.1', 0))
+    origin = threading.Thread(target=_origin, args=(listener, [[b'one', None], [b'two']]))
+    origin.start()
+    bodies = []
+
+    def client():
+        sock = socket.create_connection(('127.0.0.1', server.server_sock.getsockname()[1]))
+        for path in (b'/1', b'/2'):
+            sock.sendall(b'GET http://127.0.0.1:%d%s HTTP/1.1\r\n\r\n' % (
+                listener.getsockname()[1], path))
+            data = b''
+            while not data.endswith((b'one', b'two')):
+                data += sock.recv(4096)
+            bodies.append(data[-3:])
+        sock.close()
+    thread = threading.Thread(target=client)
+    thread.start()
+    deadline = loop.time() + 5
+
+    def check():
+        if thread.is_alive() and loop.time() < deadline:
+            loop.call_later(0.01, check)
+        else:
+            loop.stop()
+    loop.call_later(0, check)
+    loop.run()
+    origin.join(1)
+    assert bodies == [b'one', b'two']
+    assert server.stats.pool_hits == 1 and server.stats.http_requests == 2
+    listener.close()
+    server.close()
+    loop.close()
+
+
+if __name__ == '__main__':
+    test_body_framing()
+    test_pool_retry()
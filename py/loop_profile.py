@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Sampled instrumentation of EventLoop iterations.
+
+Every sample_every-th iteration is measured: how long the loop was busy
+between two polls (events and timers, the lag anything arriving then
+waits for), how many events the poll returned and how long each
+handle_event took, by handler type. Other iterations cost one modulo.
+
+With a slow_threshold the loop also times every handle_event and timer
+callback, two clock reads each, and reports the ones that run past it.
+In a sampled iteration a slow handle_event comes with the stack it was
+stuck in, captured by an interval timer signal while it is still
+running. Without setitimer (windows) it is reported without.
+"""
+import bisect
+import logging
+import signal
+import socket
+import time
+import traceback
+
+DEFAULT_SAMPLE_EVERY = 16
+DEFAULT_SLOW_THRESHOLD = 0.1
+# at most one slow callback warning this often, a stuck resolver would
+# otherwise log on every sampled event
+SLOW_LOG_INTERVAL = 10.0
+
+TIME_BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+               0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+EVENT_BOUNDS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class Histogram(object):
+    """Counts per upper bound, the last bucket takes everything above."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def to_dict(self):
+        # cumulative, as prometheus buckets are
+        buckets, seen = [], 0
+        for bound, n in zip(self.bounds + ('+Inf',), self.counts):
+            seen += n
+            buckets.append([bound, seen])
+        return {'count': self.count, 'sum': self.total, 'buckets': buckets}
+
+
+class LoopProfiler(object):
+
+    def __init__(self, sample_every=DEFAULT_SAMPLE_EVERY, slow_threshold=DEFAULT_SLOW_THRESHOLD):
+        # type: (int,float) -> None
+        self.sample_every = max(1, sample_every)
+        self.slow_threshold = slow_threshold
+        self.lag = Histogram(TIME_BOUNDS)
+        self.events = Histogram(EVENT_BOUNDS)
+        self.handlers = {}  # handler type name -> Histogram
+        self.slow_callbacks = 0
+        self._polled = None
+        self._stack = None
+        self._last_warning = None
+        self._watchdog = slow_threshold > 0 and hasattr(signal, 'setitimer')
+
+    def install(self):
+        """Take SIGALRM for the watchdog, from the main thread."""
+        if self._watchdog:
+            signal.signal(signal.SIGALRM, self._on_alarm)
+
+    def polled(self, n):
+        self._polled = time.monotonic()
+        self.events.add(n)
+
+    def call(self, handler, sock, fd, event):
+        start = time.monotonic()
+        if self._watchdog:
+            self._stack = None
+            signal.setitimer(signal.ITIMER_REAL, self.slow_threshold)
+        try:
+            handler.handle_event(sock, fd, event)
+        finally:
+            if self._watchdog:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+            elapsed = time.monotonic() - start
+            name = type(handler).__name__
+            histogram = self.handlers.get(name)
+            if histogram is None:
+                histogram = self.handlers[name] = Histogram(TIME_BOUNDS)
+            histogram.add(elapsed)
+            if self.slow_threshold and elapsed >= self.slow_threshold:
+                self.slow_callback('%s.handle_event fd:%d' % (name, fd), elapsed, self._stack)
+
+    def done(self):
+        self.lag.add(time.monotonic() - self._polled)
+
+    def _on_alarm(self, signum, frame):
+        # runs inside the handler that overran, its frame is what's slow
+        self._stack = traceback.extract_stack(frame)
+
+    def slow_callback(self, what, elapsed, stack=None):
+        self.slow_callbacks += 1
+        now = time.monotonic()
+        if self._last_warning is not None and now - self._last_warning < SLOW_LOG_INTERVAL:
+            return
+        self._last_warning = now
+        stack = ''.join(traceback.format_list(stack)) if stack else ''
+        logging.warning('slow callback: %s took %.1fms\n%s', what, elapsed * 1000, stack)
+
+    def to_dict(self):
+        return {'sample_every': self.sample_every,
+                'slow_threshold': self.slow_threshold,
+                'slow_callbacks': self.slow_callbacks,
+                'lag': self.lag.to_dict(),
+                'events_per_poll': self.events.to_dict(),
+                'handlers': dict((name, h.to_dict()) for name, h in self.handlers.items())}
+
+
+def test_loop_profiler():
+    histogram = Histogram((1, 10))
+    for value in (0, 1, 5, 50):
+        histogram.add(value)
+    assert histogram.to_dict()['buckets'] == [[1, 2], [10, 3], ['+Inf', 4]]
+
+    class Sleeper(object):
+        def handle_event(self, sock, fd, event):
+            time.sleep(0.05)
+
+    profiler = LoopProfiler(1, 0.01)
+    profiler.install()
+    profiler.polled(1)
+    profiler.call(Sleeper(), None, 3, 1)
+    profiler.done()
+    assert profiler.slow_callbacks == 1
+    if profiler._watchdog:
+        assert any(f.name == 'handle_event' for f in profiler._stack)
+    result = profiler.to_dict()
+    assert result['handlers']['Sleeper']['count'] == 1
+    assert result['events_per_poll']['buckets'][1] == [1, 1]
+    assert result['lag']['sum'] >= 0.05
+
+    # outside sampled iterations slow handlers and timers are still caught
+    from event_loop import POLL_IN, EventLoop
+    loop = EventLoop()
+    loop.profiler = LoopProfiler(1000, 0.01)
+    left, right = socket.socketpair()
+    right.send(b'x')
+
+    class Once(object):
+        def handle_event(self, sock, fd, event):
+            loop.remove(sock)
+            time.sleep(0.02)
+
+    loop.add(left, POLL_IN, Once())
+    loop.call_later(0, time.sleep, 0.02)
+    loop.call_later(0.1, loop.stop)
+    loop.run()
+    assert loop.profiler.slow_callbacks == 2 and not loop.profiler.handlers
+    left.close()
+    right.close()
+    loop.close()
+
+
+if __name__ == '__main__':
+    test_loop_profiler()
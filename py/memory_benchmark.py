@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Proxy memory per idle tunnel.
+
+    python memory_benchmark.py [-n 5000] [--proxy-args "--splice"]
+
+Opens -n tunnels through tcp_event.py to the echo origin of
+benchmark.py, leaves them idle and reports how much the proxy's RSS
+grew per tunnel, and what 100k idle tunnels would take at that rate.
+Each tunnel costs the proxy two fds, so -n is bounded by its fd limit.
+"""
+import argparse
+import logging
+import multiprocessing
+import select
+import time
+
+from benchmark import _setup, raise_nofile, rss_kb, start_origin, start_proxy
+from event_loop import EVENT_MODELS
+
+# lets the proxy finish the last replies and the allocator settle
+SETTLE_TIME = 1.0
+EXTRAPOLATE = 100000
+
+
+def hold_tunnels(proxy_port, origin_port, count, opened, done):
+    import selectors
+    raise_nofile()
+    clients, failed, _ = _setup(selectors.DefaultSelector(), proxy_port, origin_port,
+                                count, time.time() + 60)
+    opened.put((len(clients), failed))
+    # keep them open and idle until the proxy has been measured
+    done.wait()
+    for c in clients:
+        c.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='proxy memory per idle tunnel')
+    parser.add_argument('-n', '--tunnels', type=int, default=5000)
+    parser.add_argument('--generators', type=int, default=2,
+                        help='processes holding the client ends')
+    parser.add_argument('--port', type=int, default=1082)
+    parser.add_argument('--proxy-args', default='',
+                        help='extra arguments for tcp_event.py')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    nofile = raise_nofile()
+    if args.tunnels * 2 + 64 > nofile:
+        parser.error('the proxy needs two fds per tunnel, the limit is %d' % nofile)
+    origin, origin_port = start_origin()
+    model = [m for m in EVENT_MODELS if hasattr(select, m)][0]
+    proxy = start_proxy(model, args.port, args.proxy_args.split())
+    opened, done = multiprocessing.Queue(), multiprocessing.Event()
+    try:
+        time.sleep(SETTLE_TIME)
+        before = rss_kb(proxy.pid)
+        holders = []
+        for i in range(args.generators):
+            count = args.tunnels // args.generators + (i < args.tunnels % args.generators)
+            p = multiprocessing.Process(target=hold_tunnels, args=(
+                args.port, origin_port, count, opened, done))
+            p.start()
+            holders.append(p)
+        results = [opened.get() for _ in holders]
+        established = sum(r[0] for r in results)
+        time.sleep(SETTLE_TIME)
+        after = rss_kb(proxy.pid)
+        done.set()
+        for p in holders:
+            p.join()
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        origin.terminate()
+    per_tunnel = (after - before) * 1024.0 / max(1, established)
+    logging.info('tunnels:          %d (%d failed)', established, sum(r[1] for r in results))
+    logging.info('rss before/after: %d kB / %d kB', before, after)
+    logging.info('per idle tunnel:  %d bytes', per_tunnel)
+    logging.info('%dk idle tunnels: ~%d MB', EXTRAPOLATE // 1000,
+                 (before * 1024 + per_tunnel * EXTRAPOLATE) / 1e6)
+
+
+if __name__ == '__main__':
+    main()
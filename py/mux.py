@@ -0,0 +1,875 @@
+# -*- coding: utf-8 -*-
+"""Multiplexed transport between two instances of the proxy.
+
+A local instance started with --upstream carries its tunnels as streams
+over a few persistent connections to a remote instance listening on
+--mux-port, so a new tunnel costs one OPEN frame on a warm connection
+instead of a tcp and a socks handshake across the long link.
+
+Every frame is a FRAME header (type, flags, stream id, payload length)
+followed by the payload:
+
+    OPEN    local -> remote, payload: socks5 address (atyp, addr, port)
+    REPLY   remote -> local, payload: one socks5 REP code
+    DATA    either way, payload: stream bytes
+    WINDOW  either way, payload: 4 byte window increment
+    CLOSE   either way, no payload, the sender is done with the stream
+
+A stream may have INITIAL_WINDOW bytes in flight per direction; the
+receiver hands credit back with WINDOW frames once its side took the
+bytes, so a slow client holds up its own stream and not the connection.
+Streams with data and window take turns, a frame at a time.
+
+With --mux-key on both ends the connection carries ChunkAuth chunks
+instead of bare frames, see chunk_auth.py. With --mux-compress on both
+ends OPEN and REPLY carry FLAG_DEFLATE and the stream's DATA frames may
+be compressed, see compression.py; windows count uncompressed bytes.
+"""
+import errno
+import logging
+import os
+import socket
+import struct
+import threading
+import zlib
+from collections import deque
+
+import common
+from chunk_auth import ChunkAuth
+from common import CONNECT_ERRNO_REPLIES, parse_header_from
+from compression import COMPRESS_BATCH, FLAG_DEFLATE, AdaptiveDeflate, new_inflater
+from event_loop import POLL_ERR, POLL_IN, POLL_OUT
+from send_queue import HIGH_WATERMARK, LOW_WATERMARK, SendQueue
+from stats import STAGE_CONNECTING, STAGE_DESTROYED, STAGE_DNS, STAGE_STREAM, record_close
+from utils import create_remote_socket, create_server_socket, errno_from_exception
+
+FRAME = struct.Struct('>BBIH')
+_WINDOW = struct.Struct('>I')
+FRAME_OPEN = 1
+FRAME_REPLY = 2
+FRAME_DATA = 3
+FRAME_WINDOW = 4
+FRAME_CLOSE = 5
+
+MAX_FRAME_DATA = 16 * 1024
+INITIAL_WINDOW = 256 * 1024
+# credit is handed back in steps of at least this much
+WINDOW_UPDATE = INITIAL_WINDOW // 4
+# the connection's send queue is only topped up below this, so a stream
+# that turns ready waits behind at most this much of the others' data
+SESSION_QUEUE = 64 * 1024
+BUF_SIZE = 64 * 1024
+ACCEPT_BATCH = 16
+DEFAULT_CONNECTIONS = 2
+
+CONNECT_TIMEOUT = 10
+IDLE_TIMEOUT = 300
+
+
+class MuxStream(object):
+    """One tunnel on a MuxSession.
+
+    The owner hears from the peer through on_stream_reply(rep),
+    on_stream_data(data), on_stream_close() and on_stream_drained(), the
+    last once its write backlog fell to LOW_WATERMARK. It reports the
+    received bytes it passed on with consumed().
+    """
+
+    def __init__(self, session, stream_id, owner):
+        self.session = session
+        self.id = stream_id
+        self.owner = owner
+        self.send_window = INITIAL_WINDOW
+        self.recv_window = INITIAL_WINDOW
+        self.out_size = 0
+        self.closed = False
+        self.scheduled = False
+        self.deflate = None  # type: AdaptiveDeflate
+        self.inflater = None
+        self.deflate_offered = False  # the peer's OPEN asked for FLAG_DEFLATE
+        self._out = deque()
+        self._unacked = 0
+        self._closing = False  # CLOSE goes out behind what is queued
+
+    def write(self, data):
+        if self.closed or self._closing or not data:
+            return
+        self._out.append(bytes(data))
+        self.out_size += len(data)
+        self.session.schedule(self)
+
+    def reply(self, rep):
+        """Answer the peer's OPEN, agreeing to compression if both want it."""
+        flags = 0
+        if self.deflate_offered and rep == common.REP_SUCCEEDED:
+            self.deflate = AdaptiveDeflate()
+            flags = FLAG_DEFLATE
+        self.session.send_frame(FRAME_REPLY, self.id, bytes((rep,)), flags)
+
+    def consumed(self, n):
+        if self.closed:
+            return
+        self._unacked += n
+        if self._unacked >= WINDOW_UPDATE:
+            self.recv_window += self._unacked
+            self.session.send_frame(FRAME_WINDOW, self.id, _WINDOW.pack(self._unacked))
+            self._unacked = 0
+
+    def close(self):
+        """Drop the owner; CLOSE follows once the queued data is out."""
+        self.owner = None
+        if self.closed or self._closing:
+            return
+        self._closing = True
+        self.session.schedule(self)
+
+    def sendable(self):
+        if self.out_size:
+            return self.send_window > 0
+        return self._closing
+
+    def take(self, limit):
+        """Up to limit queued bytes, joined, for one DATA frame."""
+        out = self._out
+        parts = []
+        size = 0
+        while out and size < limit:
+            head = out[0]
+            if size + len(head) <= limit:
+                out.popleft()
+            else:
+                head = memoryview(head)
+                out[0] = head[limit - size:]
+                head = head[:limit - size]
+            parts.append(head)
+            size += len(head)
+        self.out_size -= size
+        self.send_window -= size
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+
+class MuxSession(object):
+    """One persistent connection carrying many streams.
+
+    Only the accepting side gets on_open(stream, address), which has to
+    give the new stream an owner. on_close(session) is called once the
+    connection is gone, after every open stream heard on_stream_close().
+    """
+
+    def __init__(self, loop, sock, connecting=False, on_open=None, on_close=None,
+                 auth=None, compress=False, stats=None):
+        # type: (object,socket.socket,bool,object,object,ChunkAuth,bool,object) -> None
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.loop = loop
+        self.streams = {}
+        self.closed = False
+        self._sock = sock
+        self._connecting = connecting
+        self._on_open = on_open
+        self._on_close = on_close
+        self._next_id = 1
+        self._control = []  # frames that go ahead of any stream data
+        self._ready = deque()  # streams waiting for their turn
+        self._queue = SendQueue()
+        self._partial = b''
+        self._pumping = False
+        self._auth = auth
+        self._compress = compress
+        self._stats = stats
+        if auth:
+            self._queue.append(auth.nonce)
+        self._mode = POLL_OUT | POLL_ERR if connecting else POLL_IN | POLL_ERR
+        loop.add(sock, self._mode, self)
+
+    def open_stream(self, owner, address):
+        stream = MuxStream(self, self._next_id, owner)
+        self._next_id += 2
+        self.streams[stream.id] = stream
+        self.send_frame(FRAME_OPEN, stream.id, address, FLAG_DEFLATE if self._compress else 0)
+        return stream
+
+    def send_frame(self, frame_type, stream_id, payload=b'', flags=0):
+        self._control.append(FRAME.pack(frame_type, flags, stream_id, len(payload)) + payload)
+        self._pump()
+
+    def schedule(self, stream):
+        if not stream.scheduled and stream.sendable():
+            stream.scheduled = True
+            self._ready.append(stream)
+        self._pump()
+
+    def _pump(self):
+        """Frame ready streams into the send queue and send."""
+        if self._pumping or self.closed:
+            return
+        self._pumping = True
+        drained = []
+        queue, auth = self._queue, self._auth
+        try:
+            while not self._connecting:
+                frames = []
+                if auth is None:
+                    frames = self._next_frames(SESSION_QUEUE - queue.size, drained)
+                    for frame in frames:
+                        queue.append(frame)
+                elif auth.ready:
+                    # a whole batch is sealed at once, so chunks come out
+                    # as large as the batch allows
+                    frames = self._next_frames(SESSION_QUEUE - queue.size, drained)
+                    if frames:
+                        queue.append(auth.seal(frames))
+                if not queue.flush(self._sock) or not frames:
+                    break
+        except (OSError, IOError) as e:
+            logging.warning("mux connection failed: %s", e)
+            self._pumping = False
+            self.close()
+            return
+        self._pumping = False
+        self._update_mode()
+        for stream in drained:
+            if stream.owner:
+                stream.owner.on_stream_drained()
+
+    def _next_frames(self, budget, drained):
+        """Control frames, then stream data round robin up to budget."""
+        frames = self._control
+        self._control = []
+        size = 0
+        ready = self._ready
+        while ready and size < budget:
+            stream = ready.popleft()
+            stream.scheduled = False
+            if stream.closed:
+                continue
+            if not stream.out_size:
+                # a closing stream whose data is all out
+                frames.append(FRAME.pack(FRAME_CLOSE, 0, stream.id, 0))
+                self._forget(stream)
+                continue
+            was_high = stream.out_size > LOW_WATERMARK
+            if stream.deflate is None:
+                data, flags = stream.take(min(MAX_FRAME_DATA, stream.send_window)), 0
+            else:
+                # compressing a larger batch at once gets the better ratio
+                raw = stream.take(min(COMPRESS_BATCH, stream.send_window))
+                data, flags = stream.deflate.compress(raw)
+                # an incompressible batch still goes out deflated (the peer's
+                # history must match) and may grow, that saves nothing
+                if self._stats and len(data) < len(raw):
+                    self._stats.compression_saved += len(raw) - len(data)
+            view = memoryview(data)
+            for start in range(0, len(data), MAX_FRAME_DATA):
+                part = view[start:start + MAX_FRAME_DATA]
+                frames.append(FRAME.pack(FRAME_DATA, flags, stream.id, len(part)))
+                frames.append(part)
+                size += FRAME.size + len(part)
+            if was_high and stream.out_size <= LOW_WATERMARK:
+                drained.append(stream)
+            if stream.sendable():
+                stream.scheduled = True
+                ready.append(stream)
+        return frames
+
+    def handle_event(self, sock, fd, mode):
+        try:
+            if self._connecting:
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    raise OSError(err, os.strerror(err))
+                self._connecting = False
+            elif mode & POLL_IN:
+                self._read()
+                if self.closed:
+                    return
+            elif mode & POLL_ERR:
+                raise OSError(errno.ECONNRESET, os.strerror(errno.ECONNRESET))
+        except (OSError, IOError) as e:
+            if errno_from_exception(e) in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            logging.warning("mux connection failed: %s", e)
+            self.close()
+            return
+        self._pump()
+
+    def _read(self):
+        data = self._sock.recv(BUF_SIZE)
+        if not data:
+            self.close()
+            return
+        if self._auth:
+            try:
+                data = self._auth.open(data)
+            except ValueError as e:
+                self._protocol_error(str(e))
+                return
+        if self._partial:
+            data = self._partial + data
+        view = memoryview(data)
+        pos, end, header_size = 0, len(data), FRAME.size
+        while end - pos >= header_size:
+            frame_type, flags, stream_id, length = FRAME.unpack_from(data, pos)
+            start = pos + header_size
+            if end - start < length:
+                break
+            pos = start + length
+            self._on_frame(frame_type, flags, stream_id, view[start:pos])
+            if self.closed:
+                return
+        self._partial = data[pos:]
+
+    def _on_frame(self, frame_type, flags, stream_id, payload):
+        stream = self.streams.get(stream_id)
+        if frame_type == FRAME_DATA:
+            if stream is None:
+                # closed on this side while the data was on its way
+                return
+            if flags & FLAG_DEFLATE:
+                payload = self._inflate(stream, payload)
+                if payload is None:
+                    return
+            stream.recv_window -= len(payload)
+            if stream.recv_window < 0:
+                self._protocol_error('stream %d overran its window' % stream_id)
+            elif stream.owner:
+                stream.owner.on_stream_data(payload)
+        elif frame_type == FRAME_WINDOW:
+            if stream is not None and len(payload) == _WINDOW.size:
+                stream.send_window += _WINDOW.unpack(payload)[0]
+                self.schedule(stream)
+        elif frame_type == FRAME_REPLY:
+            if stream is not None and stream.owner and payload:
+                if flags & FLAG_DEFLATE and self._compress:
+                    stream.deflate = AdaptiveDeflate()
+                stream.owner.on_stream_reply(payload[0])
+        elif frame_type == FRAME_CLOSE:
+            if stream is not None:
+                self._forget(stream)
+                if stream.owner:
+                    stream.owner.on_stream_close()
+        elif frame_type == FRAME_OPEN and self._on_open and stream is None:
+            stream = MuxStream(self, stream_id, None)
+            stream.deflate_offered = bool(flags & FLAG_DEFLATE) and self._compress
+            self.streams[stream_id] = stream
+            self._on_open(stream, bytes(payload))
+        else:
+            self._protocol_error('unexpected frame type %d' % frame_type)
+
+    def _inflate(self, stream, payload):
+        if stream.inflater is None:
+            stream.inflater = new_inflater()
+        inflater = stream.inflater
+        try:
+            # never inflate past the window, whatever the payload claims
+            data = inflater.decompress(payload, stream.recv_window + 1)
+        except zlib.error as e:
+            self._protocol_error('stream %d: %s' % (stream.id, e))
+            return None
+        if inflater.unconsumed_tail:
+            self._protocol_error('stream %d overran its window' % stream.id)
+            return None
+        return data
+
+    def _protocol_error(self, message):
+        logging.warning("mux protocol error: %s", message)
+        self.close()
+
+    def _forget(self, stream):
+        stream.closed = True
+        self.streams.pop(stream.id, None)
+
+    def _update_mode(self):
+        if self.closed:
+            return
+        mode = POLL_ERR
+        if self._connecting or self._queue.size:
+            mode |= POLL_OUT
+        if not self._connecting:
+            # the windows bound what each stream buffers, so the
+            # connection itself is always read
+            mode |= POLL_IN
+        if mode != self._mode:
+            self._mode = mode
+            self.loop.modify(self._sock, mode)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove(self._sock)
+        self._sock.close()
+        streams = list(self.streams.values())
+        self.streams.clear()
+        for stream in streams:
+            stream.closed = True
+            if stream.owner:
+                stream.owner.on_stream_close()
+        if self._on_close:
+            self._on_close(self)
+
+
+class MuxClient(object):
+    """The local side: spreads new streams over up to `connections`
+    sessions to the remote instance, connecting them as needed."""
+
+    def __init__(self, address, connections=DEFAULT_CONNECTIONS, key=None,
+                 compress=False, stats=None):
+        # type: (tuple,int,bytes,bool,object) -> None
+        self._address = address  # numeric (ip, port)
+        self._connections = connections
+        self._key = key
+        self._compress = compress
+        self._stats = stats
+        self._sessions = []
+        self.loop = None
+
+    def add_to_loop(self, loop):
+        self.loop = loop
+
+    def open_stream(self, owner, address):
+        """A new stream to the socks5 address; raises OSError if no
+        connection could be started."""
+        return self._pick_session().open_stream(owner, address)
+
+    def _pick_session(self):
+        if len(self._sessions) < self._connections:
+            sock = create_remote_socket(*self._address)
+            auth = ChunkAuth(self._key, True) if self._key else None
+            session = MuxSession(self.loop, sock, connecting=True,
+                                 on_close=self._sessions.remove, auth=auth,
+                                 compress=self._compress, stats=self._stats)
+            self._sessions.append(session)
+            return session
+        return min(self._sessions, key=lambda session: len(session.streams))
+
+    def close(self):
+        for session in list(self._sessions):
+            session.close()
+
+
+class MuxServer(object):
+    """The remote side: accepts sessions from local instances and opens
+    a StreamTunnel for every stream on them."""
+
+    def __init__(self, server, port, sock=None):
+        # type: (object,int,socket.socket) -> None
+        self._server = server  # the TCPServerEvent whose tunnels these are
+        self.loop = None
+        self.sessions = set()
+        # sock: an already listening socket from a hot restart
+        self.sock = sock or create_server_socket(
+            '0.0.0.0', port, server.config.get('reuse_port', False))
+        logging.info("mux fd:%s listening on port:%s", self.sock.fileno(), port)
+
+    def add_to_loop(self, loop):
+        self.loop = loop
+        loop.add(self.sock, POLL_IN | POLL_ERR, self)
+
+    def handle_event(self, sock, fd, mode):
+        allowed_clients = self._server.allowed_clients
+        for _ in range(ACCEPT_BATCH):
+            try:
+                conn, addr = sock.accept()
+            except (OSError, IOError) as e:
+                if errno_from_exception(e) not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                                   errno.ECONNABORTED, errno.EINTR):
+                    logging.error("mux accept: %s", e)
+                return
+            if allowed_clients and addr[0] not in allowed_clients:
+                self._server.stats.acl_denied += 1
+                conn.close()
+                continue
+            config = self._server.config
+            auth = ChunkAuth(config['mux_key'], False) if config.get('mux_key') else None
+            self.sessions.add(MuxSession(self.loop, conn, on_open=self._on_open,
+                                         on_close=self.sessions.discard, auth=auth,
+                                         compress=config.get('mux_compress', False),
+                                         stats=self._server.stats))
+
+    def _on_open(self, stream, address):
+        if self._server.at_capacity():
+            # the same cap an accepted client is held to, the stream is
+            # refused rather than left waiting in a backlog
+            logging.debug("refusing mux stream %d, %d tunnels open", stream.id,
+                          len(self._server.tunnels))
+            stream.reply(common.REP_GENERAL_FAILURE)
+            stream.close()
+            return
+        self._server.stats.mux_streams += 1
+        StreamTunnel(self._server, stream, address)
+
+    def stop_accepting(self):
+        if self.sock is None:
+            return
+        self.loop.remove(self.sock)
+        self.sock.close()
+        self.sock = None
+
+    def close(self):
+        self.stop_accepting()
+        for session in list(self.sessions):
+            session.close()
+
+
+class StreamTunnel(object):
+    """The remote end of a stream: connects to the address the OPEN
+    frame carried and relays between the stream and that socket."""
+
+    def __init__(self, server, stream, address):
+        self._server = server
+        self.loop = loop = server.loop
+        self._stream = stream
+        stream.owner = self
+        self._sock = None  # type: socket.socket
+        self._connecting = None
+        self._remote_host = None
+        self._remote_port = None
+        self._remote_addrs = []
+        self._connect_errno = None
+        self._to_remote = SendQueue()
+        self._uncredited = 0
+        self._paused = False
+        self._mode = None
+        self._stage = STAGE_DNS
+        self._bytes_up = 0
+        self._bytes_down = 0
+        self._start_time = self._last_activity = loop.time()
+        self._connect_time = None
+        self._timer = loop.call_later(CONNECT_TIMEOUT, self._on_timeout)
+        server.tunnels.add(self)
+        header_result = parse_header_from(address)
+        if not header_result or header_result[3] != len(address):
+            self._reply_error(common.REP_ADDRTYPE_NOT_SUPPORTED, 'protocol')
+            return
+        addrtype, self._remote_host, self._remote_port, _ = header_result
+        forbidden_ip = server.forbidden_ip
+        if forbidden_ip and addrtype != common.ADDRTYPE_HOST and \
+                forbidden_ip.contains_packed(address[1:-2]):
+            self._reply_error(common.REP_NOT_ALLOWED, 'forbidden')
+            return
+        server.dns_resolver.resolve_all(self._remote_host, self._handle_dns_resolved)
+
+    def stat_values(self):
+        return self._stage, self._bytes_up, self._bytes_down, \
+            self._to_remote.size + self._stream.out_size
+
+    def _on_timeout(self):
+        if self._stage == STAGE_DESTROYED:
+            return
+        if self._stage == STAGE_STREAM:
+            remaining = self._last_activity + IDLE_TIMEOUT - self.loop.time()
+            if remaining > 0:
+                self._timer = self.loop.call_later(remaining, self._on_timeout)
+                return
+            self.destroy('timeout')
+        else:
+            self._reply_error(common.REP_HOST_UNREACHABLE, 'timeout')
+
+    def _reply_error(self, rep, reason):
+        self._stream.reply(rep)
+        self.destroy(reason)
+
+    def _handle_dns_resolved(self, result, error):
+        if self._stage != STAGE_DNS:
+            return
+        if error:
+            logging.debug("resolve %s failed: %s", result and result[0], error)
+            self._reply_error(common.REP_HOST_UNREACHABLE, 'dns')
+            return
+        ips = result[1]
+        forbidden_ip = self._server.forbidden_ip
+        if forbidden_ip:
+            ips = [ip for ip in ips if ip not in forbidden_ip]
+            if not ips:
+                self._reply_error(common.REP_NOT_ALLOWED, 'forbidden')
+                return
+        self._remote_addrs = list(ips)
+        self._stage = STAGE_CONNECTING
+        self._connect_next()
+
+    def _connect_next(self):
+        # one address at a time: the remote end usually sits on a well
+        # connected network, the saved round trips are on the mux link
+        while self._remote_addrs:
+            ip = self._remote_addrs.pop(0)
+            try:
+                sock = create_remote_socket(ip, self._remote_port)
+            except (OSError, IOError) as e:
+                self._connect_errno = errno_from_exception(e)
+                continue
+            self._connecting = sock
+            self._set_mode(sock, POLL_OUT | POLL_ERR)
+            return
+        self._reply_error(CONNECT_ERRNO_REPLIES.get(self._connect_errno, common.REP_GENERAL_FAILURE),
+                          'connect')
+
+    def _on_connected(self, sock):
+        self._connecting = None
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.loop.remove(sock)
+            self._mode = None
+            sock.close()
+            self._connect_errno = err
+            self._connect_next()
+            return
+        self._sock = sock
+        self._connect_time = self._last_activity = self.loop.time()
+        self._stage = STAGE_STREAM
+        self._timer.cancel()
+        self._timer = self.loop.call_later(IDLE_TIMEOUT, self._on_timeout)
+        self._stream.reply(common.REP_SUCCEEDED)
+        self._to_remote.flush(sock)
+
+    def handle_event(self, sock, fd, mode):
+        try:
+            if sock is self._connecting:
+                self._on_connected(sock)
+            else:
+                if mode & (POLL_IN | POLL_ERR):
+                    data = sock.recv(BUF_SIZE)
+                    if not data:
+                        self.destroy('eof')
+                        return
+                    self._bytes_down += len(data)
+                    self._last_activity = self.loop.time()
+                    self._stream.write(data)
+                if mode & POLL_OUT:
+                    self._to_remote.flush(sock)
+        except (OSError, IOError) as e:
+            if errno_from_exception(e) in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.destroy('error')
+            return
+        self._update()
+
+    def on_stream_data(self, data):
+        self._bytes_up += len(data)
+        self._last_activity = self.loop.time()
+        self._uncredited += len(data)
+        if self._sock is None or self._to_remote.size:
+            # not connected yet, the window bounds what piles up
+            self._to_remote.append(data)
+        else:
+            try:
+                sent = self._sock.send(data)
+            except (OSError, IOError) as e:
+                if errno_from_exception(e) not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.destroy('error')
+                    return
+                sent = 0
+            if sent < len(data):
+                self._to_remote.append(data[sent:])
+        self._update()
+
+    def on_stream_reply(self, rep):
+        pass
+
+    def on_stream_drained(self):
+        self._update()
+
+    def on_stream_close(self):
+        # the local end is gone, the data it sent still goes out
+        if self._to_remote.size and self._sock is not None:
+            self._update()
+        else:
+            self.destroy('eof')
+
+    def _update(self):
+        if self._stage == STAGE_DESTROYED:
+            return
+        stream = self._stream
+        if self._uncredited and self._to_remote.size <= LOW_WATERMARK:
+            stream.consumed(self._uncredited)
+            self._uncredited = 0
+        if self._sock is None:
+            return
+        if stream.closed and not self._to_remote.size:
+            self.destroy('eof')
+            return
+        if stream.out_size >= HIGH_WATERMARK:
+            self._paused = True
+        elif stream.out_size <= LOW_WATERMARK:
+            self._paused = False
+        mode = POLL_ERR
+        if not self._paused and not stream.closed:
+            mode |= POLL_IN
+        if self._to_remote.size:
+            mode |= POLL_OUT
+        self._set_mode(self._sock, mode)
+
+    def _set_mode(self, sock, mode):
+        if self._mode is None:
+            self.loop.add(sock, mode, self)
+        elif self._mode != mode:
+            self.loop.modify(sock, mode)
+        self._mode = mode
+
+    def destroy(self, reason='closed'):
+        if self._stage == STAGE_DESTROYED:
+            return
+        server = self._server
+        server.remove_tunnel(self)
+        record_close(server, reason, 'mux:%d' % self._stream.id, self._remote_host,
+                     self._remote_port, self._bytes_up, self._bytes_down, self._start_time,
+                     self._connect_time, self._stage)
+        self._stage = STAGE_DESTROYED
+        self._timer.cancel()
+        server.dns_resolver.remove_callback(self._handle_dns_resolved)
+        for sock in (self._connecting, self._sock):
+            if sock is not None:
+                self.loop.remove(sock)
+                sock.close()
+        self._connecting = self._sock = None
+        self._stream.close()
+
+
+
+class _Recorder(object):
+    """A stream owner that writes down what it hears."""
+
+    def __init__(self):
+        self.events = []
+        self.data = b''
+
+    def on_stream_reply(self, rep):
+        self.events.append(('reply', rep))
+
+    def on_stream_data(self, data):
+        self.data += bytes(data)
+
+    def on_stream_close(self):
+        self.events.append(('close',))
+
+    def on_stream_drained(self):
+        pass
+
+
+def _tcp_pair():
+    listener = socket.create_server(('127.0.0.1', 0))
+    a = socket.create_connection(listener.getsockname())
+    b, _ = listener.accept()
+    listener.close()
+    return a, b
+
+
+def _run_until(loop, done, timeout=5):
+    deadline = loop.time() + timeout
+
+    def check():
+        if done() or loop.time() > deadline:
+            loop.stop()
+        else:
+            loop.call_later(0.001, check)
+    loop.call_later(0, check)
+    loop.run()
+
+
+def _accepting_session(loop):
+    """A session accepting streams, the peer's raw socket and the list
+    on_open() fills with (stream, address)."""
+    sock, peer = _tcp_pair()
+    opened = []
+
+    def on_open(stream, address):
+        stream.owner = _Recorder()
+        opened.append((stream, address))
+    return MuxSession(loop, sock, on_open=on_open), peer, opened
+
+
+def test_frames():
+    from event_loop import EventLoop
+    loop = EventLoop()
+    session, peer, opened = _accepting_session(loop)
+    address = common.add_header('10.0.0.1', 80)
+    # a header split across reads is picked up with the next one
+    frame = FRAME.pack(FRAME_OPEN, 0, 1, len(address)) + address
+    peer.send(frame[:3])
+    _run_until(loop, lambda: False, 0.05)
+    assert not opened
+    peer.send(frame[3:] + FRAME.pack(FRAME_DATA, 0, 1, 5) + b'hello')
+    _run_until(loop, lambda: opened and opened[0][0].owner.data)
+    stream, received = opened[0]
+    assert received == address and stream.owner.data == b'hello'
+    # and going out, REPLY ahead of DATA
+    stream.reply(common.REP_SUCCEEDED)
+    stream.write(b'world')
+    expected = FRAME.pack(FRAME_REPLY, 0, 1, 1) + b'\x00' + FRAME.pack(FRAME_DATA, 0, 1, 5) + b'world'
+    received = b''
+    while len(received) < len(expected):
+        received += peer.recv(1024)
+    assert received == expected
+    session.close()
+    peer.close()
+    loop.close()
+
+
+def test_window():
+    from event_loop import EventLoop
+    loop = EventLoop()
+    a, b = _tcp_pair()
+    opened = []
+
+    def on_open(stream, address):
+        stream.owner = _Recorder()
+        opened.append(stream)
+    client = MuxSession(loop, a)
+    server = MuxSession(loop, b, on_open=on_open)
+    owner = _Recorder()
+    stream = client.open_stream(owner, common.add_header('10.0.0.1', 80))
+    stream.write(b'x' * (INITIAL_WINDOW + 1000))
+    _run_until(loop, lambda: opened and len(opened[0].owner.data) >= INITIAL_WINDOW)
+    _run_until(loop, lambda: False, 0.05)
+    # the window is used up, the rest waits for credit
+    remote = opened[0]
+    assert len(remote.owner.data) == INITIAL_WINDOW
+    assert stream.send_window == 0 and stream.out_size == 1000
+    # credit below WINDOW_UPDATE is held back, then handed back at once
+    remote.consumed(WINDOW_UPDATE - 1)
+    assert remote.recv_window == 0
+    remote.consumed(1)
+    _run_until(loop, lambda: len(remote.owner.data) == INITIAL_WINDOW + 1000)
+    assert stream.send_window == WINDOW_UPDATE - 1000 and not stream.out_size
+    # closing reaches the other end's owner
+    stream.close()
+    _run_until(loop, lambda: remote.owner.events)
+    assert remote.owner.events == [('close',)] and not server.streams
+    client.close()
+    server.close()
+    loop.close()
+
+
+def test_bad_frames():
+    from event_loop import EventLoop
+    loop = EventLoop()
+    address = common.add_header('10.0.0.1', 80)
+    open_frame = FRAME.pack(FRAME_OPEN, 0, 1, len(address)) + address
+    # data past the window the stream was given
+    session, peer, opened = _accepting_session(loop)
+    chunk = FRAME.pack(FRAME_DATA, 0, 1, MAX_FRAME_DATA) + b'x' * MAX_FRAME_DATA
+    sender = threading.Thread(target=peer.sendall, args=(
+        open_frame + chunk * (INITIAL_WINDOW // MAX_FRAME_DATA + 1),))
+    sender.start()
+    _run_until(loop, lambda: session.closed)
+    sender.join()
+    stream = opened[0][0]
+    assert session.closed and stream.closed and stream.owner.events == [('close',)]
+    assert len(stream.owner.data) == INITIAL_WINDOW
+    peer.close()
+    # an unknown frame type, and a compressed frame that doesn't inflate
+    for frame in (FRAME.pack(9, 0, 1, 0),
+                  FRAME.pack(FRAME_DATA, FLAG_DEFLATE, 1, 4) + b'\xff' * 4):
+        session, peer, opened = _accepting_session(loop)
+        peer.send(open_frame + frame)
+        _run_until(loop, lambda: session.closed)
+        assert session.closed and opened[0][0].owner.events == [('close',)]
+        peer.close()
+    loop.close()
+
+
+if __name__ == '__main__':
+    test_frames()
+    test_window()
+    test_bad_frames()
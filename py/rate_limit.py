@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Token bucket rate limits and a per loop iteration read budget.
+
+Limits count the stream bytes a tunnel reads from either of its sockets.
+A tunnel reads while every bucket it draws from (its own, its client
+ip's, the global one) has tokens and it has read budget left in the
+current loop iteration. A spent budget only skips the read, the socket
+stays polled and is read after the next poll. A dry bucket makes the
+side that wanted to read stop polling for input and a timer resumes it
+once enough tokens are back, so a throttled tunnel costs nothing until
+then.
+"""
+
+# a drained bucket is waited on until it holds this much again, refills
+# don't turn into a stream of tiny reads
+MIN_READ = 4096
+# a bucket holds a second worth of its rate
+BURST_SECONDS = 1.0
+# a throttled side waits at least this long, at high rates MIN_READ comes
+# back within microseconds and every wait costs two epoll_ctl calls
+MIN_DELAY = 0.001
+
+
+class TokenBucket(object):
+    def __init__(self, rate, now):
+        self.rate = float(rate)
+        self.burst = max(rate * BURST_SECONDS, MIN_READ)
+        self.tokens = self.burst
+        self.users = 0
+        self._stamp = now
+
+    def refill(self, now):
+        if now > self._stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+        return self.tokens
+
+    def delay(self, amount):
+        """Seconds from the last refill until amount tokens are there."""
+        return max(0.0, (min(amount, self.burst) - self.tokens) / self.rate)
+
+
+class TunnelLimit(object):
+    """One tunnel's share: its buckets and its read budget per iteration."""
+
+    def __init__(self, limiter, buckets, ip):
+        self._limiter = limiter
+        self._buckets = buckets
+        self._ip = ip
+        self._iteration = -1
+        self._used = 0
+
+    def allowance(self, iteration, now):
+        """Bytes the tunnel may read right now."""
+        if iteration != self._iteration:
+            self._iteration = iteration
+            self._used = 0
+        allowance = self._limiter.read_budget - self._used
+        for bucket in self._buckets:
+            allowance = min(allowance, int(bucket.refill(now)))
+        return allowance
+
+    def consume(self, n):
+        self._used += n
+        for bucket in self._buckets:
+            bucket.tokens -= n
+
+    def delay(self):
+        """Seconds until reading is worth another try, 0 when only the
+        iteration budget ran out."""
+        delays = [bucket.delay(MIN_READ) for bucket in self._buckets if bucket.tokens < 1]
+        return max(delays + [MIN_DELAY]) if delays else 0.0
+
+    def release(self):
+        self._limiter.release(self._ip)
+
+
+class RateLimiter(object):
+    """Rates in bytes per second, None for no limit. The global bucket is
+    per process, with several workers each gets the full rate."""
+
+    def __init__(self, read_budget, tunnel_rate=None, client_rate=None, global_rate=None):
+        # type: (int,int,int,int) -> None
+        self.read_budget = read_budget
+        self._tunnel_rate = tunnel_rate
+        self._client_rate = client_rate
+        self._global_rate = global_rate
+        self._global = None  # type: TokenBucket
+        self._clients = {}  # ip -> TokenBucket shared by its tunnels
+
+    def tunnel_limit(self, ip, now):
+        buckets = []
+        if self._tunnel_rate:
+            buckets.append(TokenBucket(self._tunnel_rate, now))
+        if self._client_rate:
+            bucket = self._clients.get(ip)
+            if bucket is None:
+                bucket = self._clients[ip] = TokenBucket(self._client_rate, now)
+            bucket.users += 1
+            buckets.append(bucket)
+        if self._global_rate:
+            if self._global is None:
+                self._global = TokenBucket(self._global_rate, now)
+            buckets.append(self._global)
+        return TunnelLimit(self, buckets, ip)
+
+    def release(self, ip):
+        bucket = self._clients.get(ip)
+        if bucket is not None:
+            bucket.users -= 1
+            if not bucket.users:
+                del self._clients[ip]
+
+
+def test_rate_limiter():
+    budget = 32 * 1024
+    limiter = RateLimiter(budget, tunnel_rate=100000, client_rate=150000)
+    a = limiter.tunnel_limit('10.0.0.1', 0.0)
+    b = limiter.tunnel_limit('10.0.0.1', 0.0)
+    # the read budget caps one iteration, the next one starts afresh
+    assert a.allowance(1, 0.0) == budget
+    a.consume(budget)
+    assert a.allowance(1, 0.0) == 0 and a.delay() == 0.0
+    for iteration in (2, 3):
+        assert a.allowance(iteration, 0.0) == budget
+        a.consume(budget)
+    assert a.allowance(4, 0.0) == 100000 - 3 * budget
+    a.consume(100000 - 3 * budget)
+    # the tunnel's own bucket is dry, it waits for MIN_READ tokens
+    assert a.allowance(5, 0.0) == 0
+    assert abs(a.delay() - MIN_READ / 100000.0) < 1e-9
+    # b has its own bucket but shares the client's, which a drained
+    b.consume(b.allowance(1, 0.0))
+    assert b.allowance(2, 0.0) == 150000 - 100000 - budget
+    assert b.allowance(3, 0.2) == budget
+    a.release()
+    b.release()
+    assert not limiter._clients
+    # a fast bucket still keeps a dry tunnel waiting for a tick
+    fast = RateLimiter(budget, tunnel_rate=10 ** 9).tunnel_limit('10.0.0.2', 0.0)
+    fast.consume(10 ** 9)
+    assert fast.delay() == MIN_DELAY
+
+
+if __name__ == '__main__':
+    test_rate_limiter()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import errno
+import itertools
+from collections import deque
+
+from utils import errno_from_exception
+
+# per direction: stop reading the source once this much is queued for the
+# other side, resume when the queue has drained below the low mark
+HIGH_WATERMARK = 256 * 1024
+LOW_WATERMARK = 64 * 1024
+# how many queued chunks one sendmsg() call gathers
+IOV_BATCH = 64
+
+
+class SendQueue(object):
+    __slots__ = ('chunks', 'size')
+
+    def __init__(self):
+        self.chunks = deque()
+        self.size = 0
+
+    def append(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+
+    def flush(self, sock):
+        """Send as much as the socket takes, returns True once empty."""
+        chunks = self.chunks
+        while chunks:
+            try:
+                if hasattr(sock, 'sendmsg'):
+                    batch = list(itertools.islice(chunks, IOV_BATCH))
+                    n = sock.sendmsg(batch)
+                else:
+                    batch = [chunks[0]]
+                    n = sock.send(chunks[0])
+            except (OSError, IOError) as e:
+                if errno_from_exception(e) in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+            self.size -= n
+            full = n < sum(len(c) for c in batch)
+            while n:
+                head = chunks[0]
+                if n >= len(head):
+                    n -= len(head)
+                    chunks.popleft()
+                else:
+                    chunks[0] = memoryview(head)[n:]
+                    n = 0
+            if full:
+                return False
+        return True
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+import errno
+import json
+import logging
+import mmap
+import struct
+
+import common
+from event_loop import POLL_ERR, POLL_IN, POLL_OUT
+from utils import create_server_socket, errno_from_exception
+
+COUNTERS = ('accepts', 'tunnels_closed', 'connect_failures', 'dns_failures',
+            'timeouts', 'acl_denied', 'shed', 'http_requests', 'pool_hits',
+            'mux_streams', 'compression_saved', 'bytes_up', 'bytes_down')
+# where a tunnel is, the same for every engine and for mux streams
+STAGE_INIT = 0
+STAGE_ADDR = 1
+STAGE_UDP_ASSOC = 2
+STAGE_DNS = 3
+STAGE_CONNECTING = 4
+STAGE_STREAM = 5
+STAGE_DESTROYED = -1
+# indexed by STAGE_*
+STAGES = ('init', 'addr', 'udp_assoc', 'dns', 'connecting', 'stream')
+GAUGES = tuple('tunnels_' + stage for stage in STAGES) + ('queued_bytes',)
+FIELDS = COUNTERS + GAUGES
+
+# tunnel close reasons that have their own counter
+REASON_COUNTERS = {
+    'connect': 'connect_failures',
+    'dns': 'dns_failures',
+    'timeout': 'timeouts',
+    'forbidden': 'acl_denied',
+}
+
+# workers copy their values into the shared slots this often
+PUBLISH_INTERVAL = 1
+REQUEST_TIMEOUT = 5
+EMFILE_BACKOFF = 0.1
+MAX_REQUEST_SIZE = 4096
+
+
+class Stats(object):
+    """Plain attribute counters, bumped by the loop without any locking.
+
+    Gauges are not maintained on the hot path, each callable in sources
+    adds its live values to a snapshot when one is taken.
+    """
+
+    def __init__(self):
+        for name in COUNTERS:
+            setattr(self, name, 0)
+        self.sources = []
+
+    def snapshot(self):
+        values = dict((name, getattr(self, name)) for name in COUNTERS)
+        values.update((name, 0) for name in GAUGES)
+        for source in self.sources:
+            source(values)
+        return values
+
+    def count_closed(self, reason, bytes_up, bytes_down):
+        self.tunnels_closed += 1
+        self.bytes_up += bytes_up
+        self.bytes_down += bytes_down
+        if reason in REASON_COUNTERS:
+            name = REASON_COUNTERS[reason]
+            setattr(self, name, getattr(self, name) + 1)
+
+
+def collect_tunnels(tunnels, values):
+    """A Stats source: the stage gauges, bytes and queued bytes of the
+    open tunnels, anything with a stat_values()."""
+    for tunnel in tunnels:
+        stage, bytes_up, bytes_down, queued = tunnel.stat_values()
+        values['tunnels_' + STAGES[stage]] += 1
+        values['bytes_up'] += bytes_up
+        values['bytes_down'] += bytes_down
+        values['queued_bytes'] += queued
+
+
+def record_close(server, reason, client, remote_host, remote_port, bytes_up, bytes_down,
+                 start_time, connect_time, stage):
+    """Count a closed tunnel in server.stats and write its access log
+    line, for TCPEvent and StreamTunnel alike."""
+    server.stats.count_closed(reason, bytes_up, bytes_down)
+    access_log = server.access_log
+    if access_log:
+        connect_ms = None
+        if connect_time is not None:
+            connect_ms = int((connect_time - start_time) * 1000)
+        destination = None
+        if remote_host is not None:
+            destination = '%s:%d' % (common.to_str(remote_host), remote_port)
+        access_log.log((client, destination, bytes_up, bytes_down, connect_ms,
+                        int((server.loop.time() - start_time) * 1000), stage, reason))
+
+
+class SharedStats(object):
+    """One slot of FIELDS per worker in an anonymous shared mapping.
+
+    Created by the supervisor before forking; each worker only writes its
+    own slot and readers sum all of them. Reads are not synchronised with
+    writes, a sum may mix two publishes of one worker.
+    """
+
+    _struct = struct.Struct('=%dq' % len(FIELDS))
+
+    def __init__(self, slots):
+        self._slots = slots
+        self._mmap = mmap.mmap(-1, self._struct.size * slots)
+
+    def publish(self, index, values):
+        self._struct.pack_into(self._mmap, index * self._struct.size,
+                               *[values[name] for name in FIELDS])
+
+    def aggregate(self):
+        total = dict.fromkeys(FIELDS, 0)
+        for index in range(self._slots):
+            slot = self._struct.unpack_from(self._mmap,
+                                            index * self._struct.size)
+            for name, value in zip(FIELDS, slot):
+                total[name] += value
+        return total
+
+
+def to_json(values):
+    return json.dumps(values, sort_keys=True) + '\n'
+
+
+def to_prometheus(values):
+    lines = []
+    for name in COUNTERS:
+        lines.append('# TYPE socks_%s_total counter' % name)
+        lines.append('socks_%s_total %d' % (name, values[name]))
+    lines.append('# TYPE socks_tunnels gauge')
+    for stage in STAGES:
+        lines.append('socks_tunnels{stage="%s"} %d' %
+                     (stage, values['tunnels_' + stage]))
+    lines.append('# TYPE socks_queued_bytes gauge')
+    lines.append('socks_queued_bytes %d' % values['queued_bytes'])
+    return '\n'.join(lines) + '\n'
+
+
+class AdminServer(object):
+    """HTTP on localhost: GET /stats (json) and GET /metrics (prometheus).
+
+    With a SharedStats every worker binds the port with SO_REUSEPORT and
+    answers with the sum over all workers. GET /profile is the event loop
+    profile of whichever worker answers, when profiling is on.
+    """
+
+    def __init__(self, stats, port, shared=None, index=0, sock=None):
+        self._stats = stats
+        self._shared = shared
+        self._index = index
+        self._loop = None
+        self._timer = None
+        # sock: an already listening socket, taken over from an old process
+        self._sock = sock or create_server_socket('127.0.0.1', port,
+                                                  shared is not None)
+
+    @property
+    def sock(self):
+        return self._sock
+
+    def add_to_loop(self, loop):
+        self._loop = loop
+        loop.add(self._sock, POLL_IN | POLL_ERR, self)
+        if self._shared:
+            self._publish()
+
+    def _publish(self):
+        self._shared.publish(self._index, self._stats.snapshot())
+        self._timer = self._loop.call_later(PUBLISH_INTERVAL, self._publish)
+
+    def values(self):
+        if not self._shared:
+            return self._stats.snapshot()
+        self._shared.publish(self._index, self._stats.snapshot())
+        return self._shared.aggregate()
+
+    def render(self, path):
+        if path == '/metrics':
+            return 'text/plain; version=0.0.4', to_prometheus(self.values())
+        elif path in ('/', '/stats'):
+            return 'application/json', to_json(self.values())
+        elif path == '/profile' and self._loop and self._loop.profiler:
+            return 'application/json', to_json(self._loop.profiler.to_dict())
+        return None
+
+    def handle_event(self, sock, fd, mode):
+        try:
+            conn, addr = sock.accept()
+        except (OSError, IOError) as e:
+            error_no = errno_from_exception(e)
+            if error_no in (errno.EMFILE, errno.ENFILE):
+                # the request stays queued, look again once fds are back
+                # instead of spinning on a readable listener
+                self._loop.modify(sock, POLL_ERR)
+                self._loop.call_later(EMFILE_BACKOFF, self._resume)
+            elif error_no not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                logging.error('admin accept: %s', e)
+            return
+        _AdminConnection(self, self._loop, conn)
+
+    def _resume(self):
+        if self._loop:
+            self._loop.modify(self._sock, POLL_IN | POLL_ERR)
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._loop:
+            self._loop.remove(self._sock)
+            self._loop = None
+        self._sock.close()
+
+
+class _AdminConnection(object):
+    def __init__(self, server, loop, sock):
+        sock.setblocking(False)
+        self._server = server
+        self._loop = loop
+        self._sock = sock
+        self._request = b''
+        self._response = None
+        loop.add(sock, POLL_IN | POLL_ERR, self)
+        self._timer = loop.call_later(REQUEST_TIMEOUT, self.close)
+
+    def _respond(self):
+        parts = self._request.split(b'\r\n', 1)[0].split()
+        body = None
+        if len(parts) >= 2 and parts[0] == b'GET':
+            body = self._server.render(parts[1].decode('latin-1').split('?')[0])
+        if body is None:
+            status, content_type, body = '404 Not Found', 'text/plain', 'not found\n'
+        else:
+            status = '200 OK'
+            content_type, body = body
+        body = body.encode('utf-8')
+        self._response = ('HTTP/1.0 %s\r\nContent-Type: %s\r\n'
+                          'Content-Length: %d\r\nConnection: close\r\n\r\n' %
+                          (status, content_type, len(body))).encode('latin-1') + body
+        self._loop.modify(self._sock, POLL_OUT | POLL_ERR)
+
+    def handle_event(self, sock, fd, mode):
+        try:
+            if mode & POLL_IN and self._response is None:
+                data = sock.recv(MAX_REQUEST_SIZE)
+                if not data:
+                    self.close()
+                    return
+                self._request += data
+                if b'\r\n\r\n' in self._request or \
+                        len(self._request) >= MAX_REQUEST_SIZE:
+                    self._respond()
+            elif mode & POLL_OUT and self._response:
+                self._response = self._response[sock.send(self._response):]
+                if not self._response:
+                    self.close()
+            elif mode & POLL_ERR:
+                self.close()
+        except (OSError, IOError) as e:
+            if errno_from_exception(e) not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.close()
+
+    def close(self):
+        if self._sock is None:
+            return
+        self._timer.cancel()
+        self._loop.remove(self._sock)
+        self._sock.close()
+        self._sock = None
@@ -1,38 +1,269 @@
 # -*- coding: utf-8 -*-
+import errno
+import functools
 import logging
+import os
+import random
+import resource
+import signal
 import socket
+import struct
+import sys
+import threading
+import time
 
+import asyncio_engine
 import common
-from common import parse_header
-from event_loop import EventLoop, POLL_ERR, POLL_IN, POLL_OUT
-from utils import create_remote_socket, create_server_socket
+from access_log import AccessLog
+from asyncdns import DNSResolver
+from common import CMD_CONNECT, CMD_UDP_ASSOCIATE, CONNECT_ERRNO_REPLIES, METHOD_NO_AUTH, \
+    SOCKS_VERSION, parse_header_from, socks5_request_length
+from event_loop import EVENT_MODELS, EventLoop, POLL_ERR, POLL_HUP, POLL_IN, POLL_OUT
+from handoff import HandoffServer, receive_sockets
+from http_proxy import MAX_HEAD_SIZE, HTTPProxyEvent, error_response
+from loop_profile import DEFAULT_SAMPLE_EVERY, DEFAULT_SLOW_THRESHOLD, LoopProfiler
+from mux import DEFAULT_CONNECTIONS, MuxClient, MuxServer, MuxStream
+from rate_limit import RateLimiter, TunnelLimit
+from send_queue import HIGH_WATERMARK, LOW_WATERMARK, SendQueue
+from stats import STAGE_ADDR, STAGE_CONNECTING, STAGE_DESTROYED, STAGE_DNS, STAGE_INIT, \
+    STAGE_STREAM, STAGE_UDP_ASSOC, AdminServer, SharedStats, Stats, collect_tunnels, \
+    record_close
+from udp_event import UDPAssociation
+from upstream_pool import UpstreamPool
+from utils import create_remote_socket, create_server_socket, parse_request_line, \
+    parse_request_target, parse_size, read_cidr_list, errno_from_exception
 
-BUF_SIZE = 4 * 1024
-STAGE_INIT = 0
-STAGE_ADDR = 1
-STAGE_UDP_ASSOC = 2
-STAGE_DNS = 3
-STAGE_CONNECTING = 4
-STAGE_STREAM = 5
-STAGE_DESTROYED = -1
+BUF_SIZE = 32 * 1024
+
+ENGINES = ('event_loop', 'asyncio')
+
+# accepts per listener wakeup, so a connection storm doesn't turn into
+# one poll() per connection
+ACCEPT_BATCH = 64
+# fds kept free for the loop, resolver, logs etc. when deriving the
+# default tunnel cap from RLIMIT_NOFILE; a tunnel holds two sockets
+FD_RESERVE = 64
+FDS_PER_TUNNEL = 2
+# after running out of fds the listener sleeps this long
+EMFILE_BACKOFF = 0.1
+
+# hot restart: how long the old process keeps serving open tunnels, and
+# how often it looks whether they are all gone
+DRAIN_TIMEOUT = 60
+DRAIN_CHECK_INTERVAL = 0.5
+
+# seconds a tunnel may stay in a stage; the stream timeout counts from the
+# last relayed byte, the others from entering the stage
+STAGE_TIMEOUTS = {
+    STAGE_INIT: 10,
+    STAGE_ADDR: 10,
+    STAGE_UDP_ASSOC: 300,
+    STAGE_DNS: 10,
+    STAGE_CONNECTING: 10,
+    STAGE_STREAM: 300,
+}
+
+# which side of a tunnel a rate limit stopped reading
+THROTTLE_LOCAL = 1
+THROTTLE_REMOTE = 2
+
+# rfc8305 "Connection Attempt Delay": how long one connect attempt gets
+# before the next address is tried in parallel
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+# with --http, a client opening with this gets a tunnel like a socks one,
+# answered in http
+HTTP_CONNECT = b'CONNECT '
+HTTP_ESTABLISHED = b'HTTP/1.1 200 Connection established\r\n\r\n'
+# by close reason, anything else is a 502
+HTTP_ERROR_STATUS = {
+    'forbidden': '403 Forbidden',
+    'protocol': '400 Bad Request',
+    'timeout': '504 Gateway Timeout',
+}
+
+# every read lands in this buffer first, the loop is single threaded so all
+# tunnels share it and only bytes the peer can't take yet get copied out
+_recv_buf = bytearray(BUF_SIZE)
+_recv_view = memoryview(_recv_buf)
+
+# splice() moves stream data socket -> pipe -> socket inside the kernel,
+# one pipe per direction, so relayed bytes never become python objects
+SPLICE_SUPPORTED = hasattr(os, 'splice')
+PIPE_SIZE = 64 * 1024
+
+
+class _SplicePipe(object):
+    def __init__(self):
+        self.r, self.w = os.pipe()
+        os.set_blocking(self.r, False)
+        os.set_blocking(self.w, False)
+        self.pending = 0
+
+    def fill(self, src_fd):
+        """Move bytes from src_fd into the pipe, returns 0 on EOF."""
+        if self.pending:
+            return None
+        try:
+            n = os.splice(src_fd, self.w, PIPE_SIZE,
+                          flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            return None
+        self.pending += n
+        return n
+
+    def drain(self, dst_fd):
+        while self.pending:
+            try:
+                n = os.splice(self.r, dst_fd, self.pending,
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                return
+            self.pending -= n
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
 
 
 class TCPEvent(object):
+    # a proxy holds one of these per tunnel, most of them idle, so they
+    # carry no __dict__ and nothing is allocated until it is needed
+    __slots__ = ('_server', '_local_sock', '_remote_sock', 'loop', '_dns_resolver',
+                 '_remote_host', '_remote_port', '_remote_addrs', '_connecting',
+                 '_attempt_timer', '_connect_errno', '_use_splice', '_trace', '_pipes',
+                 '_udp', '_stream', '_uncredited', '_local_mode', '_remote_mode',
+                 '_client_address', '_limit', '_throttled', '_throttle_timer',
+                 '_handshake', '_to_remote', '_to_local', '_local_paused',
+                 '_remote_paused', '_stage', '_bytes_up', '_bytes_down', '_start_time',
+                 '_last_activity', '_connect_time', '_timer', '_http', '_remote_eof')
 
-    def __init__(self, local_sock, loop):
-        # type: (socket.socket,EventLoop) -> None
+    def __init__(self, server, local_sock):
+        # type: (TCPServerEvent,socket.socket) -> None
         local_sock.setblocking(False)
         local_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        self._server = server
         self._local_sock = local_sock
         self._remote_sock = None  # type: socket.socket
-        self.loop = loop
+        self.loop = loop = server.loop
+        self._dns_resolver = server.dns_resolver
+        self._remote_host = None
+        self._remote_port = None
+        self._remote_addrs = None  # addresses left to try
+        self._connecting = None  # attempt sock -> ip
+        self._attempt_timer = None
+        self._connect_errno = None
+        config = server.config
+        # spliced bytes never pass through here to be counted
+        self._use_splice = SPLICE_SUPPORTED and config.get('splice', False) and \
+            server.rate_limiter is None
+        # per-packet tracing costs a log call per recv/send, so it is only
+        # done for a sample of tunnels and only with debug logging on
+        trace_sample = config.get('trace_sample', 0)
+        self._trace = trace_sample > 0 and random.random() < trace_sample and \
+            logging.getLogger().isEnabledFor(logging.DEBUG)
+        self._pipes = None  # (local -> remote, remote -> local)
+        self._udp = None  # type: UDPAssociation
+        self._stream = None  # type: MuxStream
+        self._uncredited = 0  # bytes off the stream not yet credited back
         self.loop.add(local_sock, POLL_IN | POLL_ERR, self)
+        self._local_mode = POLL_IN | POLL_ERR
+        self._remote_mode = None
         self._client_address = local_sock.getpeername()[:2]
-        self.req_data = bytes()
-        self.recv_data = bytes()
+        self._limit = None  # type: TunnelLimit
+        if server.rate_limiter:
+            self._limit = server.rate_limiter.tunnel_limit(self._client_address[0], loop.time())
+        self._throttled = 0  # THROTTLE_* bits
+        self._throttle_timer = None
+        self._handshake = None  # bytearray holding a partial greeting/request
+        self._http = False  # an http CONNECT rather than socks
+        # queues only exist while a socket has data it didn't take yet
+        self._to_remote = None  # type: SendQueue
+        self._to_local = None  # type: SendQueue
+        self._local_paused = False
+        self._remote_paused = False
+        self._remote_eof = False  # remote closed, what it sent is being flushed
         self._stage = STAGE_INIT
+        self._bytes_up = 0
+        self._bytes_down = 0
+        self._start_time = self._last_activity = loop.time()
+        self._connect_time = None
+        self._timer = loop.call_later(STAGE_TIMEOUTS[STAGE_INIT], self._on_timeout)
+        server.tunnels.add(self)
+
+    def stat_values(self):
+        queued = 0
+        for queue in (self._to_remote, self._to_local):
+            if queue:
+                queued += queue.size
+        if self._stream:
+            queued += self._stream.out_size
+        if self._pipes:
+            queued += self._pipes[0].pending + self._pipes[1].pending
+        return self._stage, self._bytes_up, self._bytes_down, queued
 
-    def destroy(self):
+    def _set_stage(self, stage):
+        self._stage = stage
+        self._last_activity = self.loop.time()
+        self._timer.cancel()
+        self._timer = self.loop.call_later(STAGE_TIMEOUTS[stage], self._on_timeout)
+
+    def udp_activity(self, up, down):
+        self._bytes_up += up
+        self._bytes_down += down
+        self._last_activity = self.loop.time()
+
+    def _update_activity(self):
+        # the armed timer is not touched here, _on_timeout re-arms it for
+        # whatever is left when it fires
+        self._last_activity = self.loop.time()
+
+    def _on_timeout(self):
+        if self._stage == STAGE_DESTROYED:
+            return
+        remaining = self._last_activity + STAGE_TIMEOUTS[self._stage] - self.loop.time()
+        if remaining > 0:
+            self._timer = self.loop.call_later(remaining, self._on_timeout)
+            return
+        logging.debug("timed out in stage %d from %s:%d", self._stage,
+                      self._client_address[0], self._client_address[1])
+        if self._stage in (STAGE_DNS, STAGE_CONNECTING):
+            self._reply_error(common.REP_HOST_UNREACHABLE, 'timeout')
+        else:
+            self.destroy('timeout')
+
+    def _reply(self, rep, reason=None, bind_addr=('0.0.0.0', 0)):
+        if not self._http:
+            return common.socks5_reply(rep, bind_addr[0], bind_addr[1])
+        if rep == common.REP_SUCCEEDED:
+            return HTTP_ESTABLISHED
+        if rep == common.REP_NOT_ALLOWED:
+            return error_response(HTTP_ERROR_STATUS['forbidden'])
+        return error_response(HTTP_ERROR_STATUS.get(reason, '502 Bad Gateway'))
+
+    def _reply_error(self, rep, reason):
+        try:
+            self._local_sock.send(self._reply(rep, reason))
+        except (OSError, IOError):
+            pass
+        self.destroy(reason)
+
+    def destroy(self, reason='closed'):
+        if self._stage == STAGE_DESTROYED:
+            return
+        server = self._server
+        server.remove_tunnel(self)
+        record_close(server, reason, '%s:%d' % self._client_address, self._remote_host,
+                     self._remote_port, self._bytes_up, self._bytes_down, self._start_time,
+                     self._connect_time, self._stage)
+        self._stage = STAGE_DESTROYED
+        self._timer.cancel()
+        if self._limit:
+            self._limit.release()
+            if self._throttle_timer:
+                self._throttle_timer.cancel()
+        self._dns_resolver.remove_callback(self._handle_dns_resolved)
+        self._close_attempts()
         if self._remote_sock:
             self.loop.remove(self._remote_sock)
             self._remote_sock.close()
@@ -41,139 +272,1006 @@ class TCPEvent(object):
             self.loop.remove(self._local_sock)
             self._local_sock.close()
             self._local_sock = None
+        if self._pipes:
+            for pipe in self._pipes:
+                pipe.close()
+            self._pipes = None
+        if self._udp:
+            self._udp.close()
+            self._udp = None
+        if self._stream:
+            self._stream.close()
+            self._stream = None
 
-    def _local_read(self):
+    def _local_read(self, mode):
         sock = self._local_sock
+        if self._limit and self._stage == STAGE_STREAM:
+            n = self._recv_limited(sock, THROTTLE_LOCAL, mode)
+            if n is None:
+                return
+        else:
+            n = sock.recv_into(_recv_buf)
+        if not n:
+            self.destroy('eof')
+            return
+        data = _recv_view[:n]
+        if self._trace:
+            logging.debug("local fd:%s read %d bytes", sock.fileno(), n)
+        if self._stage == STAGE_STREAM:
+            self._bytes_up += n
+            self._update_activity()
+            if self._stream:
+                self._stream.write(data)
+            else:
+                self.write_to_sock(data, self._remote_sock)
+            return
+        if self._stage in (STAGE_DNS, STAGE_CONNECTING):
+            self._bytes_up += n
+            self._queue_up(data)
+            return
+        if self._stage == STAGE_UDP_ASSOC:
+            # the control connection carries nothing after the request
+            return
+        if self._handshake:
+            # complete a fragment left over from an earlier read
+            self._handshake += data
+            data = memoryview(self._handshake)
+        offset = self._parse_handshake(data)
+        if offset is None:
+            return
+        if self._stage in (STAGE_INIT, STAGE_ADDR):
+            self._handshake = bytearray(data[offset:])
+        else:
+            self._handshake = None
+            if offset < len(data) and self._stage != STAGE_UDP_ASSOC:
+                # payload pipelined behind the request goes out on connect
+                self._bytes_up += len(data) - offset
+                self._queue_up(data[offset:])
+
+    def _queue_up(self, data):
+        # a stream takes data before its REPLY, the remote end holds it
+        # until it is connected
+        if self._stream:
+            self._stream.write(data)
+        else:
+            if not self._to_remote:
+                self._to_remote = SendQueue()
+            self._to_remote.append(data)
+
+    def _parse_handshake(self, data):
+        """Consume greeting and request from data, returns the offset of
+        the first unconsumed byte or None if the tunnel was closed."""
+        offset = 0
+        if self._stage == STAGE_INIT:
+            if len(data) < 2:
+                return offset
+            if data[0] != SOCKS_VERSION:
+                if self._server.upstream_pool is None or not ord('A') <= data[0] <= ord('Z'):
+                    self.destroy('protocol')
+                    return None
+                # an http method, not a socks greeting
+                if not HTTP_CONNECT.startswith(bytes(data[:len(HTTP_CONNECT)])):
+                    self._hand_over(HTTPProxyEvent, data)
+                    return None
+                if len(data) < len(HTTP_CONNECT):
+                    return offset
+                return self._parse_http_connect(data)
+            end = 2 + data[1]
+            if len(data) < end:
+                return offset
+            if METHOD_NO_AUTH not in data[2:end]:
+                self._local_sock.send(b'\x05\xff')
+                self.destroy('protocol')
+                return None
+            self.write_to_sock(b'\x05\x00', self._local_sock)
+            self._set_stage(STAGE_ADDR)
+            offset = end
+        length = socks5_request_length(data, offset)
+        if length is None:
+            return offset
+        if length < 0:
+            self._reply_error(common.REP_ADDRTYPE_NOT_SUPPORTED, 'protocol')
+            return None
+        if data[offset] != SOCKS_VERSION:
+            self.destroy('protocol')
+            return None
+        cmd = data[offset + 1]
+        if cmd not in (CMD_CONNECT, CMD_UDP_ASSOCIATE):
+            self._reply_error(common.REP_COMMAND_NOT_SUPPORTED, 'protocol')
+            return None
+        header_result = parse_header_from(data, offset + 3)
+        if not header_result:
+            self._reply_error(common.REP_GENERAL_FAILURE, 'protocol')
+            return None
+        addrtype, remote_addr, remote_port, header_length = header_result
+        forbidden_ip = self._server.forbidden_ip
+        if forbidden_ip and addrtype != common.ADDRTYPE_HOST and cmd == CMD_CONNECT and \
+                forbidden_ip.contains_packed(data[offset + 4:offset + length - 2]):
+            self._reply_error(common.REP_NOT_ALLOWED, 'forbidden')
+            return None
+        if cmd == CMD_UDP_ASSOCIATE:
+            self._start_udp_associate(remote_port)
+            return offset + length
+        self._start_connect(remote_addr, remote_port, data[offset + 3:offset + length])
+        return None if self._stage == STAGE_DESTROYED else offset + length
+
+    def _parse_http_connect(self, data):
+        """_parse_handshake() for a CONNECT request head."""
+        end = bytes(data).find(b'\r\n\r\n')
+        if end < 0:
+            if len(data) > MAX_HEAD_SIZE:
+                self._http = True
+                self._reply_error(common.REP_GENERAL_FAILURE, 'protocol')
+                return None
+            return 0
+        self._http = True
+        try:
+            method, target, version = parse_request_line(bytes(data[:end]).split(b'\r\n', 1)[0])
+            remote_addr, remote_port, _ = parse_request_target(method, target)
+            if not version.startswith(b'HTTP/1.'):
+                raise ValueError('unsupported version')
+        except ValueError as e:
+            logging.debug('bad http request from %s:%d: %s', self._client_address[0],
+                          self._client_address[1], e)
+            self._reply_error(common.REP_GENERAL_FAILURE, 'protocol')
+            return None
+        # headers (proxy-authorization and the like) are not looked at
+        self._start_connect(remote_addr, remote_port, common.add_header(remote_addr, remote_port))
+        return None if self._stage == STAGE_DESTROYED else end + 4
+
+    def _start_connect(self, remote_addr, remote_port, address):
+        # address: the socks form, what a mux stream is opened with
+        self._remote_host = remote_addr
+        self._remote_port = remote_port
+        if self._server.mux_client:
+            self._open_stream(address)
+            return
+        self._set_stage(STAGE_DNS)
+        self._dns_resolver.resolve_all(remote_addr, self._handle_dns_resolved)
+
+    def _start_udp_associate(self, client_port):
+        # datagrams are only taken from the control connection's peer,
+        # the relay socket listens on the address the client connected to
+        bind_ip = self._local_sock.getsockname()[0]
+        self._udp = UDPAssociation(self, self.loop, self._dns_resolver, bind_ip,
+                                   self._client_address[0], client_port,
+                                   self._server.forbidden_ip)
+        self._set_stage(STAGE_UDP_ASSOC)
+        bind_addr = self._udp.bind_address
+        self.write_to_sock(common.socks5_reply(common.REP_SUCCEEDED, bind_addr[0], bind_addr[1]),
+                           self._local_sock)
+
+    def _open_stream(self, address):
+        # the remote instance resolves and connects, its REPLY frame
+        # carries the outcome
         try:
-            data = sock.recv(BUF_SIZE)
+            self._stream = self._server.mux_client.open_stream(self, bytes(address))
         except (OSError, IOError) as e:
-            logging.exception(e)
+            logging.warning("mux connection failed: %s", e)
+            self._reply_error(common.REP_GENERAL_FAILURE, 'connect')
             return
-        if not data:
-            self.destroy()
+        self._server.stats.mux_streams += 1
+        self._set_stage(STAGE_CONNECTING)
+
+    def on_stream_reply(self, rep):
+        if self._stage != STAGE_CONNECTING:
             return
-        logging.info("recv local read len: %s", len(data))
-        if data == b'\x05\x01\x00':
-            self.write_to_sock(b'\x05\00', self._local_sock)
+        if rep != common.REP_SUCCEEDED:
+            self._reply_error(rep, 'connect')
             return
-        if b'\x05\x01\x00' == data[:3]:
-            data = data[3:]
-        if self._stage == STAGE_INIT:
-            self.req_data += data
-            logging.info("POLL_IN event fd:%s", sock.fileno())
-            header_result = parse_header(self.req_data)
-            if not header_result:
-                logging.error("[parse_header] error res:%s data:%s", header_result, self.req_data)
+        self._connect_time = self.loop.time()
+        self._set_stage(STAGE_STREAM)
+        self._stream_event(self.write_to_sock, self._reply(rep), self._local_sock)
+
+    def on_stream_data(self, data):
+        self._bytes_down += len(data)
+        self._uncredited += len(data)
+        self._update_activity()
+        self._stream_event(self.write_to_sock, data, self._local_sock)
+
+    def on_stream_drained(self):
+        self._update_modes()
+
+    def on_stream_close(self):
+        if self._stage == STAGE_CONNECTING:
+            self._reply_error(common.REP_GENERAL_FAILURE, 'connect')
+        elif not self._to_local:
+            self._stream = None
+            self.destroy('eof')
+        else:
+            # what the remote end sent before closing still goes out,
+            # handle_event closes the tunnel once it is flushed
+            self._update_modes()
+
+    def _stream_event(self, func, *args):
+        # stream callbacks run inside the mux connection's handler, a
+        # failing client socket must only take this tunnel down
+        try:
+            func(*args)
+        except (OSError, IOError) as e:
+            if self._trace:
+                logging.debug("tunnel from %s:%d failed: %s", self._client_address[0],
+                              self._client_address[1], e)
+            self.destroy('error')
+            return
+        self._update_modes()
+
+    def _hand_over(self, handler_class, data):
+        # the connection speaks something else, it stops being a tunnel
+        # here and isn't counted as one
+        sock, self._local_sock = self._local_sock, None
+        self.loop.remove(sock)
+        self._server.remove_tunnel(self)
+        self._timer.cancel()
+        self._stage = STAGE_DESTROYED
+        handler_class(self._server, sock, bytes(data))
+
+    def _handle_dns_resolved(self, result, error):
+        if self._stage != STAGE_DNS:
+            return
+        if error:
+            logging.debug("resolve %s failed: %s", result and result[0], error)
+            self._reply_error(common.REP_HOST_UNREACHABLE, 'dns')
+            return
+        remote_addr, ips = result
+        forbidden_ip = self._server.forbidden_ip
+        if forbidden_ip:
+            ips = [ip for ip in ips if ip not in forbidden_ip]
+            if not ips:
+                self._reply_error(common.REP_NOT_ALLOWED, 'forbidden')
                 return
-            self._stage = STAGE_STREAM
-            addrtype, remote_addr, remote_port, header_length = header_result
-            logging.info('connecting %s:%d from %s:%d header_len:%s' %
-                         (common.to_str(remote_addr), remote_port,
-                          self._client_address[0], self._client_address[1], header_length))
-            self.req_data = self.req_data[header_length:]
-            remote_sock = create_remote_socket(remote_addr, remote_port)
-            self._remote_sock = remote_sock
-            self.write_to_sock(b'\x05\x00\x00\x01\x00\x00\x00\x00\x10\x10', self._local_sock)
-            logging.info("connecting %s:%s from :%s", remote_addr, remote_port, self._client_address)
-            logging.info("remote_sock:%s local_sock:%s", self._remote_sock.fileno(), self._local_sock.fileno())
-            self.loop.add(remote_sock, POLL_OUT | POLL_ERR, self)
-        elif self._stage == STAGE_STREAM:
-            data = self.req_data + data
-            self.req_data = bytes()
-            self.write_to_sock(data, self._remote_sock)
-
-    def _remote_read(self):
-        sock = self._remote_sock
-        logging.info("remote_sock: remote:%s local:%s", self._remote_sock.getpeername(),
-                     self._remote_sock.getsockname())
-        data = sock.recv(BUF_SIZE)
-        logging.info("POLL_IN event fd:%s  len:%s", sock.fileno(), len(data))
-        if not data:
-            self.destroy()
+        self._remote_addrs = list(ips)
+        self._connecting = {}
+        self._set_stage(STAGE_CONNECTING)
+        self._start_next_attempt()
+
+    def _start_next_attempt(self):
+        if self._attempt_timer:
+            self._attempt_timer.cancel()
+            self._attempt_timer = None
+        while self._remote_addrs:
+            ip = self._remote_addrs.pop(0)
+            try:
+                sock = create_remote_socket(ip, self._remote_port)
+            except (OSError, IOError) as e:
+                self._connect_errno = errno_from_exception(e)
+                logging.debug("connect %s:%d failed: %s", common.to_str(ip), self._remote_port, e)
+                continue
+            self._connecting[sock] = ip
+            self.loop.add(sock, POLL_OUT | POLL_ERR, self)
+            if self._remote_addrs:
+                self._attempt_timer = self.loop.call_later(CONNECTION_ATTEMPT_DELAY, self._start_next_attempt)
+            return
+        if not self._connecting:
+            self._reply_error(CONNECT_ERRNO_REPLIES.get(self._connect_errno, common.REP_GENERAL_FAILURE),
+                              'connect')
+
+    def _on_connect_event(self, sock):
+        ip = self._connecting.pop(sock)
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.loop.remove(sock)
+            sock.close()
+            self._connect_errno = err
+            logging.debug("connect %s:%d failed: errno %d", common.to_str(ip), self._remote_port, err)
+            # a failed attempt hands over to the next address right away
+            self._start_next_attempt()
             return
-        self.write_to_sock(data, self._local_sock)
-        logging.info("recv_len:%s", len(data))
+        self._close_attempts()
+        self._remote_sock = sock
+        self._connect_time = self.loop.time()
+        self._set_stage(STAGE_STREAM)
+        self.write_to_sock(self._reply(common.REP_SUCCEEDED, bind_addr=sock.getsockname()),
+                           self._local_sock)
+        self._remote_mode = POLL_OUT | POLL_ERR
+        self._flush(sock)
 
-    def _remote_write(self):
+    def _close_attempts(self):
+        if self._attempt_timer:
+            self._attempt_timer.cancel()
+            self._attempt_timer = None
+        if self._connecting:
+            for sock in self._connecting:
+                self.loop.remove(sock)
+                sock.close()
+        self._connecting = None
+        self._remote_addrs = None
+
+    def _remote_read(self, mode):
         sock = self._remote_sock
-        if self.req_data:
-            data = self.req_data
-            self.req_data = bytes()
-            self.write_to_sock(data, sock)
+        if self._limit:
+            n = self._recv_limited(sock, THROTTLE_REMOTE, mode)
+            if n is None:
+                return
         else:
-            self.loop.modify(sock, POLL_IN | POLL_ERR)
+            n = sock.recv_into(_recv_buf)
+        if not n:
+            self._on_remote_eof(bool(self._to_local))
+            return
+        if self._trace:
+            logging.debug("remote fd:%s read %d bytes", sock.fileno(), n)
+        self._bytes_down += n
+        self._update_activity()
+        self.write_to_sock(_recv_view[:n], self._local_sock)
 
-    def _local_write(self):
-        sock = self._local_sock
-        data = self.recv_data
-        self.recv_data = bytes()
-        logging.info("data:%s recv_data:%s", len(data), len(self.req_data))
-        self.write_to_sock(data, sock)
+    def _on_remote_eof(self, pending):
+        if not pending:
+            self.destroy('eof')
+            return
+        # what the remote end sent before closing still goes out, the
+        # client isn't read anymore and handle_event closes the tunnel
+        # once the rest is flushed
+        self._remote_eof = True
+        self.loop.remove(self._remote_sock)
+        self._remote_sock.close()
+        self._remote_sock = None
+
+    def _recv_limited(self, sock, side, mode):
+        """recv_into() within the tunnel's rate limits and read budget,
+        at most what is left of the budget; None when there is no
+        allowance."""
+        limit, loop = self._limit, self.loop
+        allowance = limit.allowance(loop.iteration, loop.time())
+        if allowance <= 0 and not mode & POLL_IN:
+            # an error or hangup on the throttled side, it is read off
+            # over the limit or it would be reported on every poll
+            allowance = BUF_SIZE
+        elif allowance <= 0:
+            delay = limit.delay()
+            if not delay:
+                # only this iteration's budget is spent, the socket stays
+                # polled and is read after the next poll
+                return None
+            self._throttled |= side
+            if self._throttle_timer is None:
+                self._throttle_timer = loop.call_later(delay, self._unthrottle)
+            return None
+        n = sock.recv_into(_recv_buf, min(allowance, BUF_SIZE))
+        limit.consume(n)
+        return n
+
+    def _unthrottle(self):
+        self._throttle_timer = None
+        self._throttled = 0
+        if self._stage != STAGE_DESTROYED:
+            self._update_modes()
 
     def handle_event(self, sock, fd, mode):
         # type: (socket.socket,int,int) -> None
-        if mode & POLL_IN:
-            if sock == self._local_sock:
-                self._local_read()
-            elif sock == self._remote_sock:
-                self._remote_read()
-
-        if mode & POLL_OUT:
-            if sock == self._remote_sock:
-                self._remote_write()
-            elif sock == self._local_sock:
-                self._local_write()
+        try:
+            if self._connecting and sock in self._connecting:
+                self._on_connect_event(sock)
+            elif self._pipes:
+                self._splice_event(sock, mode)
+                return
+            else:
+                # errors and hangups are reported on sockets paused or
+                # throttled for input too, a read is what takes them off
+                if mode & (POLL_IN | POLL_ERR | POLL_HUP):
+                    if sock == self._local_sock:
+                        if not self._remote_eof:
+                            self._local_read(mode)
+                        elif mode & (POLL_ERR | POLL_HUP):
+                            # the client is gone before it got the rest
+                            self.destroy('error')
+                            return
+                    elif sock == self._remote_sock:
+                        self._remote_read(mode)
+                if mode & POLL_OUT and (sock == self._remote_sock or sock == self._local_sock):
+                    self._flush(sock)
+        except (OSError, IOError) as e:
+            if errno_from_exception(e) in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            if self._trace:
+                logging.debug("tunnel from %s:%d failed: %s", self._client_address[0],
+                              self._client_address[1], e)
+            self.destroy('error')
+            return
+        if self._stage == STAGE_DESTROYED:
+            return
+        if (self._remote_eof or self._stream and self._stream.closed) and not self._to_local:
+            self.destroy('eof')
+            return
+        # switch to splicing once the copied handshake data is flushed
+        if self._use_splice and self._stage == STAGE_STREAM and not self._stream and \
+                not self._to_remote and not self._to_local:
+            self._pipes = (_SplicePipe(), _SplicePipe())
+            self._update_splice_modes()
+            return
+        self._update_modes()
+
+    def _update_modes(self):
+        # pausing at the high and resuming at the low watermark keeps a
+        # slow peer from toggling the fast side on every event
+        to_remote = self._to_remote.size if self._to_remote else 0
+        to_local = self._to_local.size if self._to_local else 0
+        stream = self._stream
+        up_size = stream.out_size if stream else to_remote
+        if up_size >= HIGH_WATERMARK:
+            self._local_paused = True
+        elif up_size <= LOW_WATERMARK:
+            self._local_paused = False
+        if stream and self._uncredited and to_local <= LOW_WATERMARK:
+            # the stream's window stands in for pausing a remote socket
+            stream.consumed(self._uncredited)
+            self._uncredited = 0
+        if to_local >= HIGH_WATERMARK:
+            self._remote_paused = True
+        elif to_local <= LOW_WATERMARK:
+            self._remote_paused = False
+        mode = POLL_ERR
+        if not self._local_paused and not self._throttled & THROTTLE_LOCAL and \
+                not self._remote_eof:
+            mode |= POLL_IN
+        if to_local:
+            mode |= POLL_OUT
+        self._set_mode(self._local_sock, mode)
+        if self._remote_sock:
+            mode = POLL_ERR
+            if not self._remote_paused and not self._throttled & THROTTLE_REMOTE:
+                mode |= POLL_IN
+            if to_remote:
+                mode |= POLL_OUT
+            self._set_mode(self._remote_sock, mode)
+
+    def _set_mode(self, sock, mode):
+        if sock == self._local_sock:
+            if self._local_mode == mode:
+                return
+            self._local_mode = mode
+        else:
+            if self._remote_mode == mode:
+                return
+            self._remote_mode = mode
+        self.loop.modify(sock, mode)
+
+    def _splice_event(self, sock, mode):
+        up, down = self._pipes
+        local_fd = self._local_sock.fileno()
+        remote_fd = self._remote_sock.fileno() if self._remote_sock else None
+        try:
+            if mode & (POLL_ERR | POLL_HUP) and not mode & POLL_IN:
+                # a socket isn't polled for input while its pipe holds
+                # data, so an error can't be read off into the pipe
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) or errno.ECONNRESET
+                raise OSError(err, os.strerror(err))
+            if mode & POLL_IN:
+                if sock == self._local_sock and not self._remote_eof:
+                    n = up.fill(local_fd)
+                    if n == 0:
+                        self.destroy('eof')
+                        return
+                    self._bytes_up += n or 0
+                    up.drain(remote_fd)
+                elif sock == self._remote_sock:
+                    n = down.fill(remote_fd)
+                    if n == 0:
+                        self._on_remote_eof(down.pending)
+                        if self._remote_eof:
+                            down.drain(local_fd)
+                        else:
+                            return
+                    self._bytes_down += n or 0
+                    down.drain(local_fd)
+            if mode & POLL_OUT:
+                if sock == self._remote_sock:
+                    up.drain(remote_fd)
+                elif sock == self._local_sock:
+                    down.drain(local_fd)
+        except (OSError, IOError) as e:
+            if self._trace:
+                logging.debug("splice fd:%s failed: %s", sock.fileno(), e)
+            self.destroy('error')
+            return
+        if self._remote_eof and not down.pending:
+            self.destroy('eof')
+            return
+        self._update_activity()
+        self._update_splice_modes()
+
+    def _update_splice_modes(self):
+        # a socket is only read while its pipe is empty, so the pipe
+        # capacity bounds what one tunnel holds in the kernel
+        up, down = self._pipes
+        for sock, src, dst in ((self._local_sock, up, down),
+                               (self._remote_sock, down, up)):
+            if sock is None:
+                continue
+            mode = POLL_ERR
+            if not src.pending and not self._remote_eof:
+                mode |= POLL_IN
+            if dst.pending:
+                mode |= POLL_OUT
+            self._set_mode(sock, mode)
 
     def write_to_sock(self, data, sock):
+        """Send data to sock, queueing what it doesn't take right now.
+
+        Returns True if anything was left queued.
+        """
         if not data:
             return False
-        l = len(data)
-        s = sock.send(data)
-        uncomplete = False
-        if s < l:
+        to_local = sock == self._local_sock
+        queue = self._to_local if to_local else self._to_remote
+        if not queue:
+            # nothing queued ahead of it, send straight from the caller's
+            # buffer and only copy the remainder
+            try:
+                s = sock.send(data)
+            except (OSError, IOError) as e:
+                if errno_from_exception(e) not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                s = 0
+            if self._trace:
+                logging.debug("fd:%s sent %d of %d bytes", sock.fileno(), s, len(data))
+            if s == len(data):
+                return False
             data = data[s:]
-            uncomplete = True
-            self.loop.modify(sock, POLL_OUT | POLL_ERR)
-        logging.info("write_to_sock event fd:%s l:%s s:%s", sock.fileno(), l, s)
-
-        if uncomplete:
-            if sock == self._local_sock:
-                self.recv_data += data
+            queue = SendQueue()
+            if to_local:
+                self._to_local = queue
             else:
-                self.req_data += data
-        else:
-            if sock == self._local_sock:
-                logging.info("send to local complete: %s", len(data))
-            elif sock == self._remote_sock:
-                logging.info("send to remote complete: %s", len(data))
-        return uncomplete
+                self._to_remote = queue
+        queue.append(data)
+        return True
+
+    def _flush(self, sock):
+        # a drained queue is dropped, an idle tunnel holds no buffers
+        if sock == self._local_sock:
+            if self._to_local and self._to_local.flush(sock):
+                self._to_local = None
+        elif self._to_remote and self._to_remote.flush(sock):
+            self._to_remote = None
 
 
 class TCPServerEvent(object):
-    def __init__(self, port):
-        self.server_sock = create_server_socket('0.0.0.0', port)
+    def __init__(self, port, dns_resolver=None, config=None, server_sock=None):
+        # type: (int,DNSResolver,dict,socket.socket) -> None
+        self.dns_resolver = dns_resolver
+        self.config = config or {}
+        self.access_log = None  # type: AccessLog
+        # IPNetwork instances, built by the caller so forked workers share them
+        self.forbidden_ip = self.config.get('forbidden_ip')  # type: common.IPNetwork
+        self.allowed_clients = self.config.get('allowed_clients')  # type: common.IPNetwork
+        self.upstream_pool = None  # type: UpstreamPool
+        self.mux_client = None  # type: MuxClient
+        self.rate_limiter = None  # type: RateLimiter
+        if any(self.config.get(key) for key in ('rate_limit', 'client_rate_limit',
+                                                 'global_rate_limit', 'read_budget')):
+            self.rate_limiter = RateLimiter(self.config.get('read_budget') or BUF_SIZE,
+                                            self.config.get('rate_limit'),
+                                            self.config.get('client_rate_limit'),
+                                            self.config.get('global_rate_limit'))
+        self.tunnels = set()
+        self.http_connections = set()  # HTTPProxyEvent, handed over by tunnels
+        self.stats = Stats()
+        self.stats.sources.append(functools.partial(collect_tunnels, self.tunnels))
+        # server_sock: an already listening socket from a hot restart
+        self.server_sock = server_sock or create_server_socket(
+            '0.0.0.0', port, self.config.get('reuse_port', False))
+        self._accepting = True
+        self._paused = False
+        self.max_tunnels = self.config.get('max_tunnels') or _default_max_tunnels(self.config)
+        # held open only to be closed on EMFILE, so one pending connection
+        # can be accepted and shed instead of the listener spinning
+        self._spare_fd = os.open(os.devnull, os.O_RDONLY)
         logging.info("src fd:%s listing server port:%s", self.server_sock.fileno(), port)
         self.loop = None  # type: EventLoop
 
     def handle_event(self, sock, fd, mode):
         # type: (socket.socket,int,int) -> None
-        if sock == self.server_sock:
-            local_sock, addr = sock.accept()
-            logging.info("receive event fd:%s addr:%s", local_sock.fileno(), addr)
-            TCPEvent(local_sock, self.loop)
-        else:
+        if sock != self.server_sock:
             raise Exception("no this socket")
+        for _ in range(ACCEPT_BATCH):
+            if self.at_capacity():
+                # connections wait in the backlog until a tunnel closes
+                self._pause_accepting()
+                return
+            try:
+                local_sock, addr = sock.accept()
+            except (OSError, IOError) as e:
+                error_no = errno_from_exception(e)
+                if error_no in (errno.EMFILE, errno.ENFILE):
+                    self._shed()
+                elif error_no not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                      errno.ECONNABORTED, errno.EINTR):
+                    logging.error("accept: %s", e)
+                return
+            self.stats.accepts += 1
+            if self.allowed_clients and addr[0] not in self.allowed_clients:
+                self.stats.acl_denied += 1
+                local_sock.close()
+                continue
+            try:
+                TCPEvent(self, local_sock)
+            except (OSError, IOError) as e:
+                # reset before we got to it
+                logging.debug("dropping new connection: %s", e)
+                local_sock.close()
+
+    def _shed(self):
+        """Out of fds: accept one pending connection on the spare fd and
+        close it, then leave the listener alone for a moment."""
+        if self._spare_fd is not None:
+            os.close(self._spare_fd)
+            self._spare_fd = None
+            try:
+                conn, _ = self.server_sock.accept()
+                conn.close()
+                self.stats.shed += 1
+            except (OSError, IOError):
+                pass
+            try:
+                self._spare_fd = os.open(os.devnull, os.O_RDONLY)
+            except OSError:
+                pass
+        logging.warning("out of file descriptors with %d connections, shedding new ones",
+                        self._open_count())
+        self._pause_accepting()
+        self.loop.call_later(EMFILE_BACKOFF, self._resume_accepting)
+
+    def _pause_accepting(self):
+        if not self._paused and self._accepting:
+            self._paused = True
+            self.loop.modify(self.server_sock, POLL_ERR)
+
+    def _resume_accepting(self):
+        if self._paused and self._accepting and self._open_count() < self.max_tunnels:
+            self._paused = False
+            self.loop.modify(self.server_sock, POLL_IN | POLL_ERR)
+
+    def _open_count(self):
+        # each holds a client socket and maybe an upstream one either way,
+        # tunnels include the StreamTunnels of mux streams
+        return len(self.tunnels) + len(self.http_connections)
+
+    def at_capacity(self):
+        return self._open_count() >= self.max_tunnels
+
+    def remove_tunnel(self, tunnel):
+        self.tunnels.discard(tunnel)
+        if self._paused:
+            self._resume_accepting()
+
+    def remove_http_connection(self, connection):
+        self.http_connections.discard(connection)
+        if self._paused:
+            self._resume_accepting()
 
     def add_loop(self, loop):
         # type: (EventLoop) -> None
         self.loop = loop
+        if self.dns_resolver is None:
+            self.dns_resolver = DNSResolver()
+            self.dns_resolver.add_to_loop(loop)
+        if self.config.get('http_proxy'):
+            self.upstream_pool = UpstreamPool()
+            self.upstream_pool.add_to_loop(loop)
+        if self.config.get('upstream'):
+            self.mux_client = MuxClient(self.config['upstream'],
+                                        self.config.get('mux_connections') or DEFAULT_CONNECTIONS,
+                                        self.config.get('mux_key'),
+                                        self.config.get('mux_compress', False), self.stats)
+            self.mux_client.add_to_loop(loop)
+        if self.config.get('access_log'):
+            self.access_log = AccessLog(self.config['access_log'])
+            self.access_log.add_to_loop(loop)
         loop.add(self.server_sock, POLL_IN | POLL_ERR, self)
 
+    def stop_accepting(self):
+        if not self._accepting:
+            return
+        self._accepting = False
+        if self.loop:
+            self.loop.remove(self.server_sock)
+        self.server_sock.close()
+        if self._spare_fd is not None:
+            os.close(self._spare_fd)
+            self._spare_fd = None
 
-if __name__ == '__main__':
-    server_port = 1082
-    logging.basicConfig(level=logging.DEBUG,
-                        format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s')
+    def drain(self, timeout, on_drained):
+        """Stop accepting, let open tunnels finish for up to timeout
+        seconds, close the rest, then call on_drained()."""
+        self.stop_accepting()
+        deadline = self.loop.time() + timeout
+        logging.info("draining %d tunnels and %d http connections for up to %ds",
+                     len(self.tunnels), len(self.http_connections), timeout)
+        for connection in list(self.http_connections):
+            connection.drain()
+
+        def check():
+            if self._open_count() and self.loop.time() < deadline:
+                self.loop.call_later(DRAIN_CHECK_INTERVAL, check)
+                return
+            for tunnel in list(self.tunnels):
+                tunnel.destroy('restart')
+            for connection in list(self.http_connections):
+                connection.destroy()
+            on_drained()
+        check()
+
+    def close(self):
+        self.stop_accepting()
+        if self.upstream_pool:
+            self.upstream_pool.close()
+        if self.mux_client:
+            self.mux_client.close()
+        if self.access_log:
+            self.access_log.close()
+
+
+def _default_max_tunnels(config):
+    nofile = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if nofile == resource.RLIM_INFINITY:
+        return 1 << 20
+    fds_per_tunnel = FDS_PER_TUNNEL
+    if config.get('splice') and SPLICE_SUPPORTED:
+        fds_per_tunnel += 4  # a pipe per direction
+    return max(1, (nofile - FD_RESERVE) // fds_per_tunnel)
+
+
+def serve(port, config, worker_index=0, shared_stats=None):
+    # type: (int,dict,int,SharedStats) -> None
+    if config.get('engine') == 'asyncio':
+        asyncio_engine.serve(port, config)
+        return
+    loop = EventLoop(model=config.get('event_model'))
+    if config.get('loop_profile'):
+        loop.profiler = LoopProfiler(config['loop_profile'],
+                                     config.get('slow_callback', DEFAULT_SLOW_THRESHOLD))
+        loop.profiler.install()
+    dns_resolver = DNSResolver()
+    dns_resolver.add_to_loop(loop)
+    handoff_path = config.get('handoff')
+    inherited = handoff_path and receive_sockets(handoff_path) or {}
+    server = TCPServerEvent(port, dns_resolver, config, inherited.get('listen'))
+    server.add_loop(loop)
+    admin = None
+    if config.get('admin_port'):
+        admin = AdminServer(server.stats, config['admin_port'], shared_stats,
+                            worker_index, inherited.get('admin'))
+        admin.add_to_loop(loop)
+    mux_server = None
+    if config.get('mux_port'):
+        mux_server = MuxServer(server, config['mux_port'], inherited.get('mux'))
+        mux_server.add_to_loop(loop)
+    handoff = None
+    if handoff_path:
+        def get_sockets():
+            socks = {'listen': server.server_sock}
+            if admin:
+                socks['admin'] = admin.sock
+            if mux_server:
+                socks['mux'] = mux_server.sock
+            return socks
+
+        def on_handoff():
+            if admin:
+                admin.close()
+            if mux_server:
+                # open sessions keep serving their streams while draining
+                mux_server.stop_accepting()
+            server.drain(config.get('drain_timeout', DRAIN_TIMEOUT), loop.stop)
+        handoff = HandoffServer(handoff_path, get_sockets, on_handoff)
+        handoff.add_to_loop(loop)
+    # turn SIGTERM into SystemExit so buffered access log records get out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        loop.run()
+    finally:
+        if handoff:
+            handoff.close()
+        if admin:
+            admin.close()
+        if mux_server:
+            mux_server.close()
+        server.close()
+
+
+def _run_proxy(splice, client_main, sndbuf=None, timeout=10):
+    """Serve tunnels on this thread's loop until client_main(server,
+    origin) returns in another thread, returns what it returned."""
     loop = EventLoop()
-    TCPServerEvent(server_port).add_loop(loop)
+    server = TCPServerEvent(0, config={'splice': splice})
+    if sndbuf:
+        # accepted client sockets inherit it
+        server.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    server.add_loop(loop)
+    origin = socket.create_server(('127.0.0.1', 0))
+    result = []
+    client = threading.Thread(target=lambda: result.append(
+        client_main(server, origin)))
+    client.daemon = True
+    client.start()
+    deadline = loop.time() + timeout
+
+    def check():
+        if client.is_alive() and loop.time() < deadline:
+            loop.call_later(0.01, check)
+        else:
+            loop.stop()
+    loop.call_later(0, check)
     loop.run()
+    origin.close()
+    server.close()
+    loop.close()
+    return result[0] if result else None
+
+
+def _socks_connect(server, origin):
+    """A client tunnelled to origin through server, and origin's end
+    of it."""
+    client = socket.create_connection(('127.0.0.1', server.server_sock.getsockname()[1]))
+    client.sendall(b'\x05\x01\x00\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') +
+                   struct.pack('>H', origin.getsockname()[1]))
+    conn, _ = origin.accept()
+    reply = b''
+    while len(reply) < 12:  # method selection and connect reply
+        reply += client.recv(12 - len(reply))
+    return client, conn
+
+
+def _slow_download(server, origin):
+    """Whether a slow client gets all of a download the origin ends by
+    closing."""
+    size = 192 * 1024
+    client, conn = _socks_connect(server, origin)
+
+    def send():
+        conn.sendall(b'x' * size)
+        conn.close()
+    threading.Thread(target=send).start()
+    # the proxy reads the origin's eof with data still queued for the client
+    time.sleep(0.5)
+    received = 0
+    client.settimeout(5)
+    while True:
+        chunk = client.recv(65536)
+        if not chunk:
+            break
+        received += len(chunk)
+    client.close()
+    return received == size
+
+
+def test_remote_eof_drains():
+    # a slow client still gets what is queued for it when the origin closes
+    assert _run_proxy(False, _slow_download, sndbuf=4096)
+    if SPLICE_SUPPORTED:
+        assert _run_proxy(True, _slow_download, sndbuf=4096)
+
+
+def _reset_paused_origin(server, origin):
+    """Whether the tunnel closes when the origin resets while the proxy
+    has stopped reading it for a client that doesn't read."""
+    client, conn = _socks_connect(server, origin)
+    conn.setblocking(False)
+    chunk = b'x' * 65536
+    blocked = 0
+    while blocked < 10:
+        try:
+            conn.send(chunk)
+            blocked = 0
+        except BlockingIOError:
+            blocked += 1
+            time.sleep(0.02)
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    conn.close()
+    deadline = time.time() + 2
+    while server.tunnels and time.time() < deadline:
+        time.sleep(0.01)
+    client.close()
+    return not server.tunnels
+
+
+def test_reset_while_paused():
+    # errors are reported on sockets not polled for input too, they must
+    # close the tunnel rather than be reported on every poll
+    assert _run_proxy(False, _reset_paused_origin, sndbuf=4096)
+    if SPLICE_SUPPORTED:
+        assert _run_proxy(True, _reset_paused_origin, sndbuf=4096)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from workers import Supervisor
+
+    parser = argparse.ArgumentParser(description='socks5 proxy')
+    parser.add_argument('-p', '--port', type=int, default=1082)
+    parser.add_argument('--engine', choices=ENGINES, default='event_loop',
+                        help='event_loop (the default) or asyncio, uvloop if installed')
+    parser.add_argument('--event-model', choices=EVENT_MODELS,
+                        help='force an event loop backend')
+    parser.add_argument('--splice', action='store_true',
+                        help='relay established tunnels with splice() (linux)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='worker processes sharing the port via SO_REUSEPORT')
+    parser.add_argument('--http', action='store_true',
+                        help='also serve http proxy requests on the port, CONNECT and '
+                             'absolute-uri ones')
+    parser.add_argument('--cpu-affinity', action='store_true',
+                        help='pin each worker to its own cpu')
+    parser.add_argument('--access-log', metavar='PATH',
+                        help='append one json line per closed tunnel')
+    parser.add_argument('--admin-port', type=int,
+                        help='serve /stats (json) and /metrics on 127.0.0.1')
+    parser.add_argument('--loop-profile', type=int, nargs='?', const=DEFAULT_SAMPLE_EVERY,
+                        metavar='N', help='profile every Nth event loop iteration (default '
+                        '%d), served as /profile on the admin port' % DEFAULT_SAMPLE_EVERY)
+    parser.add_argument('--slow-callback', type=float, default=DEFAULT_SLOW_THRESHOLD * 1000,
+                        metavar='MS', help='with --loop-profile, log a handler running longer '
+                        'than this with its stack')
+    parser.add_argument('--forbidden-ip', metavar='CIDRS',
+                        help='refuse these destinations, comma separated or a file')
+    parser.add_argument('--allowed-clients', metavar='CIDRS',
+                        help='only accept clients from these networks')
+    parser.add_argument('--max-tunnels', type=int,
+                        help='stop accepting above this many open tunnels '
+                             '(default: derived from the fd limit)')
+    parser.add_argument('--rate-limit', type=parse_size, metavar='BYTES',
+                        help='per tunnel bytes per second, both directions together '
+                             '(k, M, G suffixes)')
+    parser.add_argument('--client-rate-limit', type=parse_size, metavar='BYTES',
+                        help='bytes per second shared by all tunnels of one client ip')
+    parser.add_argument('--global-rate-limit', type=parse_size, metavar='BYTES',
+                        help='bytes per second for all tunnels, per worker')
+    parser.add_argument('--read-budget', type=parse_size, metavar='BYTES',
+                        help='bytes one tunnel may read per loop iteration '
+                             '(default %d), lower keeps small flows snappy under bulk '
+                             'load' % BUF_SIZE)
+    parser.add_argument('--handoff', metavar='PATH',
+                        help='unix socket for hot restarts: a new process started with the '
+                             'same PATH takes over the listening sockets, this one drains')
+    parser.add_argument('--drain-timeout', type=int, default=DRAIN_TIMEOUT,
+                        help='seconds open tunnels get after a handoff')
+    parser.add_argument('--upstream', metavar='HOST:PORT',
+                        help='carry tunnels over persistent mux connections to another '
+                             'instance started with --mux-port')
+    parser.add_argument('--mux-connections', type=int, default=DEFAULT_CONNECTIONS,
+                        help='mux connections per worker with --upstream')
+    parser.add_argument('--mux-port', type=int,
+                        help='serve mux connections from --upstream instances on this port')
+    parser.add_argument('--mux-compress', action='store_true',
+                        help='deflate tunnels on mux connections where both ends agree')
+    parser.add_argument('--mux-key', metavar='KEY',
+                        help='authenticate every chunk on mux connections, both ends need '
+                             'the same KEY')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='debug logging')
+    parser.add_argument('--trace-sample', type=float, default=0,
+                        help='with -v, fraction of tunnels to trace per packet')
+    args = parser.parse_args()
+    if args.handoff and (args.workers > 1 or args.engine != 'event_loop'):
+        parser.error('--handoff needs a single worker on the event_loop engine')
+    config = {'splice': args.splice, 'reuse_port': args.workers > 1,
+              'access_log': args.access_log, 'trace_sample': args.trace_sample,
+              'admin_port': args.admin_port, 'event_model': args.event_model,
+              'loop_profile': args.loop_profile, 'slow_callback': args.slow_callback / 1000.0,
+              'http_proxy': args.http, 'engine': args.engine,
+              'handoff': args.handoff, 'drain_timeout': args.drain_timeout,
+              'max_tunnels': args.max_tunnels, 'mux_port': args.mux_port,
+              'rate_limit': args.rate_limit, 'client_rate_limit': args.client_rate_limit,
+              'global_rate_limit': args.global_rate_limit, 'read_budget': args.read_budget,
+              'mux_connections': args.mux_connections, 'mux_compress': args.mux_compress,
+              'mux_key': args.mux_key and args.mux_key.encode('utf-8')}
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s')
+    for name in ('forbidden_ip', 'allowed_clients'):
+        spec = getattr(args, name)
+        if spec:
+            config[name] = common.IPNetwork(read_cidr_list(spec))
+    if args.upstream:
+        host, _, port = args.upstream.rpartition(':')
+        try:
+            # resolved once here, the mux connections are opened by number
+            config['upstream'] = socket.getaddrinfo(host.strip('[]'), int(port), 0,
+                                                    socket.SOCK_STREAM)[0][4][:2]
+        except (ValueError, socket.gaierror) as e:
+            parser.error('--upstream %s: %s' % (args.upstream, e))
+    if args.workers > 1:
+        shared_stats = SharedStats(args.workers) if args.admin_port else None
+        Supervisor(args.workers, lambda index: serve(args.port, config, index, shared_stats),
+                   args.cpu_affinity).run()
+    else:
+        serve(args.port, config)
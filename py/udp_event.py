@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import errno
+import logging
+import socket
+from collections import OrderedDict
+
+import common
+from common import ADDRTYPE_HOST, ADDRTYPE_MASK, UDP_HEADER_PREFIX, \
+    pack_udp_header, parse_header_from
+from event_loop import POLL_ERR, POLL_IN
+from utils import errno_from_exception
+
+# datagrams read from one socket per poll wakeup before yielding the loop
+UDP_BATCH = 64
+UDP_BUF_SIZE = 64 * 1024
+# a destination that hasn't been written to for this long no longer gets
+# its replies forwarded
+NAT_TIMEOUT = 60
+# the table is swept for such destinations at most this often
+NAT_EXPIRE_INTERVAL = 1.0
+# destinations one association forwards replies from, past it the one
+# written to longest ago is dropped
+MAX_NAT_ENTRIES = 4096
+
+# one buffer for every association, the loop is single threaded
+_udp_buf = bytearray(UDP_BUF_SIZE)
+_udp_view = memoryview(_udp_buf)
+
+
+class UDPAssociation(object):
+    """Relay for one SOCKS5 UDP ASSOCIATE, alive as long as its TCP tunnel.
+
+    Client datagrams carry the usual RSV FRAG ATYP DST.ADDR DST.PORT header
+    which is stripped on the way out and rebuilt from the sender address
+    on the way back. Replies are only forwarded from destinations in the
+    NAT table, which forgets entries after NAT_TIMEOUT idle seconds and
+    holds at most MAX_NAT_ENTRIES.
+    """
+
+    def __init__(self, tunnel, loop, dns_resolver, bind_ip, client_ip,
+                 client_port, forbidden_ip=None):
+        self._tunnel = tunnel
+        self._loop = loop
+        self._dns_resolver = dns_resolver
+        self._forbidden_ip = forbidden_ip  # type: common.IPNetwork
+        self._client_ip = client_ip
+        # rfc1928 lets the client announce its source port, 0 = learn it
+        self._client_addr = (client_ip, client_port) if client_port else None
+        family = socket.AF_INET6 if ':' in bind_ip else socket.AF_INET
+        self._relay_sock = socket.socket(family, socket.SOCK_DGRAM)
+        self._relay_sock.setblocking(False)
+        self._relay_sock.bind((bind_ip, 0))
+        loop.add(self._relay_sock, POLL_IN | POLL_ERR, self)
+        self._remote_socks = {}  # family -> sock
+        self._nat = OrderedDict()  # (ip, port) -> last sent
+        self._nat_swept = loop.time()
+        self._closed = False
+
+    @property
+    def bind_address(self):
+        return self._relay_sock.getsockname()[:2]
+
+    def _remote_sock(self, family):
+        sock = self._remote_socks.get(family)
+        if sock is None:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self._loop.add(sock, POLL_IN | POLL_ERR, self)
+            self._remote_socks[family] = sock
+        return sock
+
+    def handle_event(self, sock, fd, mode):
+        if sock == self._relay_sock:
+            self._on_client_readable()
+        else:
+            self._on_remote_readable(sock)
+
+    def _on_client_readable(self):
+        sock = self._relay_sock
+        for _ in range(UDP_BATCH):
+            try:
+                n, addr = sock.recvfrom_into(_udp_buf)
+            except (OSError, IOError) as e:
+                if errno_from_exception(e) not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logging.debug('udp relay recv: %s', e)
+                return
+            if addr[0] != self._client_ip:
+                continue
+            if self._client_addr is None:
+                self._client_addr = addr[:2]
+            elif addr[:2] != self._client_addr:
+                continue
+            data = _udp_view[:n]
+            # RSV RSV FRAG, fragmented datagrams are not supported
+            if n < 4 or data[2] != 0:
+                continue
+            header_result = parse_header_from(data, UDP_HEADER_PREFIX)
+            if not header_result:
+                continue
+            addrtype, dest_addr, dest_port, header_length = header_result
+            payload = data[UDP_HEADER_PREFIX + header_length:]
+            self._tunnel.udp_activity(len(payload), 0)
+            if addrtype & ADDRTYPE_MASK != ADDRTYPE_HOST:
+                if self._forbidden_ip and \
+                        self._forbidden_ip.contains_packed(
+                            data[UDP_HEADER_PREFIX + 1:UDP_HEADER_PREFIX + header_length - 2]):
+                    continue
+                self._send_to(dest_addr, dest_port, payload)
+            else:
+                # the resolver may call back later, the buffer is reused
+                payload = bytes(payload)
+                self._dns_resolver.resolve(
+                    dest_addr, lambda result, error, port=dest_port,
+                    payload=payload: self._on_resolved(result, error, port,
+                                                       payload))
+
+    def _on_resolved(self, result, error, port, payload):
+        if self._closed or error:
+            return
+        if self._forbidden_ip and result[1] in self._forbidden_ip:
+            return
+        self._send_to(result[1], port, payload)
+
+    def _send_to(self, ip, port, payload):
+        ip = common.to_str(ip)
+        family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+        key = (ip, port)
+        nat = self._nat
+        nat[key] = self._loop.time()
+        nat.move_to_end(key)
+        if len(nat) > MAX_NAT_ENTRIES:
+            nat.popitem(last=False)
+        # destinations that never answer would otherwise only be swept
+        # by a reply
+        self._expire_nat()
+        try:
+            self._remote_sock(family).sendto(payload, key)
+        except (OSError, IOError) as e:
+            logging.debug('udp sendto %s:%d: %s', ip, port, e)
+
+    def _expire_nat(self):
+        now = self._loop.time()
+        if now - self._nat_swept < NAT_EXPIRE_INTERVAL:
+            return
+        self._nat_swept = now
+        deadline = now - NAT_TIMEOUT
+        nat = self._nat
+        while nat:
+            key, last = next(iter(nat.items()))
+            if last > deadline:
+                break
+            del nat[key]
+
+    def _on_remote_readable(self, sock):
+        if self._client_addr is None:
+            return
+        self._expire_nat()
+        for _ in range(UDP_BATCH):
+            try:
+                n, addr = sock.recvfrom_into(_udp_buf)
+            except (OSError, IOError) as e:
+                if errno_from_exception(e) not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logging.debug('udp remote recv: %s', e)
+                return
+            addr = addr[:2]
+            if addr not in self._nat:
+                continue
+            header = pack_udp_header(addr[0], addr[1])
+            try:
+                # gather header and payload, the payload stays in the buffer
+                self._relay_sock.sendmsg([header, _udp_view[:n]], [], 0,
+                                         self._client_addr)
+            except (OSError, IOError) as e:
+                logging.debug('udp relay send: %s', e)
+                continue
+            self._tunnel.udp_activity(0, n)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for sock in [self._relay_sock] + list(self._remote_socks.values()):
+            self._loop.remove(sock)
+            sock.close()
+        self._remote_socks.clear()
+        self._nat.clear()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import socket
+from collections import OrderedDict
+
+from event_loop import POLL_ERR, POLL_IN, EventLoop
+
+# idle connections kept per (host, port) and in total, and how long one
+# may sit unused before it is closed
+MAX_PER_KEY = 8
+MAX_IDLE = 512
+IDLE_TIMEOUT = 60
+
+
+class UpstreamPool(object):
+    """Idle keep-alive connections to http origins, keyed by (host, port).
+
+    Idle sockets stay registered on the loop: anything readable on one,
+    normally the origin closing it, drops it from the pool. When a limit
+    is hit the least recently released connection goes first.
+    """
+
+    def __init__(self, max_per_key=MAX_PER_KEY, max_idle=MAX_IDLE,
+                 idle_timeout=IDLE_TIMEOUT):
+        self._max_per_key = max_per_key
+        self._max_idle = max_idle
+        self._idle_timeout = idle_timeout
+        self._idle = OrderedDict()  # sock -> (key, released at), oldest first
+        self._by_key = {}  # key -> [sock], most recently released last
+        self._loop = None
+        self._timer = None
+
+    def __len__(self):
+        return len(self._idle)
+
+    def add_to_loop(self, loop):
+        self._loop = loop
+
+    def acquire(self, key):
+        """An idle connection to key, or None. The caller owns it after."""
+        socks = self._by_key.get(key)
+        if not socks:
+            return None
+        # the most recently used one is the least likely to be timed out
+        sock = socks.pop()
+        if not socks:
+            del self._by_key[key]
+        del self._idle[sock]
+        self._loop.remove(sock)
+        return sock
+
+    def release(self, key, sock):
+        """Hand back a connection that sits between two responses."""
+        socks = self._by_key.setdefault(key, [])
+        if len(socks) >= self._max_per_key:
+            self._drop(socks[0])
+        if len(self._idle) >= self._max_idle:
+            self._drop(next(iter(self._idle)))
+        self._by_key.setdefault(key, []).append(sock)
+        self._idle[sock] = (key, self._loop.time())
+        self._loop.add(sock, POLL_IN | POLL_ERR, self)
+        if self._timer is None:
+            self._timer = self._loop.call_later(self._idle_timeout, self._expire)
+
+    def handle_event(self, sock, fd, mode):
+        if sock in self._idle:
+            self._drop(sock)
+
+    def _drop(self, sock):
+        key, released_at = self._idle.pop(sock)
+        socks = self._by_key[key]
+        socks.remove(sock)
+        if not socks:
+            del self._by_key[key]
+        self._loop.remove(sock)
+        sock.close()
+
+    def _expire(self):
+        self._timer = None
+        deadline = self._loop.time() - self._idle_timeout
+        while self._idle:
+            sock, (key, released_at) = next(iter(self._idle.items()))
+            if released_at > deadline:
+                self._timer = self._loop.call_later(released_at - deadline,
+                                                    self._expire)
+                break
+            self._drop(sock)
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        while self._idle:
+            self._drop(next(iter(self._idle)))
+
+
+def test_upstream_pool():
+    loop = EventLoop()
+    pool = UpstreamPool(max_per_key=2)
+    pool.add_to_loop(loop)
+    key = (b'example.com', 80)
+    pairs = [socket.socketpair() for _ in range(3)]
+    for ours, _ in pairs:
+        pool.release(key, ours)
+    # past the per key limit the least recently released one goes
+    assert len(pool) == 2 and pairs[0][0].fileno() == -1
+    # an idle connection the origin closes is dropped, not handed out
+    pairs[2][1].close()
+    loop.call_later(0.05, loop.stop)
+    loop.run()
+    assert len(pool) == 1 and pairs[2][0].fileno() == -1
+    assert pool.acquire(key) is pairs[1][0] and pool.acquire(key) is None
+    for ours, theirs in pairs:
+        ours.close()
+        theirs.close()
+    pool.close()
+    loop.close()
+
+
+if __name__ == '__main__':
+    test_upstream_pool()
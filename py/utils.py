@@ -1,23 +1,81 @@
 # -*- coding: utf-8 -*-
 
+import errno
+import os
 import re
 import socket
 
 
+# a method is an http token, a target has no whitespace or controls
+_REQUEST_LINE = re.compile(br"^([!#$%&'*+.^_`|~0-9A-Za-z-]+) ([\x21-\x7e]+) (HTTP/\d\.\d)\Z")
+MAX_REQUEST_LINE = 8192
+MAX_HOST_SIZE = 255
+
+
+def parse_request_line(line):
+    # type: (bytes) -> (bytes,bytes,bytes)
+    """b'GET http://host/ HTTP/1.1' -> (method, target, version).
+
+    Raises ValueError for anything that isn't exactly one request line.
+    """
+    if len(line) > MAX_REQUEST_LINE:
+        raise ValueError('request line too long')
+    match = _REQUEST_LINE.match(bytes(line))
+    if not match:
+        raise ValueError('bad request line')
+    return match.groups()
+
+
+def _split_authority(authority, default_port):
+    if authority.startswith(b'['):
+        host, sep, port = authority[1:].partition(b']')
+        if not sep or port and not port.startswith(b':'):
+            raise ValueError('bad ipv6 literal')
+        port = port[1:]
+    else:
+        host, _, port = authority.partition(b':')
+    if not host or len(host) > MAX_HOST_SIZE or b'@' in host:
+        raise ValueError('bad host')
+    if port:
+        if not port.isdigit() or len(port) > 5:
+            raise ValueError('bad port')
+        port = int(port)
+    elif default_port:
+        port = default_port
+    else:
+        raise ValueError('no port')
+    if not 0 < port < 65536:
+        raise ValueError('bad port')
+    return host, port
+
+
+def parse_request_target(method, target):
+    # type: (bytes,bytes) -> (bytes,int,bytes)
+    """(host, port, path) of a proxy request target.
+
+    CONNECT takes host:port and has no path, other methods an absolute
+    http uri, http://[user@]host[:port][/path]. Raises ValueError.
+    """
+    if method == b'CONNECT':
+        host, port = _split_authority(target, None)
+        return host, port, None
+    if target[:7].lower() != b'http://':
+        raise ValueError('not an absolute http uri')
+    authority, slash, path = target[7:].partition(b'/')
+    authority = authority.rpartition(b'@')[2]
+    host, port = _split_authority(authority, 80)
+    return host, port, slash + path or b'/'
+
+
 def parse_host_from_req_data(req_data):
-    # type: (bytes) -> (str,int)
-    s = str(req_data)
-    r = re.findall(r'https?://([^ /]+)', s)
-    if r and len(r) > 0:
-        url = r[0]
-        r2 = re.findall(r'([^:]+):?(\d+)?', url)
-        if r2 and len(r2) > 0:
-            r2 = r2[0]
-            host = r2[0]
-            port = 80
-            if r2[1]:
-                port = int(r2[1])
-            return host, port
+    # type: (bytes) -> (bytes,int)
+    """(host, port) the proxy request starting req_data asks for, None if
+    it doesn't start with a well-formed one."""
+    try:
+        method, target, _ = parse_request_line(req_data.split(b'\r\n', 1)[0])
+        return parse_request_target(method, target)[:2]
+    except ValueError:
+        return None
 
 
 def errno_from_exception(e):
@@ -40,8 +98,14 @@ def errno_from_exception(e):
 
 def create_remote_socket(ip, port):
     # type: (str,int) -> socket.socket
+    """Start a non-blocking connect to a numeric address.
+
+    Errors other than "in progress" are raised so that the caller can
+    move on to its next address, completion is signalled by the socket
+    becoming writable and is checked with SO_ERROR.
+    """
     addrs = socket.getaddrinfo(ip, port, 0, socket.SOCK_STREAM,
-                               socket.SOL_TCP)
+                               socket.SOL_TCP, socket.AI_NUMERICHOST)
     if len(addrs) == 0:
         raise Exception("getaddrinfo failed for %s:%d" % (ip, port))
     af, socktype, proto, canonname, sa = addrs[0]
@@ -50,16 +114,17 @@ def create_remote_socket(ip, port):
     remote_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
     remote_sock.setblocking(False)
     try:
-        remote_sock.connect((ip, port))
-    except IOError as e:
-        errno = errno_from_exception(e)
-        if errno == 36:
-            pass
+        remote_sock.connect(sa)
+    except (OSError, IOError) as e:
+        if errno_from_exception(e) not in (errno.EINPROGRESS,
+                                           errno.EWOULDBLOCK):
+            remote_sock.close()
+            raise
 
     return remote_sock
 
 
-def create_server_socket(listen_addr, listen_port):
+def create_server_socket(listen_addr, listen_port, reuse_port=False):
     addrs = socket.getaddrinfo(listen_addr, listen_port, 0,
                                socket.SOCK_STREAM, socket.SOL_TCP)
     if len(addrs) == 0:
@@ -68,7 +133,62 @@ def create_server_socket(listen_addr, listen_port):
     af, socktype, proto, canonname, sa = addrs[0]
     server_socket = socket.socket(af, socktype, proto)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # every worker binds its own socket, the kernel spreads connections
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server_socket.bind(sa)
     server_socket.listen(1024)
     server_socket.setblocking(False)
     return server_socket
+
+
+def parse_size(text):
+    # type: (str) -> int
+    """'512', '64k', '10M' or '1G' as a number of bytes."""
+    text = text.strip()
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    scale = units.get(text[-1:].lower())
+    if scale:
+        text = text[:-1]
+    return int(float(text) * (scale or 1))
+
+
+def read_cidr_list(spec):
+    # type: (str) -> list
+    """A comma separated list, or a file with one CIDR per line ('#' comments)."""
+    if not os.path.isfile(spec):
+        return spec.split(',')
+    with open(spec) as f:
+        return [line.split('#', 1)[0] for line in f]
+
+
+def test_parse_request():
+    assert parse_request_line(b'CONNECT example.com:443 HTTP/1.1') == \
+        (b'CONNECT', b'example.com:443', b'HTTP/1.1')
+    for line in (b'GET  / HTTP/1.1', b'GET / HTTP/1.1 x', b'GET /\x00 HTTP/1.1',
+                 b'GET / FTP/1.0', b'G\xe9T / HTTP/1.1', b'\x05\x01\x00'):
+        try:
+            parse_request_line(line)
+        except ValueError:
+            continue
+        assert False, line
+    assert parse_request_target(b'CONNECT', b'[::1]:8443') == (b'::1', 8443, None)
+    assert parse_request_target(b'GET', b'HTTP://u:p@example.com:8080') == \
+        (b'example.com', 8080, b'/')
+    assert parse_request_target(b'GET', b'http://example.com/a?b') == (b'example.com', 80, b'/a?b')
+    for method, target in ((b'CONNECT', b'example.com'), (b'CONNECT', b'example.com:0'),
+                           (b'CONNECT', b'example.com:https'), (b'GET', b'/index.html'),
+                           (b'GET', b'https://example.com/'), (b'GET', b'http://:80/'),
+                           (b'CONNECT', b'[::1]x:443'), (b'CONNECT', b'a@b:443')):
+        try:
+            parse_request_target(method, target)
+        except ValueError:
+            continue
+        assert False, target
+    assert parse_host_from_req_data(b'GET http://example.com:81/ HTTP/1.1\r\nHost: x\r\n') == \
+        (b'example.com', 81)
+    assert parse_host_from_req_data(b'\x05\x01\x00') is None
+
+
+if __name__ == '__main__':
+    test_parse_request()
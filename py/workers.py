@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import signal
+import time
+
+# a worker that dies sooner than this after starting is restarted only
+# after RESTART_DELAY, so a crashing worker can't fork-bomb the box
+MIN_UPTIME = 1
+RESTART_DELAY = 1
+
+
+class Supervisor(object):
+    """Pre-fork supervisor: keeps worker_count children running target.
+
+    target(index) runs in the child and should not return, each worker
+    builds its own EventLoop and SO_REUSEPORT listening socket.
+    """
+
+    def __init__(self, worker_count, target, cpu_affinity=False):
+        self._worker_count = worker_count
+        self._target = target
+        self._cpu_affinity = cpu_affinity
+        self._workers = {}  # pid -> (index, started_at)
+        self._stopping = False
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            if self._cpu_affinity and hasattr(os, 'sched_setaffinity'):
+                cpus = sorted(os.sched_getaffinity(0))
+                os.sched_setaffinity(0, {cpus[index % len(cpus)]})
+            code = 0
+            try:
+                self._target(index)
+            except Exception as e:
+                logging.exception(e)
+                code = 1
+            finally:
+                os._exit(code)
+        self._workers[pid] = (index, time.time())
+        logging.info("started worker %d pid:%d", index, pid)
+
+    def _handle_stop(self, signum, frame):
+        self._stopping = True
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        for index in range(self._worker_count):
+            self._spawn(index)
+        while self._workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            if pid not in self._workers:
+                continue
+            index, started_at = self._workers.pop(pid)
+            if self._stopping:
+                continue
+            logging.error("worker %d pid:%d exited with status %d", index,
+                          pid, status)
+            if time.time() - started_at < MIN_UPTIME:
+                time.sleep(RESTART_DELAY)
+                if self._stopping:
+                    continue
+            self._spawn(index)